@@ -1,12 +1,48 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from adorym.util import *
-from adorym.constants import *
-from adorym.misc import *
-from adorym.ptychography import *
-from adorym.forward_model import *
-from adorym.regularizers import *
-from adorym.simulation import *
-from adorym.wrappers import *
-from adorym.visualization import *
\ No newline at end of file
+import importlib
+import importlib.util
+
+# Public names of these modules are attributes of the package. They are imported on first access (PEP 562), so that
+# "import adorym" does not load the backends and the other heavy dependencies. If a name is defined in several
+# modules, the one of the module listed last is used.
+_submodule_ls = ['util', 'constants', 'misc', 'timing', 'ptychography', 'forward_model', 'regularizers',
+                 'simulation', 'wrappers', 'visualization']
+
+
+def _get_public_names(module):
+    if hasattr(module, '__all__'):
+        return list(module.__all__)
+    return [name for name in vars(module).keys() if not name.startswith('_')]
+
+
+def _import_submodule(name):
+    return importlib.import_module('{}.{}'.format(__name__, name))
+
+
+def __getattr__(name):
+    if name == '__all__':
+        d = {}
+        for submodule in _submodule_ls:
+            module = _import_submodule(submodule)
+            for n in _get_public_names(module):
+                d[n] = getattr(module, n)
+        globals().update(d)
+        globals()['__all__'] = list(d.keys())
+        return globals()['__all__']
+    if name.startswith('__'):
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    if importlib.util.find_spec('{}.{}'.format(__name__, name)) is not None:
+        return _import_submodule(name)
+    for submodule in _submodule_ls[::-1]:
+        module = _import_submodule(submodule)
+        if name in _get_public_names(module):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__getattr__('__all__')))
@@ -2,13 +2,15 @@ import numpy as np
 import os
 import h5py
 import gc
-from scipy.ndimage import rotate as sp_rotate
 
 from adorym.util import *
 import adorym.wrappers as w
 import adorym.conventional as c
 import adorym.global_settings as global_settings
 from adorym.misc import *
+from adorym.lazy import LazyModule
+
+ndimage = LazyModule('scipy.ndimage')
 
 project_config = check_config_indept_mpi()
 try:
@@ -28,8 +30,12 @@ n_ranks = comm.Get_size()
 rank = comm.Get_rank()
 
 class LargeArray(object):
-
-    def __init__(self, full_size, distribution_mode=None, monochannel=False, output_folder=None, device=None):
+    """
+    :param comm: Communicator among the ranks holding the slabs of the object in distributed_object mode. Default
+                 is MPI.COMM_WORLD; a sub-communicator is passed when object groups are replicated.
+    """
+    def __init__(self, full_size, distribution_mode=None, monochannel=False, output_folder=None, device=None,
+                 comm=None):
         self.full_size = full_size
         self.distribution_mode=distribution_mode
         self.monochannel = monochannel
@@ -41,21 +47,26 @@ class LargeArray(object):
         self.arr_rot = None
         self.device = device
         self.slice_catalog = None
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.n_ranks = self.comm.Get_size()
         if distribution_mode == 'distributed_object':
-            self.slice_catalog = get_multiprocess_distribution_index(full_size[0], n_ranks)
+            self.slice_catalog = get_multiprocess_distribution_index(full_size[0], self.n_ranks)
 
-    def create_file_object(self, fname, use_checkpoint=False):
+    def create_file_object(self, fname, use_checkpoint=False, dtype='float32', probe_size=None):
         fmode = 'a' if use_checkpoint else 'w'
-        try:
-            self.f = h5py.File(os.path.join(self.output_folder, fname), fmode, driver='mpio', comm=comm)
-        except:
-            self.f = h5py.File(os.path.join(self.output_folder, fname), fmode)
-        try:
-            # If dataset doesn't exist, create it.
-            self.dset = self.f.create_dataset('obj', shape=self.full_size, dtype='float64')
-        except:
-            # If dataset exists, create a pointer to it.
-            self.dset = self.f['obj']
+        self.f, self.dset = self.open_chunked_file(fname, fmode, dtype=dtype, probe_size=probe_size)
+
+    def open_chunked_file(self, fname, fmode, dtype='float32', probe_size=None):
+        """
+        Open an HDF5 file and create (or get, if it exists) its 'obj' dataset with the chunk layout and chunk cache
+        chosen by plan_hdf5_layout. The dataset is not zero-filled on creation.
+        """
+        chunk_shape, cache_bytes = plan_hdf5_layout(self.full_size, dtype=dtype, probe_size=probe_size)
+        f = open_hdf5_file_mpi(os.path.join(self.output_folder, fname), fmode, cache_bytes=cache_bytes,
+                               chunk_bytes=int(np.prod(chunk_shape)) * np.dtype(dtype).itemsize)
+        dset = create_dataset_without_fill(f, 'obj', self.full_size, dtype=dtype, chunks=chunk_shape)
+        return f, dset
 
     def read_chunks_from_file(self, this_pos_batch, probe_size, dset_2=None, device=None, unknown_type='delta_beta'):
         dset = self.dset if dset_2 is None else dset_2
@@ -67,11 +78,11 @@ class LargeArray(object):
 
     def read_chunks_from_distributed_object(self, probe_pos, this_ind_batch_allranks, minibatch_size,
                                             probe_size, device=None, unknown_type='delta_beta', apply_to_arr_rot=False,
-                                            dtype='float32', n_split='auto', create_variable=True):
+                                            dtype='float32', n_split='auto', create_variable=True, sync=None):
         a = self.arr if not apply_to_arr_rot else self.arr_rot
         obj = get_subblocks_from_distributed_object_mpi(a, self.slice_catalog, probe_pos, this_ind_batch_allranks, minibatch_size,
                                                     probe_size, self.full_size, unknown_type, output_folder=self.output_folder,
-                                                    dtype=dtype, n_split=n_split)
+                                                    dtype=dtype, n_split=n_split, comm=self.comm, sync=sync)
         if create_variable:
             obj = w.create_variable(obj, device=device)
         return obj
@@ -105,7 +116,7 @@ class LargeArray(object):
             else:
                 self.arr_rot = b
         else:
-            b = sp_rotate(a, -coords, axes=(1, 2), reshape=False, order=1, mode='nearest')
+            b = ndimage.rotate(a, -coords, axes=(1, 2), reshape=False, order=1, mode='nearest')
             # b = w.rotate(a, coords, override_backend=override_backend)
             if overwrite_arr:
                 self.arr = b
@@ -140,37 +151,36 @@ class LargeArray(object):
                                 probe_size, self.full_size, monochannel=self.monochannel, dtype='float32')
 
     def sync_chunks_to_distributed_object(self, obj, probe_pos, this_ind_batch_allranks, minibatch_size,
-                                          probe_size, dtype='float32', n_split='auto'):
+                                          probe_size, dtype='float32', n_split='auto', sync=None):
         obj = np.array(obj)
         self.arr = sync_subblocks_among_distributed_object_mpi(obj, self.arr, self.slice_catalog, probe_pos, this_ind_batch_allranks,
                                                        minibatch_size, probe_size, self.full_size,
-                                                       output_folder=self.output_folder, dtype='float32', n_split=n_split)
+                                                       output_folder=self.output_folder, dtype='float32', n_split=n_split,
+                                                       comm=self.comm, sync=sync)
 
 
 class ObjectFunction(LargeArray):
 
     def __init__(self, full_size, distribution_mode=None, output_folder=None, ds_level=1,
-                 object_type='normal', device=None):
+                 object_type='normal', device=None, comm=None):
         super(ObjectFunction, self).__init__(full_size, distribution_mode=distribution_mode,
-                                             monochannel=False, output_folder=output_folder, device=device)
+                                             monochannel=False, output_folder=output_folder, device=device, comm=comm)
         self.chunks = None
         self.ds_level = ds_level
         self.object_type = object_type
         self.f_rot = None
         self.dset_rot = None
 
-    def create_file_object(self, use_checkpoint=False):
-        super(ObjectFunction, self).create_file_object('intermediate_obj.h5', use_checkpoint=use_checkpoint)
+    def create_file_object(self, use_checkpoint=False, dtype='float32', probe_size=None):
+        super(ObjectFunction, self).create_file_object('intermediate_obj.h5', use_checkpoint=use_checkpoint,
+                                                       dtype=dtype, probe_size=probe_size)
 
-    def create_temporary_file_object(self):
+    def create_temporary_file_object(self, dtype='float32', probe_size=None):
         """
         This file is used to save rotated object.
         """
-        try:
-            self.f_rot = h5py.File(os.path.join(self.output_folder, 'intermediate_obj_rot.h5'), 'w', driver='mpio', comm=comm)
-        except:
-            self.f_rot = h5py.File(os.path.join(self.output_folder, 'intermediate_obj_rot.h5'), 'w')
-        self.dset_rot = self.f_rot.create_dataset('obj', shape=self.full_size, dtype='float64')
+        self.f_rot, self.dset_rot = self.open_chunked_file('intermediate_obj_rot.h5', 'w', dtype=dtype,
+                                                           probe_size=probe_size)
 
     def initialize_array(self, save_stdout=None, timestr=None, not_first_level=False, initial_guess=None, device=None,
                          random_guess_means_sigmas=(8.7e-7, 5.1e-8, 1e-7, 1e-8), unknown_type='delta_beta', non_negativity=False):
@@ -190,26 +200,27 @@ class ObjectFunction(LargeArray):
 
     def initialize_distributed_array(self, save_stdout=None, timestr=None, not_first_level=False, initial_guess=None,
                          random_guess_means_sigmas=(8.7e-7, 5.1e-8, 1e-7, 1e-8), unknown_type='delta_beta', dtype='float32', non_negativity=False):
-        if self.slice_catalog[rank] is not None:
+        if self.slice_catalog[self.rank] is not None:
             delta, beta = \
                 initialize_object_for_do(self.full_size[:-1], slice_catalog=self.slice_catalog, ds_level=self.ds_level, object_type=self.object_type,
                                   initial_guess=initial_guess, output_folder=self.output_folder,
                                   save_stdout=save_stdout, timestr=timestr,
                                   not_first_level=not_first_level,
                                   random_guess_means_sigmas=random_guess_means_sigmas, unknown_type=unknown_type, dtype=dtype,
-                                  non_negativity=non_negativity)
+                                  non_negativity=non_negativity, comm=self.comm)
             self.arr = np.stack([delta, beta], -1)
 
     def initialize_distributed_array_with_values(self, obj_delta, obj_beta, dtype='float32'):
-        if self.slice_catalog[rank] is not None:
-            delta = obj_delta[slice(*self.slice_catalog[rank])]
-            beta = obj_beta[slice(*self.slice_catalog[rank])]
+        if self.slice_catalog[self.rank] is not None:
+            delta = obj_delta[slice(*self.slice_catalog[self.rank])]
+            beta = obj_beta[slice(*self.slice_catalog[self.rank])]
             self.arr = np.stack([delta, beta], -1).astype(dtype)
 
     def initialize_distributed_array_with_zeros(self, dtype='float32'):
-        if self.slice_catalog[rank] is not None:
-            delta = np.zeros([self.slice_catalog[rank][1] - self.slice_catalog[rank][0], *self.full_size[1:-1]], dtype=dtype)
-            beta = np.zeros([self.slice_catalog[rank][1] - self.slice_catalog[rank][0], *self.full_size[1:-1]], dtype=dtype)
+        if self.slice_catalog[self.rank] is not None:
+            slab_shape = [self.slice_catalog[self.rank][1] - self.slice_catalog[self.rank][0], *self.full_size[1:-1]]
+            delta = np.zeros(slab_shape, dtype=dtype)
+            beta = np.zeros(slab_shape, dtype=dtype)
             self.arr = np.stack([delta, beta], -1)
 
     def initialize_file_object(self, save_stdout=None, timestr=None, not_first_level=False, initial_guess=None,
@@ -276,27 +287,53 @@ class Gradient(ObjectFunction):
     def __init__(self, obj, forward_model=None):
         assert isinstance(obj, ObjectFunction)
         super(Gradient, self).__init__(obj.full_size, obj.distribution_mode,
-                                 obj.output_folder, obj.dset, obj.object_type)
+                                 obj.output_folder, obj.dset, obj.object_type, comm=obj.comm)
         self.forward_model = forward_model
+        self.tile_dict = None
+        self.tile_shape = None
+
+    def create_file_object(self, dtype='float32', probe_size=None):
+        # The gradient file is entirely overwritten by write_tile_buffer_to_file before it is read, so it is
+        # neither zero-filled on creation nor initialized.
+        super(ObjectFunction, self).create_file_object('intermediate_grad.h5', use_checkpoint=False, dtype=dtype,
+                                                       probe_size=probe_size)
 
-    def create_file_object(self):
-        super(ObjectFunction, self).create_file_object('intermediate_grad.h5', use_checkpoint=False)
+    def accumulate_chunks(self, this_pos_batch, arr_channel_0, arr_channel_1, probe_size, dtype='float32'):
+        """
+        Add gradient chunks to the rank-local tile buffer. Used in shared_file mode instead of write_chunks_to_file;
+        the buffer is written to the HDF5 file by write_tile_buffer_to_file.
+        """
+        if self.tile_dict is None:
+            self.tile_dict = {}
+            self.tile_shape = tuple(probe_size[:2])
+        arr_channel_0 = w.to_numpy(arr_channel_0)
+        if arr_channel_1 is not None: arr_channel_1 = w.to_numpy(arr_channel_1)
+        accumulate_subblocks_to_tiles(self.tile_dict, this_pos_batch, arr_channel_0, arr_channel_1, probe_size,
+                                      self.full_size, self.tile_shape, monochannel=self.monochannel, dtype=dtype)
 
-    def initialize_gradient_file(self, dtype='float32'):
-        initialize_hdf5_with_constant(self.dset, rank, n_ranks, dtype=dtype)
+    def write_tile_buffer_to_file(self, dtype='float32', sync=None):
+        """
+        Sum the tile buffers of all ranks into the gradient file, replacing its content, and clear the buffer.
+        Collective.
+        :param sync: adorym.SyncCounter in which the wait time of the collectives is counted.
+        """
+        write_tiles_to_file_mpi(self.dset, {} if self.tile_dict is None else self.tile_dict, self.tile_shape,
+                                self.full_size, dtype=dtype, sync=sync)
+        self.tile_dict = None
 
 
 class Mask(LargeArray):
 
-    def __init__(self, full_size, finite_support_mask_path, distribution_mode=None, output_folder=None, ds_level=1):
+    def __init__(self, full_size, finite_support_mask_path, distribution_mode=None, output_folder=None, ds_level=1,
+                 comm=None):
         super(Mask, self).__init__(full_size, distribution_mode,
-                                   monochannel=True, output_folder=output_folder)
+                                   monochannel=True, output_folder=output_folder, comm=comm)
         self.mask = None
         self.ds_level = ds_level
         self.finite_support_mask_path = finite_support_mask_path
 
-    def create_file_object(self, use_checkpoint=False):
-        super(Mask, self).create_file_object('intermediate_mask.h5', use_checkpoint=use_checkpoint)
+    def create_file_object(self, use_checkpoint=False, dtype='float32'):
+        super(Mask, self).create_file_object('intermediate_mask.h5', use_checkpoint=use_checkpoint, dtype=dtype)
 
     def initialize_array_with_values(self, mask, device=None, dtype=None):
         args = {}
@@ -305,8 +342,8 @@ class Mask(LargeArray):
         self.mask = w.create_variable(mask, requires_grad=False, device=device, **args)
 
     def initialize_distributed_array(self, mask, dtype='float32'):
-        if self.slice_catalog[rank] is not None:
-            self.mask = mask[slice(*self.slice_catalog[rank])].astype(dtype)
+        if self.slice_catalog[self.rank] is not None:
+            self.mask = mask[slice(*self.slice_catalog[self.rank])].astype(dtype)
 
     def initialize_file_object(self, dtype='float32'):
         # arr is a memmap.
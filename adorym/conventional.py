@@ -1,7 +1,8 @@
-import dxchange
-
 from adorym.util import *
 import adorym.wrappers as w
+from adorym.lazy import LazyModule
+
+dxchange = LazyModule('dxchange')
 
 
 def alt_reconstruction_epie(obj_real, obj_imag, probe_real, probe_imag, probe_pos, probe_pos_correction,
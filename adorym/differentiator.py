@@ -6,9 +6,12 @@ import adorym.wrappers as w
 class Differentiator(object):
 
     def __init__(self):
+        self.loss = None
         self.loss_object = None
         self.opt_args_ls = []
         self.loss_args = {}
+        # Loss nodes keyed by tuples of opt_args_ls.
+        self.loss_object_dict = {}
 
     def create_loss_node(self, loss, opt_args_ls=None):
         """
@@ -16,7 +19,20 @@ class Differentiator(object):
         :param opt_args_ls: List of Int. A list of indices of arguments in forward_model.get_loss_function/predict to 
                             which the gradient should be calculated.
         """
-        self.loss_object = w.prepare_loss_node(loss, opt_args_ls)
+        self.loss = loss
+        self.loss_object_dict = {}
+        self.set_opt_args_ls(opt_args_ls)
+
+    def set_opt_args_ls(self, opt_args_ls):
+        """
+        Change the arguments to which the gradient is calculated by get_gradients. Gradients with regards to
+        the arguments not in the list are not computed at all. The loss node of each list is created once and reused.
+        :param opt_args_ls: List of Int. A list of indices of arguments in forward_model.get_loss_function/predict.
+        """
+        key = tuple(opt_args_ls) if opt_args_ls is not None else None
+        if key not in self.loss_object_dict:
+            self.loss_object_dict[key] = w.prepare_loss_node(self.loss, opt_args_ls)
+        self.loss_object = self.loss_object_dict[key]
         self.opt_args_ls = opt_args_ls
 
     def get_gradients(self, **kwargs):
@@ -31,35 +47,31 @@ class Differentiator(object):
         Create functions to compute the matrix-vector product of loss-predict-Hessian and predict-object-Jacobian
         with any arbitrary vector in its argument.
         The predict function of forward_model must return detected **magnitudes**.
+        The prediction, the VJP and the JVP all come from one linearization of forward_model.predict, so the
+        forward model is run only once. The loss and its Hessian are evaluated on the saved prediction; the loss
+        value is saved in forward_model.current_loss.
         :param forward_model: adorym.ForwardModel object.
-        :param ind_opt_arg: List of Int. A list of indices of arguments in forward_model.get_loss_function to
-                            which the gradient should be calculated.
+        :param ind_opt_arg: Int. Index of the argument in forward_model.get_loss_function to which the gradient
+                            should be calculated.
         :param kwargs: Unwrapped dictionary or key word arguments that contain ALL arguments of forward_model.get_loss_function/predict.
         """
         assert isinstance(forward_model, adorym.ForwardModel)
-        self.func_vjp, _ = w.vjp(forward_model.predict, [ind_opt_arg])(*list(kwargs.values()))
-        self.func_jvp = w.jvp(forward_model.predict, [ind_opt_arg])(*list(kwargs.values()))
-        #if forward_model.loss_function_type == 'lsq':
-        #    self.func_hvp = lambda x: x
-        #    self.jloss = 2 * forward_model.predict(**kwargs)
-        #else:
-        #    self.func_hvp, self.jloss = w.hvp(forward_model.get_mismatch_loss, [0])(forward_model.this_pred_batch, forward_model.this_prj_batch)
+        self.this_pred_batch, self.func_vjp, self.func_jvp = \
+            w.linearize(forward_model.predict, ind_opt_arg)(*list(kwargs.values()))
 
         # Calculate HVP of loss using predicted and measured data.
         obj = kwargs['obj']
-        this_pred_batch = forward_model.predict(**kwargs)
-        this_prj_batch = forward_model.get_data(kwargs['this_i_theta'], kwargs['this_ind_batch'], 
+        this_prj_batch = forward_model.get_data(kwargs['this_i_theta'], kwargs['this_ind_batch'],
                                                theta_downsample=forward_model.common_vars['theta_downsample'],
                                                ds_level=forward_model.common_vars['ds_level'])
-        self.func_hvp, self.jloss = w.hvp(forward_model.loss, [0])(this_pred_batch, this_prj_batch, obj)
+        self.func_hvp, self.jloss = w.hvp(forward_model.loss, 0)(self.this_pred_batch, this_prj_batch, obj)
+        self.linearization_args = kwargs
 
         # GVP is Gauss-Newton-vector product.
         def f_gvp(g):
-            g = self.func_jvp([g])
+            g = self.func_jvp(g)
             g = self.func_hvp(g)
-            g = self.func_vjp(g)[0]
+            g = self.func_vjp(g)
             return g
         self.func_gvp = f_gvp
-        self.full_grad = self.func_vjp(self.jloss)[0]
-        # gradients = w.get_gradients(self.loss_object, opt_args_ls=[0], **kwargs) # self.full_grad should match gradients
-     
+        self.full_grad = self.func_vjp(self.jloss)
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.ndimage import rotate as sp_rotate
 import inspect
 
 import gc
@@ -8,6 +7,7 @@ import time
 import adorym.wrappers as w
 from adorym.regularizers import *
 from adorym.util import *
+from adorym.timing import timed
 from adorym.propagate import multislice_propagate_batch, get_kernel
 
 class ForwardModel(object):
@@ -103,6 +103,7 @@ class ForwardModel(object):
             this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
         return this_prj_batch
 
+    @timed()
     def loss(self, this_pred_batch, this_prj_batch, obj):
         """
         The last-layer loss function that computes (regularized) loss from predicted magnitude.
@@ -159,6 +160,7 @@ class PtychographyModel(ForwardModel):
         args.pop(0)
         self.argument_ls = args
 
+    @timed()
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, tilt_ls, prj_pos_offset):
@@ -388,6 +390,7 @@ class SingleBatchFullfieldModel(PtychographyModel):
         super(SingleBatchFullfieldModel, self).__init__(loss_function_type, distribution_mode, device, common_vars_dict,
                                                 raw_data_type, simulation_mode=simulation_mode)
 
+    @timed()
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, tilt_ls, prj_pos_offset):
@@ -477,6 +480,7 @@ class SingleBatchPtychographyModel(PtychographyModel):
         super(SingleBatchPtychographyModel, self).__init__(loss_function_type, distribution_mode, device, common_vars_dict,
                                                 raw_data_type, simulation_mode=simulation_mode)
 
+    @timed()
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, tilt_ls, prj_pos_offset):
@@ -578,6 +582,7 @@ class SparseMultisliceModel(ForwardModel):
         args.pop(0)
         self.argument_ls = args
 
+    @timed()
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, slice_pos_cm_ls,
@@ -795,6 +800,7 @@ class MultiDistModel(ForwardModel):
         args.pop(0)
         self.argument_ls = args
 
+    @timed()
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, free_prop_cm, safe_zone_width, prj_affine_ls, ctf_lg_kappa,
@@ -0,0 +1,40 @@
+import importlib
+
+__all__ = ['LazyModule']
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is imported on first attribute access, so that heavy dependencies are only loaded
+    by the processes that use them. Once the module is imported, its attributes are copied onto the stand-in, so
+    later accesses cost the same as on the module itself.
+
+    :param name: Str. Full name of the module, e.g. 'scipy.ndimage'.
+    :param on_load: Function called with the module right after it is imported.
+    """
+    def __init__(self, name, on_load=None):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_on_load'] = on_load
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = module
+            self.__dict__.update(module.__dict__)
+            if self.__dict__['_lazy_on_load'] is not None:
+                self.__dict__['_lazy_on_load'](module)
+        return module
+
+    def __getattr__(self, attr):
+        # Only called for attributes not copied yet, e.g. submodules that the module imports lazily itself.
+        return getattr(self._lazy_load(), attr)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '{}' (not loaded)>".format(self.__dict__['_lazy_name'])
+        return repr(self.__dict__['_lazy_module'])
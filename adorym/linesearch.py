@@ -1,4 +1,5 @@
 from typing import Callable, NamedTuple
+import time
 import adorym.wrappers as w
 import numpy as np
 
@@ -10,10 +11,40 @@ class LSState(NamedTuple):
     newx: object
     alpha: object
     step_count: object
-
-
-class BackTrackingLineSearch:
-    """Adapted from the backtracking line search in the manopt package"""
+    n_eval: int = 0
+    eval_time: float = 0.
+
+
+class LineSearchEvaluator:
+    """
+    Evaluates the objective along a fixed descent direction, and counts the evaluations and their wall time. Trial
+    step sizes of a search strictly decrease, so no step size is evaluated twice and nothing is kept between
+    calls; the caller holds only the updated variable of the current trial.
+    """
+    def __init__(self, objective_and_update: Callable, x0, descent_dir):
+        self.objective_and_update = objective_and_update
+        self.x0 = x0
+        self.descent_dir = descent_dir
+        self.n_eval = 0
+        self.eval_time = 0.
+
+    def __call__(self, alpha):
+        t0 = time.time()
+        res = self.objective_and_update(self.x0, alpha * self.descent_dir)
+        self.eval_time += time.time() - t0
+        self.n_eval += 1
+        return res
+
+
+class LineSearch:
+    """
+    Parent class of line searches. Trial step sizes are reduced until the Armijo condition is met. With
+    interpolation='cubic', the next trial is the minimizer of the quadratic (after the first trial) or cubic (after
+    later trials) that interpolates the loss and directional derivative at 0 and the losses at the last trials,
+    safeguarded to lie within [0.1, contraction_factor] times the last trial; with interpolation=None, trials are
+    reduced by contraction_factor. The instance keeps the accepted step size of the last search, so that reusing
+    it for the next search warm-starts the search.
+    """
     def __init__(self, contraction_factor: float = 0.5,
                  optimism: float = 3.,
                  suff_decr: float = 1e-4,
@@ -21,14 +52,16 @@ class BackTrackingLineSearch:
                  stepsize_threshold_low: float = 1e-10,
                  dtype: np.dtype = np.float32,
                  maxiter: int = None,
-                 name='backtracking_linesearch',
-                 normalize_alpha=True) -> None:
+                 name='linesearch',
+                 normalize_alpha=True,
+                 interpolation='cubic') -> None:
         self.contraction_factor = contraction_factor
         self.optimism = optimism
         self.suff_decr = suff_decr
         self.initial_stepsize = initial_stepsize
         self.stepsize_threshold_low = stepsize_threshold_low
         self.normalize_alpha = normalize_alpha
+        self.interpolation = interpolation
 
         self._dtype = dtype
         self._machine_eps = np.finfo(dtype).eps
@@ -41,6 +74,93 @@ class BackTrackingLineSearch:
             maxiter = np.inf
         self.maxiter = np.minimum(maxiter, machine_maxiter).astype('int32')
 
+        # Accumulated over all searches.
+        self.n_search = 0
+        self.n_eval_total = 0
+        self.eval_time_total = 0.
+
+    def get_cold_start_stepsize(self, descent_norm):
+        if self.normalize_alpha:
+            return self.initial_stepsize / descent_norm
+        return self.initial_stepsize
+
+    def get_next_trial_stepsize(self, f0, df0, alpha, f_alpha, alpha_prev=None, f_alpha_prev=None):
+        alpha_contracted = self.contraction_factor * alpha
+        if self.interpolation is None:
+            return alpha_contracted
+        f0, df0, alpha, f_alpha = float(f0), float(df0), float(alpha), float(f_alpha)
+        with np.errstate(all='ignore'):
+            if alpha_prev is None or self.interpolation == 'quadratic':
+                alpha_new = -df0 * alpha ** 2 / (2 * (f_alpha - f0 - df0 * alpha))
+            else:
+                alpha_prev, f_alpha_prev = float(alpha_prev), float(f_alpha_prev)
+                d1 = f_alpha - f0 - df0 * alpha
+                d2 = f_alpha_prev - f0 - df0 * alpha_prev
+                denom = alpha_prev ** 2 * alpha ** 2 * (alpha - alpha_prev)
+                a = (alpha_prev ** 2 * d1 - alpha ** 2 * d2) / denom
+                b = (-alpha_prev ** 3 * d1 + alpha ** 3 * d2) / denom
+                if a == 0:
+                    alpha_new = -df0 / (2 * b)
+                else:
+                    alpha_new = (-b + np.sqrt(b ** 2 - 3 * a * df0)) / (3 * a)
+        if not np.isfinite(alpha_new):
+            return alpha_contracted
+        return float(np.clip(alpha_new, 0.1 * alpha, alpha_contracted))
+
+    def backtrack(self, evaluator: LineSearchEvaluator, f0, df0, alpha):
+
+        # Make the chosen step and compute the cost there
+        newf, newx = evaluator(alpha)
+        step_count = 1
+
+        # Backtrack while the Armijo criterion is not satisfied
+        def _cond(state: LSState):
+            cond1 = state.newf > f0 + self.suff_decr * state.alpha * df0
+            cond2 = state.step_count <= self.maxiter
+            cond3 = state.alpha > self.stepsize_threshold_low
+            return cond1 and cond2 and cond3
+
+        lsstate_new = LSState(newf=newf, newx=newx, alpha=alpha, step_count=step_count)
+        alpha_prev = f_alpha_prev = None
+        while _cond(lsstate_new):
+            alpha = self.get_next_trial_stepsize(f0, df0, lsstate_new.alpha, lsstate_new.newf,
+                                                 alpha_prev, f_alpha_prev)
+            alpha_prev, f_alpha_prev = lsstate_new.alpha, lsstate_new.newf
+            step_count = lsstate_new.step_count + 1
+            # Release the rejected trial before evaluating the next one.
+            lsstate_new = newx = None
+            newf, newx = evaluator(alpha)
+            lsstate_new = LSState(newf=newf,
+                                  newx=newx,
+                                  alpha=alpha,
+                                  step_count=step_count)
+        return lsstate_new
+
+    def finalize_state(self, lsstate, evaluator: LineSearchEvaluator):
+        self.n_search += 1
+        self.n_eval_total += evaluator.n_eval
+        self.eval_time_total += evaluator.eval_time
+        return lsstate._replace(n_eval=evaluator.n_eval, eval_time=evaluator.eval_time)
+
+
+class BackTrackingLineSearch(LineSearch):
+    """Adapted from the backtracking line search in the manopt package"""
+    def __init__(self, contraction_factor: float = 0.5,
+                 optimism: float = 3.,
+                 suff_decr: float = 1e-4,
+                 initial_stepsize: float = 10.0,
+                 stepsize_threshold_low: float = 1e-10,
+                 dtype: np.dtype = np.float32,
+                 maxiter: int = None,
+                 name='backtracking_linesearch',
+                 normalize_alpha=True,
+                 interpolation='cubic') -> None:
+        super(BackTrackingLineSearch, self).__init__(contraction_factor=contraction_factor, optimism=optimism,
+                                                     suff_decr=suff_decr, initial_stepsize=initial_stepsize,
+                                                     stepsize_threshold_low=stepsize_threshold_low, dtype=dtype,
+                                                     maxiter=maxiter, name=name, normalize_alpha=normalize_alpha,
+                                                     interpolation=interpolation)
+
         self._oldf0 = -np.inf
         self._alpha = 0.
 
@@ -49,8 +169,9 @@ class BackTrackingLineSearch:
     def search(self, objective_and_update: Callable,
                x0, descent_dir, gradient, f0=None):
 
+        evaluator = LineSearchEvaluator(objective_and_update, x0, descent_dir)
         if f0 is None:
-            f0, _ = objective_and_update(x0, w.zeros_like(x0))
+            f0, _ = evaluator(0.)
 
         # Calculating the directional derivative along the descent direction
         descent_norm = w.vec_norm(descent_dir)
@@ -63,35 +184,11 @@ class BackTrackingLineSearch:
             # Look a little further
             alpha *= self.optimism
             if alpha * descent_norm < self._machine_eps:
-                if self.normalize_alpha:
-                    alpha = self.initial_stepsize / descent_norm
-                else:
-                    alpha = self.initial_stepsize
+                alpha = self.get_cold_start_stepsize(descent_norm)
         else:
-            if self.normalize_alpha:
-                alpha = self.initial_stepsize / descent_norm
-            else:
-                alpha = self.initial_stepsize
+            alpha = self.get_cold_start_stepsize(descent_norm)
 
-        # Make the chosen sten and compute the cost there
-        newf, newx = objective_and_update(x0, alpha * descent_dir)
-        step_count = 1
-
-        # Backtrack while the Armijo criterion is not satisfied
-        def _cond(state: LSState):
-            cond1 = state.newf > f0 + self.suff_decr * state.alpha * df0
-            cond2 = state.step_count <= self.maxiter
-            cond3 = state.alpha > self.stepsize_threshold_low
-            return cond1 and cond2 and cond3
-
-        lsstate_new = LSState(newf=newf, newx=newx, alpha=alpha, step_count=step_count)
-        while _cond(lsstate_new):
-            alpha = self.contraction_factor * lsstate_new.alpha
-            newf, newx = objective_and_update(x0, alpha * descent_dir)
-            lsstate_new = LSState(newf=newf,
-                          newx=newx,
-                          alpha=alpha,
-                          step_count=lsstate_new.step_count + 1)
+        lsstate_new = self.backtrack(evaluator, f0, df0, alpha)
 
         self._oldf0 = f0
         self._alpha = lsstate_new.alpha
@@ -100,10 +197,10 @@ class BackTrackingLineSearch:
         else:
             lsstate_updated = LSState(newf=f0, newx=x0, alpha=0., step_count=lsstate_new.step_count)
 
-        return lsstate_updated
+        return self.finalize_state(lsstate_updated, evaluator)
 
 
-class AdaptiveLineSearch:
+class AdaptiveLineSearch(LineSearch):
     """Adapted from the backtracking line search in the manopt package"""
     def __init__(self, contraction_factor: float = 0.5,
                  optimism: float = 2.,
@@ -113,24 +210,13 @@ class AdaptiveLineSearch:
                  dtype: np.dtype = np.float32,
                  maxiter: int = None,
                  name='backtracking_linesearch',
-                 normalize_alpha=True) -> None:
-        self.contraction_factor = contraction_factor
-        self.optimism = optimism
-        self.suff_decr = suff_decr
-        self.initial_stepsize = initial_stepsize
-        self.stepsize_threshold_low = stepsize_threshold_low
-        self.normalize_alpha=normalize_alpha
-
-        self._dtype = dtype
-        self._machine_eps = np.finfo(dtype).eps
-
-        self._name = name
-
-        machine_maxiter = np.ceil(np.log(self._machine_eps) / np.log(self.contraction_factor))
-
-        if maxiter is None:
-            maxiter = np.inf
-        self.maxiter = np.minimum(maxiter, machine_maxiter).astype('int32')
+                 normalize_alpha=True,
+                 interpolation='cubic') -> None:
+        super(AdaptiveLineSearch, self).__init__(contraction_factor=contraction_factor, optimism=optimism,
+                                                 suff_decr=suff_decr, initial_stepsize=initial_stepsize,
+                                                 stepsize_threshold_low=stepsize_threshold_low, dtype=dtype,
+                                                 maxiter=maxiter, name=name, normalize_alpha=normalize_alpha,
+                                                 interpolation=interpolation)
 
         self._alpha = 0
         self._alpha_suggested = 0
@@ -141,8 +227,9 @@ class AdaptiveLineSearch:
     def search(self, objective_and_update: Callable,
                x0, descent_dir, gradient, f0=None):
 
+        evaluator = LineSearchEvaluator(objective_and_update, x0, descent_dir)
         if f0 is None:
-            f0, _ = objective_and_update(x0, w.zeros_like(x0))
+            f0, _ = evaluator(0.)
 
         # Calculating the directional derivative along the descent direction
         descent_norm = w.vec_norm(descent_dir)
@@ -151,30 +238,9 @@ class AdaptiveLineSearch:
         if self._alpha_suggested > 0:
             alpha = self._alpha_suggested
         else:
-            if self.normalize_alpha:
-                alpha = self.initial_stepsize / descent_norm
-            else:
-                alpha = self.initial_stepsize
-
-        # Make the chosen sten and compute the cost there
-        newf, newx = objective_and_update(x0, alpha * descent_dir)
-        step_count = 1
+            alpha = self.get_cold_start_stepsize(descent_norm)
 
-        # Backtrack while the Armijo criterion is not satisfied
-        def _cond(state: LSState):
-            cond1 = state.newf > f0 + self.suff_decr * state.alpha * df0
-            cond2 = (state.step_count <= self.maxiter)
-            cond3 = state.alpha > self.stepsize_threshold_low
-            return cond1 and cond2 and cond3
-
-        lsstate_new = LSState(newf=newf, newx=newx, alpha=alpha, step_count=step_count)
-        while _cond(lsstate_new):
-            alpha = self.contraction_factor * lsstate_new.alpha
-            newf, newx = objective_and_update(x0, alpha * descent_dir)
-            lsstate_new = LSState(newf=newf,
-                            newx=newx,
-                            alpha=alpha,
-                            step_count=lsstate_new.step_count + 1)
+        lsstate_new = self.backtrack(evaluator, f0, df0, alpha)
 
         # New suggestion for step size
         if lsstate_new.step_count - 1 == 0:
@@ -197,4 +263,4 @@ class AdaptiveLineSearch:
             print('Line search is unable to find a smaller loss ({} > {})!'.format(lsstate_new.newf, f0))
             lsstate_updated = LSState(newf=f0, newx=x0, alpha=0., step_count=lsstate_new.step_count)
 
-        return lsstate_updated
+        return self.finalize_state(lsstate_updated, evaluator)
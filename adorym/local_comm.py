@@ -0,0 +1,458 @@
+"""
+Shared-memory communicator for running Adorym with several processes on a single machine without MPI.
+
+Processes are started by the ``adorym-run`` launcher::
+
+    adorym-run -n <num_procs> python_script.py [script arguments]
+
+The launcher starts a small broker process that holds one inbox queue per rank and a barrier, then runs the script
+once per rank with the broker address in the environment. ``adorym.pseudo`` picks this up at import time and
+returns a ``LocalComm`` as ``MPI.COMM_WORLD``, so the rest of Adorym uses it just like an mpi4py communicator.
+Control messages go through the broker; NumPy arrays above ``SHM_THRESHOLD`` bytes are moved through
+``multiprocessing.shared_memory`` blocks and never pass through the broker.
+
+Only the subset of the mpi4py interface that Adorym uses is implemented. HDF5 files opened with the ``mpio`` driver
+need a real MPI communicator, so ``distribution_mode='shared_file'`` is not available with this communicator.
+"""
+import os
+import sys
+import time
+import uuid
+import glob
+import pickle
+import queue
+import signal
+import argparse
+import threading
+import subprocess
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.managers import BaseManager, BarrierProxy
+
+import numpy as np
+
+ENV_RANK = 'ADORYM_LOCAL_RANK'
+ENV_SIZE = 'ADORYM_LOCAL_SIZE'
+ENV_ADDRESS = 'ADORYM_LOCAL_ADDRESS'
+ENV_AUTHKEY = 'ADORYM_LOCAL_AUTHKEY'
+ENV_JOB = 'ADORYM_LOCAL_JOB'
+
+# Contiguous buffers at least this large are passed through shared memory instead of the broker.
+SHM_THRESHOLD = 1 << 16
+
+_TAG_BCAST = -1
+_TAG_REDUCE = -2
+_TAG_ALLTOALL = -3
+_TAG_GATHER = -4
+
+# The track argument of SharedMemory was added in Python 3.13.
+_shm_has_track_arg = sys.version_info >= (3, 13)
+
+
+def _open_shm(name, create=False, size=0):
+    """
+    Create or attach a shared memory block without registering it with the resource tracker of this process.
+    Blocks are passed between processes and unlinked explicitly by whichever process consumes them last, so the
+    tracker must not unlink them when the process that happened to open them exits.
+    """
+    if _shm_has_track_arg:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _unlink_shm(shm):
+    if not _shm_has_track_arg:
+        # unlink() unregisters the block from the tracker, so it must be registered again first.
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _read_shm(shm, nbytes):
+    mv = shm.buf[:nbytes]
+    b = bytearray(mv)
+    mv.release()
+    return b
+
+
+class _Request(object):
+    """
+    Completed request returned by LocalComm.isend. Sends are buffered by the broker and never block.
+    """
+    def Test(self):
+        return True
+
+    def Wait(self):
+        return None
+
+
+class _ClientManager(BaseManager):
+    pass
+
+_ClientManager.register('get_inbox')
+_ClientManager.register('get_barrier', proxytype=BarrierProxy)
+
+
+class _Channel(object):
+    """
+    Connection of this process to the broker, shared by all communicators created in the process. Messages for all
+    communicators arrive in the same inbox, so unmatched messages are kept here rather than in a communicator.
+    """
+    def __init__(self, global_rank, global_size, address, authkey, job_id):
+        self.global_rank = global_rank
+        self.job_id = job_id
+        self.manager = _ClientManager(address=address, authkey=authkey)
+        self.manager.connect()
+        self.inbox_ls = [self.manager.get_inbox(i) for i in range(global_size)]
+        self.stash = []
+        self.i_block = 0
+
+    def post(self, dest, msg):
+        self.inbox_ls[dest].put(msg)
+
+    def fetch(self, source, tag):
+        for i, msg in enumerate(self.stash):
+            if msg[0] == source and msg[1] == tag:
+                del self.stash[i]
+                return msg
+        while True:
+            msg = self.inbox_ls[self.global_rank].get()
+            if msg[0] == source and msg[1] == tag:
+                return msg
+            self.stash.append(msg)
+
+    def new_block_name(self):
+        self.i_block += 1
+        return '{}_{}_{}'.format(self.job_id, self.global_rank, self.i_block)
+
+
+class LocalComm(object):
+    """
+    Communicator for processes started by ``adorym-run`` on the same machine.
+
+    :param channel: _Channel of this process.
+    :param members: List of global ranks in this communicator, ordered by their rank in it.
+    :param context: String identifying this communicator. Messages, barriers and shared memory blocks of different
+                    communicators are kept apart by it.
+    """
+    def __init__(self, channel, members, context='w'):
+        self.channel = channel
+        self.members = list(members)
+        self.context = context
+        self.rank = self.members.index(channel.global_rank)
+        self.size = len(self.members)
+        self.barrier = channel.manager.get_barrier(context, self.size)
+        self.i_collective = 0
+        self.i_split = 0
+
+    @classmethod
+    def from_environ(cls):
+        host, port = os.environ[ENV_ADDRESS].rsplit(':', 1)
+        size = int(os.environ[ENV_SIZE])
+        channel = _Channel(int(os.environ[ENV_RANK]), size, (host, int(port)),
+                           bytes.fromhex(os.environ[ENV_AUTHKEY]), os.environ[ENV_JOB])
+        return cls(channel, range(size))
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def Barrier(self):
+        if self.size > 1:
+            self.barrier.wait()
+
+    def Split(self, color=0, key=0):
+        """
+        Create sub-communicators of ranks with the same color, ordered by key. Collective over this communicator.
+        """
+        color_key_ls = self.allgather((color, key))
+        members = [i for i in range(self.size) if color_key_ls[i][0] == color]
+        members.sort(key=lambda i: (color_key_ls[i][1], i))
+        context = '{}s{}c{}'.format(self.context, self.i_split, color)
+        self.i_split += 1
+        return LocalComm(self.channel, [self.members[i] for i in members], context=context)
+
+    # ================================================================================
+    # Point-to-point messages. Objects are pickled with protocol 5, and large out-of-band
+    # buffers (i.e. NumPy arrays) are written to shared memory blocks named in the message.
+    # ================================================================================
+    def _dumps(self, a):
+        block_ls = []
+        def buffer_callback(buf):
+            raw = buf.raw()
+            if raw.nbytes < SHM_THRESHOLD:
+                return True
+            name = self.channel.new_block_name()
+            shm = _open_shm(name, create=True, size=raw.nbytes)
+            shm.buf[:raw.nbytes] = raw
+            shm.close()
+            block_ls.append((name, raw.nbytes))
+            return False
+        data = pickle.dumps(a, protocol=5, buffer_callback=buffer_callback)
+        return data, block_ls
+
+    def _loads(self, data, block_ls, unlink):
+        buffers = []
+        for name, nbytes in block_ls:
+            shm = _open_shm(name)
+            buffers.append(_read_shm(shm, nbytes))
+            shm.close()
+            if unlink:
+                _unlink_shm(shm)
+        return pickle.loads(data, buffers=buffers)
+
+    def _post(self, dest, tag, data, block_ls, unlink=True):
+        self.channel.post(self.members[dest], ((self.context, self.rank), tag, data, block_ls, unlink))
+
+    def _fetch(self, source, tag):
+        return self.channel.fetch((self.context, source), tag)
+
+    def send(self, a, dest, tag=0):
+        data, block_ls = self._dumps(a)
+        self._post(dest, tag, data, block_ls)
+
+    def isend(self, a, dest, tag=0):
+        self.send(a, dest, tag=tag)
+        return _Request()
+
+    def recv(self, buf=None, source=0, tag=0):
+        _, _, data, block_ls, unlink = self._fetch(source, tag)
+        return self._loads(data, block_ls, unlink)
+
+    # ================================================================================
+    # Collectives.
+    # ================================================================================
+    def bcast(self, a, root=0):
+        if self.size == 1:
+            return a
+        if self.rank == root:
+            data, block_ls = self._dumps(a)
+            for i in range(self.size):
+                if i != root:
+                    self._post(i, _TAG_BCAST, data, block_ls, unlink=False)
+        else:
+            _, _, data, block_ls, _ = self._fetch(root, _TAG_BCAST)
+            a = self._loads(data, block_ls, unlink=False)
+        if len(block_ls) > 0:
+            # Shared blocks are read by all ranks, so the root unlinks them after everyone is done.
+            self.Barrier()
+            if self.rank == root:
+                for name, _ in block_ls:
+                    _unlink_shm(_open_shm(name))
+        return a
+
+    def Bcast(self, a, root=0):
+        if self.size == 1:
+            return a
+        if a.nbytes < SHM_THRESHOLD:
+            a[...] = self.bcast(a, root=root)
+            return a
+        name = self._collective_block_name(root)
+        if self.rank == root:
+            shm = _open_shm(name, create=True, size=a.nbytes)
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            self.Barrier()
+        else:
+            self.Barrier()
+            shm = _open_shm(name)
+            a[...] = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+        self.Barrier()
+        shm.close()
+        if self.rank == root:
+            _unlink_shm(shm)
+        self.i_collective += 1
+        return a
+
+    def allreduce(self, a, op=None):
+        """
+        :param op: Binary reduction function. Default is summation. mpi4py's MPI.SUM, MPI.MAX etc. are callables
+                   with the same signature and can also be used.
+        """
+        if self.size == 1:
+            return a
+        if op is None and isinstance(a, np.ndarray) and a.nbytes >= SHM_THRESHOLD:
+            return self._allreduce_array(a)
+        if op is None:
+            op = lambda x, y: x + y
+        if self.rank == 0:
+            for i in range(1, self.size):
+                a = op(a, self.recv(source=i, tag=_TAG_REDUCE))
+        else:
+            self.send(a, 0, tag=_TAG_REDUCE)
+        return self.bcast(a, root=0)
+
+    def allgather(self, a):
+        if self.rank == 0:
+            a_ls = [a] + [self.recv(source=i, tag=_TAG_GATHER) for i in range(1, self.size)]
+        else:
+            self.send(a, 0, tag=_TAG_GATHER)
+            a_ls = None
+        return self.bcast(a_ls, root=0)
+
+    def Allreduce(self, sendbuf, recvbuf=None, op=None):
+        """
+        Buffer version of allreduce. If recvbuf is None, the result is written back into sendbuf.
+        """
+        if recvbuf is None:
+            recvbuf = sendbuf
+        recvbuf[...] = self.allreduce(sendbuf, op=op)
+        return recvbuf
+
+    def alltoall(self, a):
+        if self.size == 1:
+            return a
+        for i in range(self.size):
+            if i != self.rank:
+                self.send(a[i], i, tag=_TAG_ALLTOALL)
+        return [a[i] if i == self.rank else self.recv(source=i, tag=_TAG_ALLTOALL) for i in range(self.size)]
+
+    def _collective_block_name(self, i_owner):
+        # All ranks call collectives in the same order, so the counter is consistent among ranks and
+        # block names can be computed locally without an extra exchange.
+        return '{}_{}_c{}_{}'.format(self.channel.job_id, self.context, self.i_collective, i_owner)
+
+    def _allreduce_array(self, a):
+        """
+        Sum arrays in shared memory. Every rank writes its contribution to its own block, then reduces
+        1 / n_ranks of the elements over all blocks in place, and finally gathers the reduced segments.
+        """
+        a = np.ascontiguousarray(a)
+        shape, dtype = a.shape, a.dtype
+        a = a.reshape(-1)
+        shm = _open_shm(self._collective_block_name(self.rank), create=True, size=a.nbytes)
+        this_block = np.ndarray(a.shape, dtype=dtype, buffer=shm.buf)
+        this_block[...] = a
+        self.Barrier()
+        seg_bounds = np.linspace(0, a.size, self.size + 1).astype(int)
+        shm_ls = [shm if i == self.rank else _open_shm(self._collective_block_name(i)) for i in range(self.size)]
+        block_ls = [np.ndarray(a.shape, dtype=dtype, buffer=s.buf) for s in shm_ls]
+        st, end = seg_bounds[self.rank], seg_bounds[self.rank + 1]
+        for i in range(self.size):
+            if i != self.rank:
+                this_block[st:end] += block_ls[i][st:end]
+        self.Barrier()
+        res = np.empty_like(a)
+        for i in range(self.size):
+            res[seg_bounds[i]:seg_bounds[i + 1]] = block_ls[i][seg_bounds[i]:seg_bounds[i + 1]]
+        del this_block, block_ls
+        self.Barrier()
+        for s in shm_ls:
+            s.close()
+        _unlink_shm(shm)
+        self.i_collective += 1
+        return res.reshape(shape)
+
+
+# ================================================================================
+# Launcher.
+# ================================================================================
+_inbox_dict = {}
+_barrier_dict = {}
+_broker_lock = threading.Lock()
+
+
+def _get_inbox(i):
+    with _broker_lock:
+        if i not in _inbox_dict:
+            _inbox_dict[i] = queue.Queue()
+        return _inbox_dict[i]
+
+
+def _get_barrier(context, n):
+    with _broker_lock:
+        if context not in _barrier_dict:
+            _barrier_dict[context] = threading.Barrier(n)
+        return _barrier_dict[context]
+
+
+class _BrokerManager(BaseManager):
+    pass
+
+_BrokerManager.register('get_inbox', callable=_get_inbox)
+_BrokerManager.register('get_barrier', callable=_get_barrier, proxytype=BarrierProxy)
+
+# Executed by each worker. mpi4py is hidden so that Adorym always falls back to adorym.pseudo, which returns
+# a LocalComm when the launcher variables are present.
+_BOOTSTRAP = "import sys, runpy; sys.modules['mpi4py'] = None; sys.argv = sys.argv[1:]; " \
+             "runpy.run_path(sys.argv[0], run_name='__main__')"
+
+
+def launch(script, args=(), n_ranks=1, threads_per_rank=None):
+    """
+    Run a Python script with n_ranks local processes connected by LocalComm.
+
+    :param script: Path to the script.
+    :param args: Command line arguments passed to the script.
+    :param n_ranks: Number of processes.
+    :param threads_per_rank: Value of OMP_NUM_THREADS/MKL_NUM_THREADS for each process. If None, the cores are
+                             divided evenly among ranks unless OMP_NUM_THREADS is already set.
+    :return: Exit code. If any rank fails, the others are terminated and its exit code is returned.
+    """
+    authkey = os.urandom(16)
+    broker = _BrokerManager(address=('127.0.0.1', 0), authkey=authkey)
+    broker.start(initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    job_id = 'adorym_{}'.format(uuid.uuid4().hex[:8])
+    env = os.environ.copy()
+    env[ENV_SIZE] = str(n_ranks)
+    env[ENV_ADDRESS] = '{}:{}'.format(*broker.address)
+    env[ENV_AUTHKEY] = authkey.hex()
+    env[ENV_JOB] = job_id
+    if threads_per_rank is None and 'OMP_NUM_THREADS' not in env:
+        threads_per_rank = max(1, (os.cpu_count() or 1) // n_ranks)
+    if threads_per_rank is not None:
+        for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            env[k] = str(threads_per_rank)
+
+    proc_ls = []
+    for i in range(n_ranks):
+        env[ENV_RANK] = str(i)
+        proc_ls.append(subprocess.Popen([sys.executable, '-c', _BOOTSTRAP, script] + list(args), env=env.copy()))
+    ret = 0
+    try:
+        while any(p.poll() is None for p in proc_ls):
+            failed = [p.returncode for p in proc_ls if p.returncode not in (None, 0)]
+            if len(failed) > 0:
+                ret = failed[0]
+                break
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        ret = 130
+    finally:
+        for p in proc_ls:
+            if p.poll() is None:
+                p.terminate()
+        for p in proc_ls:
+            p.wait()
+        broker.shutdown()
+        # Remove blocks left behind by ranks that did not exit normally.
+        for f in glob.glob(os.path.join('/dev/shm', job_id + '*')):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+    if ret == 0:
+        failed = [p.returncode for p in proc_ls if p.returncode != 0]
+        ret = failed[0] if len(failed) > 0 else 0
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='adorym-run',
+                                     description='Run an Adorym script with multiple local processes without MPI.')
+    parser.add_argument('-n', '--np', type=int, default=1, dest='n_ranks', help='Number of processes.')
+    parser.add_argument('-t', '--threads-per-rank', type=int, default=None,
+                        help='Threads per process. Default is the number of cores divided by the number of processes.')
+    parser.add_argument('script', help='Python script to run.')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments passed to the script.')
+    a = parser.parse_args(argv)
+    script = a.script
+    # Allow "adorym-run -n 4 python script.py" in the same form as mpirun.
+    if os.path.basename(script).startswith('python') and len(a.args) > 0:
+        script = a.args.pop(0)
+    sys.exit(launch(script, a.args, n_ranks=a.n_ranks, threads_per_rank=a.threads_per_rank))
+
+
+if __name__ == '__main__':
+    main()
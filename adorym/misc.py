@@ -1,16 +1,38 @@
 import os
 import numpy as np
 import glob
-import dxchange
 import re
 import sys
+import time
 import datetime
+import pickle
+import threading
+import collections
+import copy
+import json
+import zlib
+import h5py
 import adorym.global_settings as global_settings
+import adorym.wrappers as w
+from adorym.timing import timers, timer
+from adorym.lazy import LazyModule
+
+dxchange = LazyModule('dxchange')
+
+_project_config_dict = {}
 
 def check_config_indept_mpi():
+    # Every module calls this when imported; the file is read only once per working directory, since reading it
+    # from every rank is slow on shared file systems.
+    fname = os.path.join(os.getcwd(), 'project_config.txt')
+    if fname not in _project_config_dict.keys():
+        _project_config_dict[fname] = _read_project_config(fname)
+    return dict(_project_config_dict[fname])
+
+def _read_project_config(fname):
     d = {}
     try:
-        f = open(os.path.join(os.getcwd(), 'project_config.txt'), 'r')
+        f = open(fname, 'r')
         for l in f.readlines():
             if '\n' in l:
                 l = l[:l.find('\n')]
@@ -146,6 +168,185 @@ def create_directory_multirank(path):
     return
 
 
+class SyncCounter(object):
+    """
+    Wrapper of an MPI communicator that records how long the current rank stays blocked in each synchronization
+    point of the reconstruction loop. Every call takes a label naming the call site, and the wait times are
+    accumulated per label until report() is called (usually at the end of an epoch).
+
+    :param comm: MPI communicator (or adorym.pseudo.Comm).
+    """
+    def __init__(self, comm):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.n_ranks = comm.Get_size()
+        self.t_dict = {}
+        self.n_dict = {}
+        self.pending_requests = []
+
+    def _record(self, label, t0):
+        dt = time.time() - t0
+        self.t_dict[label] = self.t_dict.get(label, 0.) + dt
+        self.n_dict[label] = self.n_dict.get(label, 0) + 1
+        timers.record('sync/' + label, label, t0, dt)
+
+    def Barrier(self, label='barrier'):
+        t0 = time.time()
+        self.comm.Barrier()
+        self._record(label, t0)
+
+    def bcast(self, a, label='bcast', root=0):
+        t0 = time.time()
+        a = self.comm.bcast(a, root=root)
+        self._record(label, t0)
+        return a
+
+    def Bcast(self, a, label='Bcast', root=0):
+        t0 = time.time()
+        self.comm.Bcast(a, root=root)
+        self._record(label, t0)
+        return a
+
+    def allreduce(self, a, label='allreduce', comm=None):
+        """
+        :param comm: Communicator to reduce over instead of the wrapped one (e.g., a sub-communicator).
+        """
+        t0 = time.time()
+        a = (self.comm if comm is None else comm).allreduce(a)
+        self._record(label, t0)
+        return a
+
+    def allgather(self, a, label='allgather', comm=None):
+        t0 = time.time()
+        a = (self.comm if comm is None else comm).allgather(a)
+        self._record(label, t0)
+        return a
+
+    def alltoall(self, a, label='alltoall', comm=None):
+        t0 = time.time()
+        a = (self.comm if comm is None else comm).alltoall(a)
+        self._record(label, t0)
+        return a
+
+    def wait_on_root(self, label='wait_on_root', root=0, tag=77):
+        """
+        Point-to-point replacement of a Barrier for cases where only the root rank needs to know that all other
+        ranks have reached this point (e.g. before rank 0 reads the whole shared HDF5 object). Non-root ranks
+        post a non-blocking notice and move on; only the root rank blocks.
+        """
+        if self.n_ranks == 1:
+            return
+        t0 = time.time()
+        if self.rank == root:
+            for i_rank in range(self.n_ranks):
+                if i_rank != root:
+                    self.comm.recv(source=i_rank, tag=tag)
+        else:
+            # Completed notices from earlier calls are released here.
+            self.pending_requests = [req for req in self.pending_requests if not req.Test()]
+            self.pending_requests.append(self.comm.isend(True, dest=root, tag=tag))
+        self._record(label, t0)
+
+    def report(self, i_epoch, save_folder=None, reset=True, **stdout_options):
+        """
+        Print the accumulated wait times of this rank, and append them to
+        [save_folder]/convergence/sync_wait_rank_[rank].txt if save_folder is given.
+        """
+        labels = sorted(self.t_dict.keys(), key=lambda k: -self.t_dict[k])
+        t_tot = sum(self.t_dict.values())
+        s = 'Epoch {} (rank {}) sync wait: {:.3f} s total'.format(i_epoch, self.rank, t_tot)
+        for k in labels:
+            s += '; {}: {:.3f} s/{}'.format(k, self.t_dict[k], self.n_dict[k])
+        print_flush(s, self.rank, self.rank, **stdout_options)
+        if save_folder is not None:
+            fname = os.path.join(save_folder, 'convergence', 'sync_wait_rank_{}.txt'.format(self.rank))
+            write_header = not os.path.exists(fname)
+            f = open(fname, 'a')
+            if write_header:
+                f.write('i_epoch,label,n_calls,time\n')
+            for k in labels:
+                f.write('{},{},{},{}\n'.format(i_epoch, k, self.n_dict[k], self.t_dict[k]))
+            f.close()
+        if reset:
+            self.t_dict = {}
+            self.n_dict = {}
+
+
+class ConvergenceMonitor(object):
+    """
+    Decides when to stop the epoch loop. The losses of all minibatches of an epoch are averaged over all ranks,
+    and the epoch losses are smoothed with an exponential moving average. If n_epochs is 'auto', the loop stops when
+    the relative decrease of the smoothed loss over the last epoch falls below crit_conv_rate, or when max_nepochs
+    epochs are done; otherwise, it stops after n_epochs epochs.
+
+    :param sync: adorym.SyncCounter used to reduce the losses over ranks.
+    :param n_epochs: Int or 'auto'.
+    :param crit_conv_rate: Float. Relative decrease of the smoothed loss below which the loop stops.
+    :param max_nepochs: Int. Maximum number of epochs if n_epochs is 'auto'.
+    :param smoothing: Float. Weight of the previous smoothed loss in the moving average. Use 0 to disable smoothing.
+    """
+    def __init__(self, sync, n_epochs='auto', crit_conv_rate=0.03, max_nepochs=200, smoothing=0.5):
+        self.sync = sync
+        self.n_epochs = n_epochs
+        self.crit_conv_rate = crit_conv_rate
+        self.max_nepochs = max_nepochs
+        self.smoothing = smoothing
+        self.loss_sum = 0.
+        self.loss_count = 0
+        self.smoothed_loss = None
+        self.conv_rate = None
+
+    def add_loss(self, loss):
+        try:
+            loss = float(loss)
+        except (TypeError, ValueError):
+            return
+        if np.isfinite(loss):
+            self.loss_sum += loss
+            self.loss_count += 1
+
+    def end_epoch(self, i_epoch, save_folder=None, **stdout_options):
+        """
+        Reduce the losses of the epoch over ranks and update the convergence rate. Must be called by all ranks.
+        :return: True if the loop should continue.
+        """
+        loss_sum, loss_count = self.sync.allreduce(np.array([self.loss_sum, self.loss_count], dtype='float64'),
+                                                   'convergence_allreduce')
+        self.loss_sum = 0.
+        self.loss_count = 0
+        epoch_loss = loss_sum / loss_count if loss_count > 0 else np.nan
+        if self.smoothing > 0 and self.smoothed_loss is not None and np.isfinite(self.smoothed_loss):
+            smoothed_loss = self.smoothing * self.smoothed_loss + (1 - self.smoothing) * epoch_loss
+        else:
+            smoothed_loss = epoch_loss
+        if self.smoothed_loss is not None and self.smoothed_loss > 0:
+            self.conv_rate = (self.smoothed_loss - smoothed_loss) / self.smoothed_loss
+        self.smoothed_loss = smoothed_loss
+
+        if self.n_epochs == 'auto':
+            cont = i_epoch < self.max_nepochs - 1
+            if not cont:
+                print_flush('Maximum number of epochs ({}) reached.'.format(self.max_nepochs), 0, self.sync.rank,
+                            **stdout_options)
+            elif self.conv_rate is not None and not self.conv_rate >= self.crit_conv_rate:
+                cont = False
+                print_flush('Converged: relative loss decrease {} is below {}.'.format(
+                    self.conv_rate, self.crit_conv_rate), 0, self.sync.rank, **stdout_options)
+        else:
+            cont = i_epoch < self.n_epochs - 1
+        print_flush('Epoch {} average loss = {}; smoothed loss = {}; relative decrease = {}.'.format(
+            i_epoch, epoch_loss, smoothed_loss, self.conv_rate), 0, self.sync.rank, **stdout_options)
+
+        if save_folder is not None and self.sync.rank == 0:
+            fname = os.path.join(save_folder, 'convergence', 'epoch_loss.txt')
+            write_header = not os.path.exists(fname)
+            f = open(fname, 'a')
+            if write_header:
+                f.write('i_epoch,loss,smoothed_loss,conv_rate\n')
+            f.write('{},{},{},{}\n'.format(i_epoch, epoch_loss, smoothed_loss, self.conv_rate))
+            f.close()
+        return cont
+
 def create_summary(save_path, locals_dict, var_list=None, preset=None, verbose=True):
 
     if preset == 'ptycho':
@@ -176,39 +377,517 @@ def create_summary(save_path, locals_dict, var_list=None, preset=None, verbose=T
     return
 
 
-def save_checkpoint(i_epoch, i_batch, output_folder, distribution_mode=None, obj_array=None, optimizer=None):
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread. save() copies the object, the optimizer state and the other
+    parameters into one of two reusable host buffers, and returns as soon as the copy is done; the files are then
+    written by a background thread while the reconstruction continues, so that the next snapshot can be taken into
+    the other buffer. At most one checkpoint is being written at a time: save() waits for the previous one to
+    finish before starting a new one. Each file is written under a temporary name and renamed when complete, and
+    the names of the data files carry the version of the checkpoint they belong to. The checkpoint is committed by
+    the record (checkpoint.json, or checkpoint_rank_[rank].json in distributed modes), which holds the epoch and
+    batch indices, the version, the names of the data files and the step counters of sparse updates; it is
+    renamed into place last, after which the data files no longer referenced by it are deleted. A crash therefore
+    leaves either the previous checkpoint or the new one, never a mix of both.
 
-    path = os.path.join(output_folder, 'checkpoint')
-    np.savetxt(os.path.join(path, 'checkpoint.txt'),
-               np.array([i_epoch, i_batch]), fmt='%d')
-    if distribution_mode is None:
-        np.save(os.path.join(path, 'obj_checkpoint.npy'), obj_array)
+    :param output_folder: String. Checkpoints are written to [output_folder]/checkpoint.
+    :param distribution_mode: None or 'distributed_object'. Determines the file names.
+    :param asynchronous: Bool. If False, save() writes the files before returning.
+    """
+    def __init__(self, output_folder, distribution_mode=None, asynchronous=True):
+        self.path = os.path.join(output_folder, 'checkpoint')
+        self.distribution_mode = distribution_mode
+        self.asynchronous = asynchronous
+        self.suffix = '' if distribution_mode is None else '_rank_{}'.format(rank)
+        self.buffer_ls = [{}, {}]
+        self.i_buffer = 0
+        self.thread = None
+        self.exception = None
+        self.compression = None
+        self.referenced_files = set()
+        # Versions continue from existing checkpoints (of either format) so that their files are not overwritten
+        # before the new record is written.
+        record = load_checkpoint_record(output_folder, distribution_mode)
+        manifest = load_checkpoint_manifest(output_folder, distribution_mode)
+        self.version = max(record['version'] if record is not None else 0,
+                           manifest.get('version', 0) if manifest is not None else 0)
+
+    def copy_to_buffer(self, buffer, key, arr_ls):
+        """
+        Copy a list of arrays into one stacked array of the buffer, reallocating it only if the shape changes.
+        """
+        arr_ls = [w.to_numpy(a) for a in arr_ls]
+        shape = (len(arr_ls), *arr_ls[0].shape)
+        if key not in buffer or buffer[key].shape != shape or buffer[key].dtype != arr_ls[0].dtype:
+            buffer[key] = np.empty(shape, dtype=arr_ls[0].dtype)
+        for i, a in enumerate(arr_ls):
+            np.copyto(buffer[key][i], a)
+        return buffer[key]
+
+    def save(self, i_epoch, i_batch, obj_array=None, optimizer=None, params=None):
+        """
+        :param obj_array: Array of the object (or the object slab of this rank in distributed_object mode).
+        :param optimizer: adorym.Optimizer of the object, whose state is saved.
+        :param params: Dict of the other optimizable parameters. Saved as [checkpoint]/params_[rank]_[version].
+        """
+        buffer = self.buffer_ls[self.i_buffer]
+        self.version += 1
+        v = self.version
+        file_dict = collections.OrderedDict()
+        if obj_array is not None:
+            file_dict['obj'] = ('obj_checkpoint{}_{}.npy'.format(self.suffix, v),
+                                self.copy_to_buffer(buffer, 'obj', [obj_array])[0])
+        if optimizer is not None and len(optimizer.params_list) > 0:
+            arr = self.copy_to_buffer(buffer, 'opt', optimizer.get_decoded_param_arrays())
+            file_dict['opt'] = ('opt_{}_params_checkpoint{}_{}.npy'.format(optimizer.name, self.suffix, v), arr)
+        if params is not None:
+            file_dict['params'] = ('params_{}_{}'.format(rank, v), pickle.dumps(params))
+        record = {'i_epoch': int(i_epoch), 'i_batch': int(i_batch), 'version': v,
+                  'files': {key: fname for key, (fname, _) in file_dict.items()}}
         if optimizer is not None:
-            optimizer.save_param_arrays_to_checkpoint()
-    elif distribution_mode == 'distributed_object':
+            record.update(optimizer.get_tile_counters())
+        file_ls = list(file_dict.values())
+        file_ls.append(('checkpoint{}.json'.format(self.suffix), record))
+        self.wait()
+        self.referenced_files = set(record['files'].values())
+        if self.asynchronous:
+            self.thread = threading.Thread(target=self.write_files, args=(file_ls,), daemon=True)
+            self.thread.start()
+            self.i_buffer = 1 - self.i_buffer
+        else:
+            self.write_files(file_ls)
+            self.raise_exception()
+
+    def write_files(self, file_ls):
+        try:
+            for fname, data in file_ls:
+                fname = os.path.join(self.path, fname)
+                # Ranks may write the same file (checkpoint{suffix}.json), so temporary names are made unique.
+                fname_tmp = '{}.{}.tmp'.format(fname, rank)
+                if fname.endswith('.h5'):
+                    # Dict of arrays written as compressed datasets.
+                    with h5py.File(fname_tmp, 'w') as f:
+                        for key, arr in data.items():
+                            f.create_dataset(key, data=arr, compression=self.compression)
+                    f = open(fname_tmp, 'rb+')
+                else:
+                    f = open(fname_tmp, 'wb')
+                    if fname.endswith('.npy'):
+                        np.save(f, data)
+                    elif fname.endswith('.json'):
+                        f.write(json.dumps(data).encode())
+                    else:
+                        f.write(data)
+                    f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                os.replace(fname_tmp, fname)
+            self.after_write()
+        except Exception as e:
+            self.exception = e
+
+    def after_write(self):
+        # Delete data files superseded by the record just written.
+        pattern = re.compile(r'(obj_checkpoint{0}|opt_.+_params_checkpoint{0})_\d+\.npy$|params_{1}_\d+$'.format(
+            self.suffix, rank))
+        for fname in os.listdir(self.path):
+            if pattern.match(fname) and fname not in self.referenced_files:
+                os.remove(os.path.join(self.path, fname))
+
+    def raise_exception(self):
+        if self.exception is not None:
+            e = self.exception
+            self.exception = None
+            raise e
+
+    def wait(self):
+        """
+        Block until the checkpoint being written (if any) is complete.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.raise_exception()
+
+
+
+class TiledCheckpointWriter(CheckpointWriter):
+    """
+    Writes checkpoints as a manifest and per-tile files, rewriting only the (y, x) tiles that changed since the
+    previous checkpoint. Each tile file holds the object and the optimizer state of one tile, compressed
+    losslessly through h5py, and its name carries the checkpoint version it was written in. The manifest
+    (manifest.json, or manifest_rank_[rank].json in distributed modes) records the epoch and batch indices, the
+    state of NumPy's RNG, the names of the stored arrays, the version of every tile, the step counters of sparse
+    updates and the name of the file of the other parameters; it is written last, after which tile and parameter
+    files no longer referenced by it are deleted. Restore with TiledCheckpointArray.
+
+    :param tile_size: Int. Edge length of the tiles in pixels.
+    :param compression: String. Compression filter of h5py ('lzf' or 'gzip').
+    """
+    def __init__(self, output_folder, distribution_mode=None, asynchronous=True, tile_size=64, compression='lzf'):
+        super(TiledCheckpointWriter, self).__init__(output_folder, distribution_mode=distribution_mode,
+                                                    asynchronous=asynchronous)
+        self.tile_size = tile_size
+        self.compression = compression
+        self.tile_version = None
+        self.tile_checksum = None
+        self.shape = None
+        self.names = None
+        manifest = load_checkpoint_manifest(output_folder, distribution_mode)
+        if manifest is not None and 'tile_version' in manifest:
+            self.version = max(self.version, int(np.max(manifest['tile_version'])))
+
+    def get_tile_slicer(self, i_ty, i_tx):
+        return (slice(i_ty * self.tile_size, (i_ty + 1) * self.tile_size),
+                slice(i_tx * self.tile_size, (i_tx + 1) * self.tile_size))
+
+    def get_tile_checksums(self, arr_ls):
+        checksum = np.zeros(self.tile_version.shape, dtype='int64')
+        for i_ty in range(checksum.shape[0]):
+            for i_tx in range(checksum.shape[1]):
+                sl = self.get_tile_slicer(i_ty, i_tx)
+                c = 1
+                for arr in arr_ls:
+                    c = zlib.adler32(np.ascontiguousarray(arr[sl]), c)
+                checksum[i_ty, i_tx] = c
+        return checksum
+
+    def save(self, i_epoch, i_batch, obj_array=None, optimizer=None, params=None, tile_mask=None):
+        """
+        :param tile_mask: Boolean array of shape [n_tiles_y, n_tiles_x] marking the tiles changed since the last
+                          checkpoint (e.g. the footprints of the minibatches). If None, changed tiles are found by
+                          comparing the checksums of the tiles.
+        """
+        file_ls = []
+        self.version += 1
         if obj_array is not None:
-            np.save(os.path.join(path, 'obj_checkpoint_rank_{}.npy'.format(rank)), obj_array)
+            arr_dict = {'obj': w.to_numpy(obj_array)}
+            if optimizer is not None and len(optimizer.params_list) > 0:
+                for param_name, arr in zip(optimizer.params_list, optimizer.get_decoded_param_arrays()):
+                    arr_dict['opt_{}_{}'.format(optimizer.name, param_name)] = w.to_numpy(arr)
+            shape = arr_dict['obj'].shape
+            n_tiles = [int(np.ceil(shape[i] / self.tile_size)) for i in range(2)]
+            # All tiles are written in the first checkpoint.
+            write_all = self.shape != shape or sorted(arr_dict.keys()) != self.names
+            if write_all:
+                self.shape = shape
+                self.names = sorted(arr_dict.keys())
+                self.tile_version = np.zeros(n_tiles, dtype=int)
+            if tile_mask is None:
+                checksum = self.get_tile_checksums(list(arr_dict.values()))
+                tile_mask = checksum != self.tile_checksum if self.tile_checksum is not None else None
+                self.tile_checksum = checksum
+            else:
+                self.tile_checksum = None
+            if write_all or tile_mask is None:
+                tile_mask = np.ones(n_tiles, dtype=bool)
+            # Only the changed tiles are copied.
+            for i_ty, i_tx in zip(*np.nonzero(tile_mask)):
+                sl = self.get_tile_slicer(i_ty, i_tx)
+                file_ls.append((self.get_tile_filename(i_ty, i_tx, self.version),
+                                {key: np.array(arr[sl]) for key, arr in arr_dict.items()}))
+                self.tile_version[i_ty, i_tx] = self.version
+        rng_state = np.random.get_state()
+        manifest = {'i_epoch': int(i_epoch), 'i_batch': int(i_batch), 'version': self.version,
+                    'rng_state': [rng_state[0], rng_state[1].tolist(), *rng_state[2:]],
+                    'tile_size': self.tile_size, 'compression': self.compression}
+        if params is not None:
+            manifest['params'] = 'params_{}_{}'.format(rank, self.version)
+            file_ls.append((manifest['params'], pickle.dumps(params)))
+        if self.tile_version is not None:
+            manifest.update({'shape': list(self.shape), 'names': self.names,
+                             'tile_version': self.tile_version.tolist()})
         if optimizer is not None:
-            optimizer.save_distributed_param_arrays_to_checkpoint()
+            manifest.update(optimizer.get_tile_counters())
+        file_ls.append(('manifest{}.json'.format(self.suffix), manifest))
+        self.wait()
+        if not os.path.exists(os.path.join(self.path, 'tiles')):
+            os.makedirs(os.path.join(self.path, 'tiles'), exist_ok=True)
+        self.referenced_files = set(self.get_tile_filename(i_ty, i_tx, v)
+                                    for (i_ty, i_tx), v in np.ndenumerate(self.tile_version)) \
+                                if self.tile_version is not None else set()
+        if params is not None:
+            self.referenced_files.add(manifest['params'])
+        if self.asynchronous:
+            self.thread = threading.Thread(target=self.write_files, args=(file_ls,), daemon=True)
+            self.thread.start()
+        else:
+            self.write_files(file_ls)
+            self.raise_exception()
+
+    def get_tile_filename(self, i_ty, i_tx, version):
+        return os.path.join('tiles', 'tile{}_{}_{}_{}.h5'.format(self.suffix, i_ty, i_tx, version))
+
+    def after_write(self):
+        # Delete tile and parameter files superseded by the manifest just written.
+        super(TiledCheckpointWriter, self).after_write()
+        pattern = re.compile(r'tile{}_\d+_\d+_\d+\.h5$'.format(self.suffix))
+        for fname in os.listdir(os.path.join(self.path, 'tiles')):
+            if pattern.match(fname) and os.path.join('tiles', fname) not in self.referenced_files:
+                os.remove(os.path.join(self.path, 'tiles', fname))
+
+
+class TiledCheckpointArray(object):
+    """
+    Array-like view of an array stored in a checkpoint written by TiledCheckpointWriter. Tiles are read when
+    they are indexed, so reading a region only opens the files of the tiles it overlaps.
+
+    :param path: String. The checkpoint folder.
+    :param manifest: Dict loaded from the manifest file.
+    :param name: String. Name of the array ('obj', or 'opt_[optimizer name]_[parameter name]').
+    """
+    def __init__(self, path, manifest, name):
+        self.path = path
+        self.name = name
+        self.tile_size = manifest['tile_size']
+        self.tile_version = np.array(manifest['tile_version'])
+        self.shape = tuple(manifest['shape'])
+        self.suffix = manifest.get('suffix', '')
+        self.dtype = None
+
+    def get_tile(self, i_ty, i_tx):
+        fname = os.path.join(self.path, 'tiles', 'tile{}_{}_{}_{}.h5'.format(
+            self.suffix, i_ty, i_tx, self.tile_version[i_ty, i_tx]))
+        with h5py.File(fname, 'r') as f:
+            return f[self.name][...]
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        sl_ls = []
+        for i in range(2):
+            sl = item[i] if i < len(item) else slice(None)
+            if not isinstance(sl, slice) or sl.step not in (None, 1):
+                raise IndexError('Only contiguous slices are supported along the first 2 axes.')
+            sl_ls.append(slice(*sl.indices(self.shape[i])[:2]))
+        out = None
+        ts = self.tile_size
+        for i_ty in range(sl_ls[0].start // ts, (sl_ls[0].stop - 1) // ts + 1):
+            for i_tx in range(sl_ls[1].start // ts, (sl_ls[1].stop - 1) // ts + 1):
+                tile = self.get_tile(i_ty, i_tx)
+                if out is None:
+                    out = np.zeros([sl_ls[0].stop - sl_ls[0].start, sl_ls[1].stop - sl_ls[1].start,
+                                    *self.shape[2:]], dtype=tile.dtype)
+                y0, x0 = i_ty * ts, i_tx * ts
+                ys = slice(max(y0, sl_ls[0].start), min(y0 + ts, sl_ls[0].stop))
+                xs = slice(max(x0, sl_ls[1].start), min(x0 + ts, sl_ls[1].stop))
+                out[ys.start - sl_ls[0].start:ys.stop - sl_ls[0].start,
+                    xs.start - sl_ls[1].start:xs.stop - sl_ls[1].start] = \
+                    tile[ys.start - y0:ys.stop - y0, xs.start - x0:xs.stop - x0]
+        return out[(slice(None), slice(None), *item[2:])]
+
+    def __array__(self, dtype=None):
+        arr = self[:, :]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def load_checkpoint_manifest(output_folder, distribution_mode=None):
+    suffix = '' if distribution_mode is None else '_rank_{}'.format(rank)
+    fname = os.path.join(output_folder, 'checkpoint', 'manifest{}.json'.format(suffix))
+    if not os.path.exists(fname):
+        return None
+    f = open(fname, 'r')
+    manifest = json.load(f)
+    f.close()
+    manifest['suffix'] = suffix
+    return manifest
+
+
+def load_checkpoint_record(output_folder, distribution_mode=None):
+    """
+    Load the record of the last checkpoint written by CheckpointWriter, or None if there is none.
+    """
+    suffix = '' if distribution_mode is None else '_rank_{}'.format(rank)
+    fname = os.path.join(output_folder, 'checkpoint', 'checkpoint{}.json'.format(suffix))
+    if not os.path.exists(fname):
+        return None
+    f = open(fname, 'r')
+    record = json.load(f)
+    f.close()
+    return record
+
+
+def restore_params_checkpoint(output_folder, distribution_mode=None):
+    """
+    Load the optimizable parameters other than the object saved with the last checkpoint, or None if there are
+    none.
+    """
+    path = os.path.join(output_folder, 'checkpoint')
+    manifest = load_checkpoint_manifest(output_folder, distribution_mode)
+    record = load_checkpoint_record(output_folder, distribution_mode)
+    if manifest is not None and (record is None or
+                                 (manifest['i_epoch'], manifest['i_batch']) >= (record['i_epoch'], record['i_batch'])):
+        fname = manifest.get('params')
+    elif record is not None:
+        fname = record['files'].get('params')
     else:
-        pass
+        # Checkpoints written before the files were versioned.
+        fname = 'params_{}'.format(rank)
+    if fname is None or not os.path.exists(os.path.join(path, fname)):
+        return None
+    f = open(os.path.join(path, fname), 'rb')
+    params = pickle.load(f)
+    f.close()
+    return params
+
+def save_checkpoint(i_epoch, i_batch, output_folder, distribution_mode=None, obj_array=None, optimizer=None):
+
+    if distribution_mode == 'shared_file':
+        # The object and optimizer state are in HDF5 files already.
+        obj_array = optimizer = None
+    writer = CheckpointWriter(output_folder, distribution_mode=distribution_mode, asynchronous=False)
+    writer.save(i_epoch, i_batch, obj_array=obj_array, optimizer=optimizer)
     return
 
 
 def restore_checkpoint(output_folder, distribution_mode=None, optimizer=None, dtype='float32'):
 
     path = os.path.join(output_folder, 'checkpoint')
-    i_epoch, i_batch = [int(i) for i in np.loadtxt(os.path.join(path, 'checkpoint.txt'))]
+    manifest = load_checkpoint_manifest(output_folder, distribution_mode)
+    record = load_checkpoint_record(output_folder, distribution_mode)
+    if record is not None:
+        i_epoch, i_batch = record['i_epoch'], record['i_batch']
+        file_dict = record['files']
+    elif os.path.exists(os.path.join(path, 'checkpoint.txt')):
+        # Checkpoints written before the files were versioned.
+        i_epoch, i_batch = [int(i) for i in np.loadtxt(os.path.join(path, 'checkpoint.txt'))]
+        suffix = '' if distribution_mode is None else '_rank_{}'.format(rank)
+        file_dict = {'obj': 'obj_checkpoint{}.npy'.format(suffix)}
+    elif manifest is None:
+        raise FileNotFoundError('No checkpoint found in {}.'.format(path))
+    else:
+        i_epoch, i_batch = (-1, -1)
+        file_dict = {}
+    # Use the tiled checkpoint if it is more recent than the .npy one.
+    if manifest is not None and (manifest['i_epoch'], manifest['i_batch']) >= (i_epoch, i_batch):
+        return restore_tiled_checkpoint(manifest, output_folder, distribution_mode, optimizer, dtype=dtype)
+    if distribution_mode == 'shared_file':
+        return i_epoch, i_batch
+    obj = np.load(os.path.join(path, file_dict['obj']))
+    arr = np.load(os.path.join(path, file_dict['opt'])) if 'opt' in file_dict else None
     if distribution_mode is None:
-        obj = np.load(os.path.join(path, 'obj_checkpoint.npy'))
-        optimizer.restore_param_arrays_from_checkpoint()
-        return i_epoch, i_batch, obj
+        optimizer.restore_param_arrays_from_checkpoint(arr=arr)
     elif distribution_mode == 'distributed_object':
-        obj = np.load(os.path.join(path, 'obj_checkpoint_rank_{}.npy'.format(rank)))
-        optimizer.restore_distributed_param_arrays_from_checkpoint(use_numpy=True, dtype=dtype)
-        return i_epoch, i_batch, obj
-    elif distribution_mode == 'shared_file':
-        return i_epoch, i_batch
+        optimizer.restore_distributed_param_arrays_from_checkpoint(use_numpy=True, dtype=dtype, arr=arr)
+    if record is not None:
+        optimizer.set_tile_counters(record)
+    return i_epoch, i_batch, obj
+
+
+
+def restore_tiled_checkpoint(manifest, output_folder, distribution_mode=None, optimizer=None, dtype='float32'):
+
+    path = os.path.join(output_folder, 'checkpoint')
+    rng_state = manifest['rng_state']
+    np.random.set_state((rng_state[0], np.array(rng_state[1], dtype='uint32'), *rng_state[2:]))
+    if distribution_mode == 'shared_file':
+        return manifest['i_epoch'], manifest['i_batch']
+    obj = np.asarray(TiledCheckpointArray(path, manifest, 'obj'))
+    if optimizer is not None and len(optimizer.params_list) > 0:
+        arr = np.stack([np.asarray(TiledCheckpointArray(path, manifest, 'opt_{}_{}'.format(optimizer.name, p)))
+                        for p in optimizer.params_list])
+        if distribution_mode is None:
+            optimizer.restore_param_arrays_from_checkpoint(arr=arr)
+        else:
+            optimizer.restore_distributed_param_arrays_from_checkpoint(use_numpy=True, dtype=dtype, arr=arr)
+    if optimizer is not None:
+        optimizer.set_tile_counters(manifest)
+    return manifest['i_epoch'], manifest['i_batch'], obj
+
+class IntermediateOutputWriter(object):
+    """
+    Writes intermediate output in a background thread. submit() queues a job, which is a function and its
+    arguments, and returns immediately; the worker thread runs the jobs in order, so the conversion of the arrays
+    (to host memory, magnitude and phase, etc.) and the file writing overlap with the reconstruction. The arrays
+    passed to a job must be snapshots that the reconstruction does not modify afterwards (see snapshot_object and
+    snapshot_params); for PyTorch, the snapshots stay on the device and are copied to the host by the worker.
+    At most max_pending jobs of each kind (i.e., with the same function) wait in the queue besides the one being
+    written. If a job is submitted when max_pending jobs of its kind are waiting, the oldest of them is dropped, so
+    the memory held by snapshots is bounded and a slow file system never stalls the reconstruction, and jobs of
+    one kind (e.g., parameters) never push out those of another (e.g., the object).
+
+    :param max_pending: Int. Maximum number of jobs of each kind waiting in the queue.
+    :param asynchronous: Bool. If False, submit() runs the job before returning.
+    """
+    def __init__(self, max_pending=1, asynchronous=True):
+        self.max_pending = max_pending
+        self.asynchronous = asynchronous
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.busy = False
+        self.exception = None
+        self.n_dropped = 0
+
+    @staticmethod
+    def snapshot_object(obj):
+        """
+        Return a shallow copy of an adorym.ObjectFunction whose array is a snapshot of obj.arr.
+        """
+        obj_snapshot = copy.copy(obj)
+        if obj.arr is not None:
+            obj_snapshot.arr = w.copy(obj.arr)
+        return obj_snapshot
+
+    @staticmethod
+    def snapshot_params(params, names):
+        """
+        Return a dict of snapshots of the parameters in params whose keys are in names.
+        """
+        snapshot = {}
+        for name in names:
+            if name in params.keys():
+                if isinstance(params[name], (list, tuple)):
+                    snapshot[name] = [w.copy(a) for a in params[name]]
+                else:
+                    snapshot[name] = w.copy(params[name])
+        return snapshot
+
+    def submit(self, func, *args, **kwargs):
+        self.raise_exception()
+        if not self.asynchronous:
+            func(*args, **kwargs)
+            return
+        with self.cond:
+            same_kind_ls = [i for i, job in enumerate(self.queue) if job[0] is func]
+            if len(same_kind_ls) >= self.max_pending:
+                del self.queue[same_kind_ls[0]]
+                self.n_dropped += 1
+            self.queue.append((func, args, kwargs))
+            self.cond.notify_all()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.queue) == 0:
+                    self.cond.wait()
+                func, args, kwargs = self.queue.popleft()
+                self.busy = True
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.exception = e
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def raise_exception(self):
+        if self.exception is not None:
+            e = self.exception
+            self.exception = None
+            raise e
+
+    def wait(self):
+        """
+        Block until all queued jobs are written.
+        """
+        with self.cond:
+            while len(self.queue) > 0 or self.busy:
+                self.cond.wait()
+        self.raise_exception()
 
 
 def parse_source_folder(src_dir, prefix):
@@ -2,7 +2,6 @@ import numpy as np
 import os
 import h5py
 import pickle
-import scipy.optimize
 
 import adorym
 from adorym.util import *
@@ -10,6 +9,7 @@ from adorym.array_ops import ObjectFunction, Gradient
 import adorym.wrappers as w
 import adorym.global_settings as global_settings
 from adorym.misc import *
+from adorym.timing import timer, timed
 from adorym.linesearch import *
 
 project_config = check_config_indept_mpi()
@@ -50,6 +50,12 @@ class Optimizer(object):
     :param params_list: List of str; a list of optimizer parameters provided in strings. (Only used for parent class.
                         Child Optimizer classes do NOT take this argument.)
     """
+    # Whether the parameters of the optimizer can be stored in bfloat16 or float16 (see create_container).
+    supports_state_encoding = False
+    # Whether the optimizer can update only the tiles of a sparse update (see apply_gradient_to_tiles), i.e.,
+    # whether it implements get_param_decay_rates.
+    supports_sparse_update = False
+
     def __init__(self, name, output_folder='.', params_list=(), distribution_mode=None,
                  options_dict=None, forward_model=None):
         self.name = name
@@ -64,113 +70,365 @@ class Optimizer(object):
         self.params_chunk_array_0_dict = {}
         self.i_batch = 0
         self.index_in_grad_returns = None
+        # Update schedule of parameters other than the object. See set_update_schedule.
+        self.update_period = 1
+        self.gradient_policy = 'sample'
         self.slice_catalog = None
+        self.params_dset_written = False
+        # Step counters of sparse updates. tile_last_step holds the index of the last sparse step at which
+        # each (y, x) tile was updated, or -1 if it has not been updated yet.
+        self.tile_last_step = None
+        self.i_tile_step = 0
+        # Storage precision of optimizer parameters. See create_container.
+        self.state_dtype = None
+        self.stochastic_rounding = True
+        self.params_scale_dict = {}
+        self.params_scale_dset_dict = {}
+        self.rng = np.random.default_rng()
+        self.comm = MPI.COMM_WORLD
+        # adorym.SyncCounter counting the wait time of the reductions of the optimizer. Set by
+        # reconstruct_ptychography; if None, self.comm is used directly.
+        self.sync = None
         self.distribution_mode = distribution_mode
         self.options_dict = options_dict
         self.grads = None # Object gradient should be saved in Gradient class, not here.
         return
 
+    def allreduce(self, a, label='allreduce'):
+        if self.sync is not None:
+            return self.sync.allreduce(a, label, comm=self.comm)
+        return self.comm.allreduce(a)
+
     def __str__(self):
         s = self.__class__.__name__ + '; '
         for k in self.options_dict.keys():
             s = s + k + ': ' + str(self.options_dict[k]) + '; '
         return s
 
-    def create_container(self, whole_object_size, use_checkpoint, device_obj, use_numpy=False, dtype='float32'):
+    def create_container(self, whole_object_size, use_checkpoint, device_obj, use_numpy=False, dtype='float32',
+                         comm=None, probe_size=None, state_dtype=None, stochastic_rounding=True):
         """
         :param whole_object_size: List of int; 4-D vector for object function (including 2 channels),
                                   or a 3-D vector for probe, or a 1-D scalar for other variables.
                                   Channel must be the last domension. Parameter arrays will be created
                                   following exactly whole_object_size.
+        :param comm: Communicator among the ranks holding the slabs of the object in distributed_object mode.
+                     Default is MPI.COMM_WORLD.
+        :param probe_size: Probe size used to plan the chunk layout of parameter files in shared_file mode.
+        :param state_dtype: None or String. Storage data type of optimizer parameters. Choose from None (same
+                            as before: dtype for files and distributed arrays, backend default for arrays in
+                            data parallelism mode), 'float64', 'float32', 'bfloat16', or 'float16'. bfloat16 values
+                            are stored as raw bits in int16 arrays; float16 values are stored with a power-of-two
+                            scaling factor for each slice along the first axis, so that small values such as the
+                            second moment of Adam do not underflow. Parameters are converted to float32 for
+                            updates, and checkpoints are saved in float32.
+        :param stochastic_rounding: Bool. Whether to use stochastic rounding when storing parameters in bfloat16
+                                    or float16.
         """
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
+        self.state_dtype = state_dtype
+        self.stochastic_rounding = stochastic_rounding
+        if self.is_state_encoded() and len(self.params_list) > 0 and not self.supports_state_encoding:
+            raise NotImplementedError('{} does not support state_dtype = {}.'.format(self.__class__.__name__,
+                                                                                      state_dtype))
         if self.distribution_mode == 'distributed_object':
-            self.slice_catalog = get_multiprocess_distribution_index(whole_object_size[0], n_ranks)
+            self.slice_catalog = get_multiprocess_distribution_index(whole_object_size[0], self.comm.Get_size())
         self.whole_object_size = whole_object_size
         if self.distribution_mode == 'shared_file':
-            self.create_file_objects(whole_object_size, use_checkpoint=use_checkpoint)
+            self.create_file_objects(whole_object_size, use_checkpoint=use_checkpoint, dtype=dtype, probe_size=probe_size)
         elif self.distribution_mode == 'distributed_object':
-            self.create_distributed_param_arrays(whole_object_size, use_numpy=use_numpy, dtype=dtype)
+            self.create_distributed_param_arrays(whole_object_size, use_numpy=use_numpy,
+                                                 dtype=get_state_storage_dtype(state_dtype or dtype))
         elif self.distribution_mode is None:
-            self.create_param_arrays(whole_object_size, device=device_obj)
+            self.create_param_arrays(whole_object_size, device=device_obj,
+                                     dtype=get_state_storage_dtype(state_dtype))
+
+    def is_state_encoded(self):
+        return self.state_dtype in ('bfloat16', 'float16')
+
+    def create_scale_arrays(self, n_rows):
+        self.params_scale_dict = {}
+        if self.state_dtype == 'float16':
+            for param_name in self.params_list:
+                self.params_scale_dict[param_name] = np.ones(n_rows)
+
+    def encode_state(self, param_name, arr, rows):
+        return encode_optimizer_state(arr, self.state_dtype, row_scale=self.get_row_scale(param_name, rows),
+                                      stochastic_rounding=self.stochastic_rounding, rng=self.rng)
+
+    def decode_state(self, param_name, stored, rows):
+        return decode_optimizer_state(stored, self.state_dtype, row_scale=self.get_row_scale(param_name, rows))
+
+    def get_row_scale(self, param_name, rows):
+        if param_name not in self.params_scale_dict:
+            return None
+        return np.atleast_1d(self.params_scale_dict[param_name][rows])
+
+    def update_row_scale(self, param_name, arr, rows, full_rows=True):
+        """
+        Update the float16 scaling factors of the given rows to fit arr, which is about to be encoded into these
+        rows. Returns the list of rows whose factors decreased although arr covers only part of them; the
+        remaining content of these rows must be re-encoded by the caller.
+        """
+        if param_name not in self.params_scale_dict:
+            return []
+        scale = self.params_scale_dict[param_name]
+        rows = np.atleast_1d(np.arange(len(scale))[rows])
+        new_scale = get_state_row_scale(arr)
+        if full_rows:
+            new_scale[np.isinf(new_scale)] = 1.
+            rescale_ls = []
+        else:
+            # Only shrink the factors of partially written rows, as the unwritten part still needs to fit.
+            new_scale = np.minimum(new_scale, scale[rows])
+            rescale_ls = [(row, scale[row]) for row, s_new in zip(rows, new_scale) if s_new != scale[row]]
+        scale[rows] = new_scale
+        return rescale_ls
 
-    def create_file_objects(self, whole_object_size, use_checkpoint=False):
+    def create_file_objects(self, whole_object_size, use_checkpoint=False, dtype='float32', probe_size=None):
+        """
+        Parameter datasets are created without zero-filling. Until they are written for the first time
+        (i.e., until self.params_dset_written is True), get_param_slice_from_file returns zeros instead
+        of reading them.
+        """
         self.whole_object_size = whole_object_size
+        self.params_dset_written = True
+        if self.state_dtype is None:
+            self.state_dtype = dtype
+        storage_dtype = get_state_storage_dtype(self.state_dtype)
+        self.create_scale_arrays(self.whole_object_size[0])
         if len(self.params_list) > 0:
+            chunk_shape, cache_bytes = plan_hdf5_layout(self.whole_object_size, dtype=storage_dtype,
+                                                        probe_size=probe_size)
             for param_name in self.params_list:
                 fmode = 'a' if use_checkpoint else 'w'
-                try:
-                    self.params_file_pointer_dict[param_name] = h5py.File(os.path.join(self.output_folder, 'intermediate_{}.h5'.format(param_name)), fmode, driver='mpio', comm=comm)
-                    print_flush('Created intermediate file: {}'.format(os.path.join(self.output_folder, 'intermediate_{}.h5'.format(param_name))), 0, rank)
-                except:
-                    self.params_file_pointer_dict[param_name] = h5py.File(os.path.join(self.output_folder, 'intermediate_{}.h5'.format(param_name)), fmode)
-                try:
-                    dset_p = self.params_file_pointer_dict[param_name].create_dataset('obj', shape=self.whole_object_size,
-                                                                                      dtype='float64', data=np.zeros(self.whole_object_size))
-                except:
-                    dset_p = self.params_file_pointer_dict[param_name]['obj']
-                # if rank == 0: dset_p[...] = 0
+                fname = os.path.join(self.output_folder, 'intermediate_{}.h5'.format(param_name))
+                f = open_hdf5_file_mpi(fname, fmode, cache_bytes=cache_bytes,
+                                       chunk_bytes=int(np.prod(chunk_shape)) * np.dtype(storage_dtype).itemsize)
+                print_flush('Created intermediate file: {}'.format(fname), 0, rank)
+                self.params_file_pointer_dict[param_name] = f
+                if 'obj' not in f:
+                    self.params_dset_written = False
+                elif f['obj'].attrs.get('state_dtype', str(f['obj'].dtype)) != self.state_dtype:
+                    self.convert_param_file(param_name, storage_dtype, chunk_shape)
+                dset_p = create_dataset_without_fill(f, 'obj', self.whole_object_size, dtype=storage_dtype,
+                                                     chunks=chunk_shape)
+                dset_p.attrs['state_dtype'] = self.state_dtype
                 self.params_dset_dict[param_name] = dset_p
+                if self.state_dtype == 'float16':
+                    if 'scale' in f:
+                        self.params_scale_dict[param_name][...] = f['scale'][...]
+                    else:
+                        f.create_dataset('scale', data=self.params_scale_dict[param_name])
+                    self.params_scale_dset_dict[param_name] = f['scale']
         return
 
-    def create_param_arrays(self, whole_object_size, device=None, use_numpy=False):
+    def convert_param_file(self, param_name, storage_dtype, chunk_shape):
+        """
+        Convert an existing parameter dataset (e.g., from a checkpoint saved with a different state_dtype) to the
+        current state_dtype. Each rank converts its own slices.
+        """
+        f = self.params_file_pointer_dict[param_name]
+        dset_old = f['obj']
+        old_state_dtype = dset_old.attrs.get('state_dtype', str(dset_old.dtype))
+        old_scale = f['scale'][...] if old_state_dtype == 'float16' else None
+        print_flush('Converting {} from {} to {}.'.format(param_name, old_state_dtype, self.state_dtype), 0, rank)
+        dset_new = create_dataset_without_fill(f, 'obj_converted', self.whole_object_size, dtype=storage_dtype,
+                                               chunks=chunk_shape)
+        for i_slice in range(self.comm.Get_rank(), self.whole_object_size[0], self.comm.Get_size()):
+            p = dset_old[i_slice]
+            if old_state_dtype in ('bfloat16', 'float16'):
+                p = decode_optimizer_state(p[None], old_state_dtype,
+                                           row_scale=old_scale[i_slice:i_slice + 1] if old_scale is not None else None)[0]
+            if self.is_state_encoded():
+                self.update_row_scale(param_name, p[None], [i_slice])
+                p = self.encode_state(param_name, p[None], [i_slice])[0]
+            dset_new[i_slice] = p
+        self.comm.Barrier()
+        if self.state_dtype == 'float16':
+            self.params_scale_dict[param_name] = self.comm.allreduce(
+                np.where(np.arange(self.whole_object_size[0]) % self.comm.Get_size() == self.comm.Get_rank(),
+                         self.params_scale_dict[param_name], 0))
+        del f['obj']
+        if 'scale' in f:
+            del f['scale']
+        f.move('obj_converted', 'obj')
+
+    def read_param_from_file(self, param_name, rows, sx=slice(None)):
+        """
+        :param rows: Int or slice. Index or range of slices along the first axis.
+        """
+        p = self.params_dset_dict[param_name][rows, sx]
+        if self.is_state_encoded():
+            if isinstance(rows, slice):
+                p = self.decode_state(param_name, p, rows)
+            else:
+                p = self.decode_state(param_name, p[None], [rows])[0]
+        return p
+
+    def write_param_to_file(self, param_name, rows, p, sx=slice(None)):
+        dset_p = self.params_dset_dict[param_name]
+        if self.is_state_encoded():
+            p_rows = p if isinstance(rows, slice) else p[None]
+            row_ls = rows if isinstance(rows, slice) else [rows]
+            full_row = sx == slice(None)
+            for row, old_scale in self.update_row_scale(param_name, p_rows, row_ls, full_rows=full_row):
+                # Re-encode the rest of the slice with the new factor.
+                p_row = decode_optimizer_state(dset_p[row][None], self.state_dtype,
+                                               row_scale=np.array([old_scale]))
+                dset_p[row] = self.encode_state(param_name, p_row, [row])[0]
+            p = self.encode_state(param_name, p_rows, row_ls)
+            p = p if isinstance(rows, slice) else p[0]
+            if param_name in self.params_scale_dset_dict:
+                self.params_scale_dset_dict[param_name][rows] = self.params_scale_dict[param_name][rows]
+        dset_p[rows, sx] = p
+
+    def get_param_slice_from_file(self, param_name, rows):
+        dset_p = self.params_dset_dict[param_name]
+        if not self.params_dset_written:
+            shape = dset_p.shape[1:]
+            if isinstance(rows, slice):
+                shape = [len(range(*rows.indices(dset_p.shape[0]))), *shape]
+            return np.zeros(shape, dtype='float32' if self.is_state_encoded() else dset_p.dtype)
+        return self.read_param_from_file(param_name, rows)
+
+    def get_file_update_blocks(self, n_slices, block_bytes=2 ** 26):
+        """
+        Split the slices updated by this rank into strided blocks of about block_bytes per array. A rank owns the
+        slices rank, rank + n_ranks, ..., the same ones it rotates in apply_rotation_to_hdf5 and
+        revert_rotation_to_hdf5, so no rank reads a slice that another rank is still rotating or updating.
+        """
+        slice_ls = range(rank, n_slices, n_ranks)
+        slice_bytes = max(int(np.prod(self.whole_object_size[1:])) * 4, 1)
+        n_per_block = max(block_bytes // slice_bytes, 1)
+        return [slice(slice_ls[i], slice_ls[min(i + n_per_block, len(slice_ls)) - 1] + 1, n_ranks)
+                for i in range(0, len(slice_ls), n_per_block)]
+
+    def stream_update_file(self, obj, gradient, update_func):
+        """
+        Update the slices of obj owned by this rank and the optimizer parameters in files block by block. A reader
+        thread reads x, g and the parameters of the next block and a writer thread writes the previous block
+        while update_func(x, g, p_ls) updates the current block in place, with p_ls in the order of params_list.
+        """
+        assert isinstance(obj, ObjectFunction)
+        assert isinstance(gradient, Gradient)
+
+        def read_block(sl):
+            return obj.dset[sl], gradient.dset[sl], [self.get_param_slice_from_file(param_name, sl)
+                                                     for param_name in self.params_list]
+
+        def update_block(sl, data):
+            update_func(*data)
+            return data
+
+        def write_block(sl, data):
+            x, _, p_ls = data
+            obj.dset[sl] = x
+            for param_name, p in zip(self.params_list, p_ls):
+                self.write_param_to_file(param_name, sl, p)
+
+        backend_temp = global_settings.backend
+        global_settings.backend = 'autograd'
+        try:
+            stream_blocks(self.get_file_update_blocks(obj.dset.shape[0]), read_block, update_block, write_block)
+        finally:
+            global_settings.backend = backend_temp
+        self.params_dset_written = True
+
+    def create_param_arrays(self, whole_object_size, device=None, use_numpy=False, dtype=None):
         self.whole_object_size = whole_object_size
         malias = np if use_numpy else w
         kwargs = {} if use_numpy else {'device': device}
         if len(self.params_list) > 0:
+            self.create_scale_arrays(self.whole_object_size[0])
             for param_name in self.params_list:
                 if malias == np:
-                    self.params_whole_array_dict[param_name] = malias.zeros(self.whole_object_size, device=device)
+                    self.params_whole_array_dict[param_name] = malias.zeros(self.whole_object_size, dtype=dtype)
                 else:
                     self.params_whole_array_dict[param_name] = malias.zeros(self.whole_object_size, device=device,
-                                                                            requires_grad=False)
+                                                                            requires_grad=False, dtype=dtype)
         return
 
     def create_distributed_param_arrays(self, whole_object_size, use_numpy=False, dtype='float32'):
         self.whole_object_size = whole_object_size
         malias = np if use_numpy else w
-        if len(self.params_list) > 0 and self.slice_catalog[rank] is not None:
+        my_slice_range = self.slice_catalog[self.comm.Get_rank()]
+        if len(self.params_list) > 0 and my_slice_range is not None:
+            self.create_scale_arrays(my_slice_range[1] - my_slice_range[0])
             for param_name in self.params_list:
                 if malias == np:
                     self.params_whole_array_dict[param_name] = \
-                        malias.zeros([self.slice_catalog[rank][1] - self.slice_catalog[rank][0],
+                        malias.zeros([my_slice_range[1] - my_slice_range[0],
                                       *self.whole_object_size[1:]], dtype=dtype)
                 else:
                     self.params_whole_array_dict[param_name] = \
-                        malias.zeros([self.slice_catalog[rank][1] - self.slice_catalog[rank][0],
+                        malias.zeros([my_slice_range[1] - my_slice_range[0],
                                       *self.whole_object_size[1:]], dtype=dtype, requires_grad=False)
         return
 
-    def restore_param_arrays_from_checkpoint(self, device=None, use_numpy=False):
+    def restore_param_arrays_from_checkpoint(self, device=None, use_numpy=False, arr=None):
+        """
+        :param arr: Array of the stacked parameter arrays. If None, it is read from the .npy checkpoint file.
+        """
         if len(self.params_list) > 0:
-            arr = np.load(os.path.join(self.output_folder, 'checkpoint', 'opt_{}_params_checkpoint.npy'.format(self.name)))
+            if arr is None:
+                arr = np.load(os.path.join(self.output_folder, 'checkpoint', 'opt_{}_params_checkpoint.npy'.format(self.name)))
             if use_numpy == False:
                 arr = w.create_variable(arr, device=device, requires_grad=False)
             if len(self.params_list) > 0:
                 for i, param_name in enumerate(self.params_list):
-                    self.params_whole_array_dict[param_name] = arr[i]
+                    self.params_whole_array_dict[param_name] = self.encode_checkpoint_array(param_name, arr[i])
         return
 
-    def restore_distributed_param_arrays_from_checkpoint(self, device=None, use_numpy=False, dtype='float32'):
+    def restore_distributed_param_arrays_from_checkpoint(self, device=None, use_numpy=False, dtype='float32', arr=None):
+        """
+        :param arr: Array of the stacked parameter arrays. If None, it is read from the .npy checkpoint file.
+        """
         if len(self.params_list) > 0:
             path = os.path.join(self.output_folder, 'checkpoint', 'opt_{}_params_checkpoint_rank_{}.npy'.format(self.name, rank))
-            if os.path.exists(path):
-                arr = np.load(path)
+            if arr is not None or os.path.exists(path):
+                if arr is None:
+                    arr = np.load(path)
                 if use_numpy == False:
                     arr = w.create_variable(arr, device=device, requires_grad=False)
                 if len(self.params_list) > 0:
                     for i, param_name in enumerate(self.params_list):
-                        self.params_whole_array_dict[param_name] = arr[i].astype(dtype)
+                        if self.is_state_encoded():
+                            self.params_whole_array_dict[param_name] = self.encode_checkpoint_array(param_name, arr[i])
+                        else:
+                            self.params_whole_array_dict[param_name] = arr[i].astype(dtype)
         return
 
+    def encode_checkpoint_array(self, param_name, arr):
+        """
+        Convert a float32 parameter array loaded from a checkpoint to the storage format.
+        """
+        if not self.is_state_encoded():
+            return arr
+        if param_name not in self.params_scale_dict:
+            self.create_scale_arrays(arr.shape[0])
+        self.update_row_scale(param_name, arr, slice(None))
+        return self.encode_state(param_name, arr, slice(None))
+
+    def get_decoded_param_arrays(self):
+        """
+        Get the list of parameter arrays in params_list order, decoded to float32 if they are stored in reduced
+        precision.
+        """
+        arr = []
+        for param_name in self.params_list:
+            p = self.params_whole_array_dict[param_name]
+            if self.is_state_encoded():
+                p = self.decode_state(param_name, p, slice(None))
+            arr.append(p)
+        return arr
+
     def save_param_arrays_to_checkpoint(self, use_numpy=False):
         malias = np if use_numpy else w
         path = os.path.join(self.output_folder, 'checkpoint')
         create_directory_multirank(path)
         if len(self.params_list) > 0:
-            arr = []
-            for i, param_name in enumerate(self.params_list):
-                arr.append(self.params_whole_array_dict[param_name])
-            arr = malias.stack(arr)
+            arr = malias.stack(self.get_decoded_param_arrays())
             np.save(os.path.join(path, 'opt_{}_params_checkpoint.npy'.format(self.name)), w.to_numpy(arr))
         return
 
@@ -180,17 +438,20 @@ class Optimizer(object):
         if not os.path.exists(path):
             os.makedirs(path)
         if len(self.params_list) > 0:
-            arr = []
-            for i, param_name in enumerate(self.params_list):
-                arr.append(self.params_whole_array_dict[param_name])
-            arr = malias.stack(arr)
+            arr = malias.stack(self.get_decoded_param_arrays())
             np.save(os.path.join(path, 'opt_{}_params_checkpoint_rank_{}.npy'.format(self.name, rank)), w.to_numpy(arr))
         return
 
     def get_params_from_file(self, this_pos_batch=None, probe_size=None):
 
+        if self.is_state_encoded():
+            raise NotImplementedError('Reading rotated chunks of parameters stored in {} is not '
+                                      'supported.'.format(self.state_dtype))
         for param_name, dset_p in self.params_dset_dict.items():
-            p = get_rotated_subblocks(dset_p, this_pos_batch, probe_size, self.whole_object_size[:-1])
+            if self.params_dset_written:
+                p = get_rotated_subblocks(dset_p, this_pos_batch, probe_size, self.whole_object_size[:-1])
+            else:
+                p = np.zeros([len(this_pos_batch), *probe_size, *self.whole_object_size[2:]])
             self.params_chunk_array_dict[param_name] = p
             self.params_chunk_array_0_dict[param_name] = np.copy(p)
         return
@@ -223,34 +484,233 @@ class Optimizer(object):
     def read_chunks_from_distributed_object(self, probe_pos, this_ind_batch_allranks, minibatch_size,
                                             probe_size, device=None, unknown_type='delta_beta', apply_to_arr_rot=False, dtype='float32', n_split='auto'):
         p_dict = self.params_whole_array_dict if not apply_to_arr_rot else self.params_whole_array_rot_dict
-        for param_name, arr in p_dict:
+        for param_name, arr in p_dict.items():
             arr = get_subblocks_from_distributed_object_mpi(arr, self.slice_catalog, probe_pos, this_ind_batch_allranks,
                                                             minibatch_size, probe_size, self.whole_object_size,
-                                                            unknown_type, output_folder=self.output_folder, dtype=dtype, n_split=n_split)
+                                                            unknown_type, output_folder=self.output_folder, dtype=dtype, n_split=n_split,
+                                                            comm=self.comm, sync=self.sync)
             arr = w.create_variable(arr, device=device)
         return arr
 
     def sync_chunks_to_distributed_object(self, arr, probe_pos, this_ind_batch_allranks, minibatch_size,
                                           probe_size, dtype='float32', n_split='auto'):
         arr = np.array(arr)
-        for param_name, params_arr in self.params_whole_array_dict:
+        for param_name, params_arr in self.params_whole_array_dict.items():
             self.params_whole_array_dict[param_name] = sync_subblocks_among_distributed_object_mpi(arr, params_arr,
                                                            self.slice_catalog, probe_pos, this_ind_batch_allranks,
                                                            minibatch_size, probe_size, self.whole_object_size,
-                                                           output_folder=self.output_folder, dtype='float32', n_split=n_split)
+                                                           output_folder=self.output_folder, dtype='float32', n_split=n_split,
+                                                           comm=self.comm, sync=self.sync)
 
     def set_index_in_grad_return(self, ind):
         self.index_in_grad_returns = ind
 
-    def convert_gradient(self, gradient):
+    def set_update_schedule(self, period=1, gradient_policy='sample'):
+        """
+        Set how often the parameter is updated. Only used for parameters other than the object function, whose
+        updates follow update_scheme and n_batch_per_update of reconstruct_ptychography.
+        :param period: Int or 'angle'. If Int, the parameter is updated every period update steps of the object;
+                       if 'angle', it is updated once per angle, at the first update step after the last batch of
+                       the angle.
+        :param gradient_policy: String. If 'sample', the gradient of the parameter is only calculated in the update
+                                steps where the parameter is updated, so that the differentiator skips it otherwise.
+                                If 'accumulate', the gradient is calculated in every step and summed over the period.
+        """
+        if period != 'angle' and (int(period) != period or period < 1):
+            raise ValueError('Update period must be a positive integer or \'angle\'.')
+        if gradient_policy not in ['sample', 'accumulate']:
+            raise ValueError('Gradient policy must be \'sample\' or \'accumulate\'.')
+        self.update_period = period
+        self.gradient_policy = gradient_policy
+
+    def convert_gradient(self, gradient, apply_scale=True):
+        """
+        :param apply_scale: If False, the gradient is returned as is, and the caller is expected to multiply it
+                            with get_gradient_scale() itself (e.g., inside a fused update kernel) so that
+                            no object-sized temporary is created.
+        """
         if isinstance(gradient, adorym.Gradient):
             g = gradient.arr
         else:
             g = gradient
-        if self.distribution_mode == 'distributed_object':
+        if apply_scale and self.distribution_mode == 'distributed_object':
             g = g / n_ranks
         return g
 
+    def get_gradient_scale(self):
+        if self.distribution_mode == 'distributed_object':
+            return 1. / n_ranks
+        return 1.
+
+    def get_param_arrays(self, x, ss, names):
+        """
+        Get the parameter arrays in self.params_whole_array_dict at slicer ss, moved to the device of x.
+        Returns the list of arrays and a list of flags telling whether each array is a copy that needs
+        to be written back with put_param_arrays after being updated in place.
+        """
+        basic_slicing = all(isinstance(s, slice) for s in ss)
+        arr_ls = []
+        copied_ls = []
+        for param_name in names:
+            p0 = self.params_whole_array_dict[param_name][tuple(ss)]
+            if w.get_var_device_type(x) == 'cuda':
+                p = w.to_gpu(p0, w.get_var_device(x))
+            else:
+                p = w.to_cpu(p0)
+            if self.is_state_encoded():
+                p = self.decode_state(param_name, p, ss[0])
+            arr_ls.append(p)
+            copied_ls.append(p is not p0 or not basic_slicing)
+        return arr_ls, copied_ls
+
+    def put_param_arrays(self, ss, names, arr_ls, copied_ls):
+        for param_name, p, copied in zip(names, arr_ls, copied_ls):
+            if not copied:
+                continue
+            p_whole = self.params_whole_array_dict[param_name]
+            if self.is_state_encoded():
+                full_rows = all(s == slice(None) or s == slice(0, n) for s, n in zip(ss[1:], p_whole.shape[1:]))
+                for row, old_scale in self.update_row_scale(param_name, p, ss[0], full_rows=full_rows):
+                    # Re-encode the rest of the row with the new factor.
+                    p_row = decode_optimizer_state(p_whole[row:row + 1], self.state_dtype,
+                                                   row_scale=np.array([old_scale]))
+                    p_whole[row:row + 1] = self.encode_state(param_name, p_row, [row])
+                p = self.encode_state(param_name, p, ss[0])
+            if w.get_var_device_type(p_whole) == 'cuda':
+                p = w.to_gpu(p, w.get_var_device(p_whole))
+            else:
+                p = w.to_cpu(p)
+            p_whole[tuple(ss)] = p
+
+    def get_state_chunk_slicers(self, x, ss):
+        """
+        Yield pairs of slicers of x and of the parameter arrays. If parameters are stored in reduced precision,
+        the region is split into chunks along the first axis so that only chunk-sized float32 copies of the
+        parameters are created; otherwise it is yielded as a whole.
+        """
+        if not self.is_state_encoded() or not isinstance(ss[0], slice):
+            yield Ellipsis, ss
+            return
+        n_rows = self.params_whole_array_dict[self.params_list[0]].shape[0]
+        row_st, _, row_step = ss[0].indices(n_rows)
+        for sl in _iter_slab_chunks(x):
+            ss_chunk = [slice(row_st + sl.start * row_step, row_st + sl.stop * row_step, row_step)] + list(ss[1:])
+            yield sl, ss_chunk
+
+    def get_file_gradient_scale(self):
+        return 1.
+
+    def get_param_decay_rates(self, **kwargs):
+        """
+        Get the factors by which each optimizer parameter is multiplied at a step with zero gradient. These
+        are used to apply the decay of skipped steps lazily in sparse updates.
+        """
+        raise NotImplementedError('{} does not support sparse updates.'.format(self.__class__.__name__))
+
+    def get_skipped_steps(self, tile_mask):
+        """
+        Get the number of sparse steps each tile has been skipped since its last update.
+        Tiles that have never been updated are reported as skipped 0 times.
+        """
+        if self.tile_last_step is None or self.tile_last_step.shape != tile_mask.shape:
+            self.tile_last_step = np.full(tile_mask.shape, -1, dtype=int)
+        n_skipped = self.i_tile_step - self.tile_last_step - 1
+        n_skipped[self.tile_last_step < 0] = 0
+        return n_skipped
+
+    def update_tile_counters(self, tile_mask):
+        self.tile_last_step[tile_mask] = self.i_tile_step
+        self.i_tile_step += 1
+
+    def get_tile_counters(self):
+        """
+        Get the step counters of sparse updates as a dict of JSON-serializable values. They are saved with
+        checkpoints, so that the decay pending in skipped tiles is still applied after a restart.
+        """
+        if self.tile_last_step is None:
+            return {}
+        return {'tile_last_step': self.tile_last_step.tolist(), 'i_tile_step': int(self.i_tile_step)}
+
+    def set_tile_counters(self, d):
+        """
+        Restore the step counters of sparse updates from a dict returned by get_tile_counters (or a checkpoint
+        record containing its keys).
+        """
+        if 'tile_last_step' in d:
+            self.tile_last_step = np.array(d['tile_last_step'], dtype=int)
+            self.i_tile_step = int(d['i_tile_step'])
+
+    def apply_gradient_to_tiles(self, x, gradient, i_batch, tile_mask, tile_size, **kwargs):
+        """
+        Sparse version of apply_gradient that updates x and the optimizer parameters only in the (y, x) tiles
+        where tile_mask is True. The decay of the parameters over the steps a tile was skipped is applied when
+        the tile is updated again.
+        :param tile_mask: Boolean array of shape [n_tiles_y, n_tiles_x], e.g. from get_footprint_tile_mask.
+        :param tile_size: Int. Edge length of tiles in pixels.
+        """
+        g = self.convert_gradient(gradient, apply_scale=False)
+        decay_rates = self.get_param_decay_rates(**kwargs)
+        n_skipped = self.get_skipped_steps(tile_mask)
+        for i_ty, i_tx_st, i_tx_end in get_tile_mask_runs(tile_mask):
+            sy = slice(i_ty * tile_size, (i_ty + 1) * tile_size)
+            for param_name, rate in decay_rates.items():
+                for i_tx in range(i_tx_st, i_tx_end):
+                    if n_skipped[i_ty, i_tx] > 0:
+                        ss_tile = [sy, slice(i_tx * tile_size, (i_tx + 1) * tile_size)]
+                        (p,), copied_ls = self.get_param_arrays(x, ss_tile, [param_name])
+                        p *= rate ** n_skipped[i_ty, i_tx]
+                        self.put_param_arrays(ss_tile, [param_name], [p], copied_ls)
+            ss = [sy, slice(i_tx_st * tile_size, i_tx_end * tile_size)] + [slice(None)] * (len(x.shape) - 2)
+            self.apply_gradient(x[tuple(ss)], g[tuple(ss)], i_batch, params_slicer=ss, update_batch_count=False,
+                                **kwargs)
+        self.update_tile_counters(tile_mask)
+        return x
+
+    def apply_gradient_to_file_tiles(self, obj, gradient, tile_mask, tile_size, i_batch=None, **kwargs):
+        """
+        Sparse version of apply_gradient_to_file. Slices and tiles outside tile_mask are neither read nor written.
+        """
+        assert isinstance(obj, ObjectFunction)
+        assert isinstance(gradient, Gradient)
+        s = obj.dset.shape
+        slice_ls = range(rank, s[0], n_ranks)
+        if i_batch is None: i_batch = self.i_batch
+        decay_rates = self.get_param_decay_rates(**kwargs)
+        n_skipped = self.get_skipped_steps(tile_mask)
+        run_dict = {}
+        for i_ty, i_tx_st, i_tx_end in get_tile_mask_runs(tile_mask):
+            run_dict.setdefault(i_ty, []).append((i_tx_st, i_tx_end))
+
+        backend_temp = global_settings.backend
+        global_settings.backend = 'autograd'
+        for i_slice in slice_ls:
+            i_ty = i_slice // tile_size
+            for i_tx_st, i_tx_end in run_dict.get(i_ty, []):
+                sx = slice(i_tx_st * tile_size, i_tx_end * tile_size)
+                x = obj.dset[i_slice, sx]
+                g = gradient.dset[i_slice, sx]
+                if self.get_file_gradient_scale() != 1:
+                    g *= self.get_file_gradient_scale()
+                p_dict = {}
+                for param_name, rate in decay_rates.items():
+                    p = self.read_param_from_file(param_name, i_slice, sx)
+                    for i_tx in range(i_tx_st, i_tx_end):
+                        sl = slice((i_tx - i_tx_st) * tile_size, (i_tx - i_tx_st + 1) * tile_size)
+                        # Parameter datasets are not zero-filled, and in sparse mode they are only ever
+                        # written in updated tiles.
+                        if not self.params_dset_written and self.tile_last_step[i_ty, i_tx] < 0:
+                            p[sl] = 0
+                        elif n_skipped[i_ty, i_tx] > 0:
+                            p[sl] *= rate ** n_skipped[i_ty, i_tx]
+                    p_dict[param_name] = p
+                self.apply_gradient(x, g, i_batch, update_batch_count=False, **p_dict, **kwargs)
+                obj.dset[i_slice, sx] = x
+                for param_name, p in p_dict.items():
+                    self.write_param_to_file(param_name, i_slice, p, sx)
+        self.update_tile_counters(tile_mask)
+        self.i_batch += 1
+        global_settings.backend = backend_temp
+
     def get_array_slicer(self, slicer):
         if slicer == None:
             if len(self.params_list) > 0:
@@ -267,6 +727,9 @@ class Optimizer(object):
 
 class AdamOptimizer(Optimizer):
 
+    supports_state_encoding = True
+    supports_sparse_update = True
+
     def __init__(self, name, output_folder='.', distribution_mode=None, options_dict=None, forward_model=None):
         super(AdamOptimizer, self).__init__(name, output_folder=output_folder, params_list=['m', 'v'],
                                             distribution_mode=distribution_mode, options_dict=options_dict, forward_model=forward_model)
@@ -286,82 +749,59 @@ class AdamOptimizer(Optimizer):
             gradient.
         """
         ss = self.get_array_slicer(params_slicer)
-        g = self.convert_gradient(gradient)
-        malias = np if use_numpy else w
+        g = self.convert_gradient(gradient, apply_scale=False)
         if m is None or v is None:
             if distribution_mode == 'shared_file':
                 m = self.params_chunk_array_dict['m']
                 v = self.params_chunk_array_dict['v']
             else:
-                m = self.params_whole_array_dict['m'][tuple(ss)]
-                v = self.params_whole_array_dict['v'][tuple(ss)]
-                device_0 = w.get_var_device(m)
-                device_type_0 = w.get_var_device_type(m)
-                if w.get_var_device_type(x) == 'cuda':
-                    m = w.to_gpu(m, w.get_var_device(x))
-                    v = w.to_gpu(v, w.get_var_device(x))
-                else:
-                    m = w.to_cpu(m)
-                    v = w.to_cpu(v)
-        m = b1 * m  # First moment estimate.
-        m = m + (1 - b1) * g
-        v = b2 * v  # Second moment estimate.
-        v = v + (1 - b2) * (g ** 2)
-        q = 1 - b1 ** (i_batch + 1)
-        mhat = m / q  # Bias correction.
-        q = 1 - b2 ** (i_batch + 1)
-        vhat = v / q
-        d = step_size * mhat / (malias.sqrt(vhat) + eps)
-        x = x - d
-        if distribution_mode == 'shared_file':
-            self.params_chunk_array_dict['m'] = m
-            self.params_chunk_array_dict['v'] = v
-        else:
-            if device_type_0 == 'cpu':
-                m = w.to_cpu(m)
-                v = w.to_cpu(v)
-            else:
-                m = w.to_gpu(m, device_0)
-                v = w.to_gpu(v, device_0)
-            self.params_whole_array_dict['m'][tuple(ss)] = m
-            self.params_whole_array_dict['v'][tuple(ss)] = v
+                for xs, ss_chunk in self.get_state_chunk_slicers(x, ss):
+                    (m, v), copied_ls = self.get_param_arrays(x, ss_chunk, ['m', 'v'])
+                    # x, m and v are updated in place.
+                    apply_adam_update_inplace(x[xs], g[xs], m, v, i_batch, step_size=step_size, b1=b1, b2=b2,
+                                              eps=eps, g_scale=self.get_gradient_scale())
+                    self.put_param_arrays(ss_chunk, ['m', 'v'], [m, v], copied_ls)
+                m = v = None
+        if m is not None:
+            apply_adam_update_inplace(x, g, m, v, i_batch, step_size=step_size, b1=b1, b2=b2, eps=eps,
+                                      g_scale=self.get_gradient_scale())
         if update_batch_count:
             self.i_batch += 1
-        del mhat, vhat
         if return_moments:
             return x, m, v
         else:
             return x
 
-    def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, b1=0.9, b2=0.999, eps=1e-7, **kwargs):
+    def apply_gradient_to_tiles(self, x, gradient, i_batch, tile_mask, tile_size, **kwargs):
+        x = super(AdamOptimizer, self).apply_gradient_to_tiles(x, gradient, i_batch, tile_mask, tile_size, **kwargs)
+        self.i_batch += 1
+        return x
+
+    def get_param_decay_rates(self, b1=0.9, b2=0.999, **kwargs):
+        return {'m': b1, 'v': b2}
+
+    def get_file_gradient_scale(self):
+        return 1. / n_ranks
+
+    def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, b1=0.9, b2=0.999, eps=1e-7,
+                               **kwargs):
 
-        assert isinstance(obj, ObjectFunction)
-        assert isinstance(gradient, Gradient)
-        s = obj.dset.shape
-        slice_ls = range(rank, s[0], n_ranks)
         if i_batch is None: i_batch = self.i_batch
 
-        backend_temp = global_settings.backend
-        global_settings.backend = 'autograd'
+        def update_func(x, g, p_ls):
+            m, v = p_ls
+            apply_adam_update_inplace(x, g, m, v, i_batch, step_size=step_size, b1=b1, b2=b2, eps=eps,
+                                      g_scale=self.get_file_gradient_scale())
 
-        for i_slice in slice_ls:
-            x = obj.dset[i_slice]
-            g = gradient.dset[i_slice] / n_ranks
-            m = self.params_dset_dict['m'][i_slice]
-            v = self.params_dset_dict['v'][i_slice]
-            x, m, v = self.apply_gradient(x, g, i_batch, step_size=step_size,
-                                    b1=b1, b2=b2, eps=eps, shared_file_object=False,
-                                    m=m, v=v, update_batch_count=False, return_moments=True)
-
-            obj.dset[i_slice] = x
-            self.params_dset_dict['m'][i_slice] = m
-            self.params_dset_dict['v'][i_slice] = v
+        self.stream_update_file(obj, gradient, update_func)
         self.i_batch += 1
-        global_settings.backend = backend_temp
 
 
 class MomentumOptimizer(Optimizer):
 
+    supports_state_encoding = True
+    supports_sparse_update = True
+
     def __init__(self, name, output_folder='.', distribution_mode=None, options_dict=None, forward_model=None):
         super(MomentumOptimizer, self).__init__(name, output_folder=output_folder, params_list=['v'],
                                           distribution_mode=distribution_mode, options_dict=options_dict,
@@ -369,7 +809,7 @@ class MomentumOptimizer(Optimizer):
         return
 
     def apply_gradient(self, x, gradient, i_batch, step_size=0.001, gamma=0.9, use_numpy=False, params_slicer=None,
-                       **kwargs):
+                       v=None, **kwargs):
         """
         Use calculated gradient to update the variable being optimized.
         :param x: Array or Tensor of the optimized variable.
@@ -381,51 +821,37 @@ class MomentumOptimizer(Optimizer):
             gradient.
         """
         ss = self.get_array_slicer(params_slicer)
-        if self.distribution_mode == 'shared_file':
-            v = self.params_chunk_array_dict['v']
-        else:
-            v = self.params_whole_array_dict['v'][ss]
-            device_0 = w.get_var_device(v)
-            device_type_0 = w.get_var_device_type(v)
-            if w.get_var_device_type(x) == 'cuda':
-                v = w.to_gpu(v, w.get_var_device(x))
-            else:
-                v = w.to_cpu(v)
-        g = self.convert_gradient(gradient)
-        v = gamma * v + step_size * g
-        x = x - v
-
-        if self.distribution_mode == 'shared_file':
-            self.params_chunk_array_dict['v'] = v
-        else:
-            if device_type_0 == 'cpu':
-                v = w.to_cpu(v)
+        g = self.convert_gradient(gradient, apply_scale=False)
+        if v is None:
+            if self.distribution_mode == 'shared_file':
+                v = self.params_chunk_array_dict['v']
             else:
-                v = w.to_gpu(v, device_0)
-            self.params_whole_array_dict['v'][ss] = v
+                for xs, ss_chunk in self.get_state_chunk_slicers(x, ss):
+                    (v,), copied_ls = self.get_param_arrays(x, ss_chunk, ['v'])
+                    # x and v are updated in place.
+                    apply_momentum_update_inplace(x[xs], g[xs], v, step_size=step_size, gamma=gamma,
+                                                  g_scale=self.get_gradient_scale())
+                    self.put_param_arrays(ss_chunk, ['v'], [v], copied_ls)
+                return x
+        apply_momentum_update_inplace(x, g, v, step_size=step_size, gamma=gamma, g_scale=self.get_gradient_scale())
         return x
 
+    def get_param_decay_rates(self, gamma=0.9, **kwargs):
+        return {'v': gamma}
+
     def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, gamma=0.9, **kwargs):
 
-        assert isinstance(obj, ObjectFunction)
-        assert isinstance(gradient, Gradient)
-        s = obj.dset.shape
-        slice_ls = range(rank, s[0], n_ranks)
-        if i_batch is None: i_batch = self.i_batch
+        def update_func(x, g, p_ls):
+            apply_momentum_update_inplace(x, g, p_ls[0], step_size=step_size, gamma=gamma)
 
-        backend_temp = global_settings.backend
-        global_settings.backend = 'autograd'
-        for i_slice in slice_ls:
-            x = obj.dset[i_slice]
-            g = gradient.dset[i_slice]
-            x = self.apply_gradient(x, g, i_batch, step_size=step_size, gamma=gamma)
-            obj.dset[i_slice] = x
+        self.stream_update_file(obj, gradient, update_func)
         self.i_batch += 1
-        global_settings.backend = backend_temp
 
 
 class GDOptimizer(Optimizer):
 
+    supports_sparse_update = True
+
     def __init__(self, name, output_folder='.', distribution_mode=None, options_dict=None, forward_model=None):
         super(GDOptimizer, self).__init__(name, output_folder=output_folder, params_list=[],
                                           distribution_mode=distribution_mode, options_dict=options_dict,
@@ -444,38 +870,29 @@ class GDOptimizer(Optimizer):
             Adam, i_batch may be preferably up-counted only when all voxels of the object are updated with non-zero
             gradient.
         """
-        g = self.convert_gradient(gradient)
+        g = self.convert_gradient(gradient, apply_scale=False)
         if dynamic_rate:
-            threshold_iteration = first_downrate_iteration
-            i = 1
-            while threshold_iteration < i_batch:
-                threshold_iteration += first_downrate_iteration * 2 ** i
-                i += 1
-                step_size /= 2.
-                if verbose:
-                    print_flush('  -- Step size halved.', 0, comm.Get_rank(), save_stdout=False)
-        x = x - step_size * g
+            step_size = get_gd_step_size(step_size, i_batch, first_downrate_iteration, verbose=verbose)
+        # x is updated in place.
+        apply_gd_update_inplace(x, g, step_size=step_size, g_scale=self.get_gradient_scale())
 
         return x
 
-    def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, dynamic_rate=True, first_downrate_iteration=92, **kwargs):
+    def get_param_decay_rates(self, **kwargs):
+        return {}
+
+    def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, dynamic_rate=True, first_downrate_iteration=92,
+                               **kwargs):
 
-        assert isinstance(obj, ObjectFunction)
-        assert isinstance(gradient, Gradient)
-        s = obj.dset.shape
-        slice_ls = range(rank, s[0], n_ranks)
         if i_batch is None: i_batch = self.i_batch
+        if dynamic_rate:
+            step_size = get_gd_step_size(step_size, i_batch, first_downrate_iteration)
 
-        backend_temp = global_settings.backend
-        global_settings.backend = 'autograd'
-        for i_slice in slice_ls:
-            x = obj.dset[i_slice]
-            g = gradient.dset[i_slice]
-            x = self.apply_gradient(x, g, i_batch, step_size=step_size,
-                                    dynamic_rate=dynamic_rate, first_downrate_iteration=first_downrate_iteration)
-            obj.dset[i_slice] = x
+        def update_func(x, g, p_ls):
+            apply_gd_update_inplace(x, g, step_size=step_size)
+
+        self.stream_update_file(obj, gradient, update_func)
         self.i_batch += 1
-        global_settings.backend = backend_temp
 
 
 class CurveballOptimizer(Optimizer):
@@ -496,18 +913,27 @@ class CurveballOptimizer(Optimizer):
         self.lmbda = 1
         self.z_chunk = None
         self.dz_chunk = None
+        # Gauss-Newton product of z_chunk, computed with dz and reused for beta and rho.
+        self.gz_chunk = None
+        self.pending_lambda_update = None
         return
 
+    def get_zeros_like(self, arr):
+        if isinstance(arr, np.ndarray):
+            return np.zeros_like(arr)
+        return w.zeros_like(arr, requires_grad=False)
+
     def calculate_dz(self, differentiator, use_numpy=False):
         """
         In DO, dz will be synchronized as Gradient class after this step.
         """
         assert isinstance(differentiator, adorym.Differentiator)
-        malias = np if use_numpy else w
         if self.z_chunk is None:
-            self.z_chunk = malias.zeros(differentiator.full_grad.shape)
+            self.z_chunk = self.get_zeros_like(differentiator.full_grad)
+        self.apply_pending_lambda_update(differentiator)
         print_flush('  Curveball damping factor lambda is {}.'.format(self.lmbda), 0, rank)
-        self.dz_chunk = differentiator.func_gvp(self.z_chunk) + self.lmbda * self.z_chunk + differentiator.full_grad
+        self.gz_chunk = differentiator.func_gvp(self.z_chunk)
+        self.dz_chunk = self.gz_chunk + self.lmbda * self.z_chunk + differentiator.full_grad
         return self.dz_chunk
 
     def calculate_beta_rho(self, differentiator, use_numpy=False):
@@ -515,20 +941,23 @@ class CurveballOptimizer(Optimizer):
         Parameters are calculated using chunks when working with DO. In DP mode, self.dz_chunk and
         self.z_chunk should match object size.
         """
-        malias = np if use_numpy else w
         assert isinstance(differentiator, adorym.Differentiator)
         if self.z_chunk is None:
-            self.z_chunk = malias.zeros(differentiator.full_grad.shape)
+            self.z_chunk = self.get_zeros_like(differentiator.full_grad)
         if self.dz_chunk is None:
-            self.dz_chunk = malias.zeros(differentiator.full_grad.shape)
-        a11 = malias.sum(self.dz_chunk * differentiator.func_gvp(self.dz_chunk))
-        a12 = malias.sum(self.z_chunk * differentiator.func_gvp(self.dz_chunk))
-        a22 = malias.sum(self.z_chunk * differentiator.func_gvp(self.z_chunk))
-        a11 = a11 + malias.sum(self.dz_chunk * self.dz_chunk) * self.lmbda
-        a12 = a12 + malias.sum(self.z_chunk * self.dz_chunk) * self.lmbda
-        a22 = a22 + malias.sum(self.z_chunk * self.z_chunk) * self.lmbda
-        b1 = malias.sum(differentiator.full_grad * self.dz_chunk)
-        b2 = malias.sum(differentiator.full_grad * self.z_chunk)
+            self.dz_chunk = self.get_zeros_like(differentiator.full_grad)
+        if self.gz_chunk is None:
+            self.gz_chunk = differentiator.func_gvp(self.z_chunk)
+        gdz_chunk = differentiator.func_gvp(self.dz_chunk)
+        a11 = get_dot_product(self.dz_chunk, gdz_chunk)
+        a12 = get_dot_product(self.z_chunk, gdz_chunk)
+        a22 = get_dot_product(self.z_chunk, self.gz_chunk)
+        self.gz_chunk = None
+        a11 = a11 + get_dot_product(self.dz_chunk, self.dz_chunk) * self.lmbda
+        a12 = a12 + get_dot_product(self.z_chunk, self.dz_chunk) * self.lmbda
+        a22 = a22 + get_dot_product(self.z_chunk, self.z_chunk) * self.lmbda
+        b1 = get_dot_product(differentiator.full_grad, self.dz_chunk)
+        b2 = get_dot_product(differentiator.full_grad, self.z_chunk)
         self.mat_a = np.array([[a11, a12], [a12, a22]])
         self.vec_b = np.array([[b1], [b2]])
         p = np.linalg.pinv(self.mat_a)
@@ -566,16 +995,39 @@ class CurveballOptimizer(Optimizer):
             Adam, i_batch may be preferably up-counted only when all voxels of the object are updated with non-zero
             gradient.
         """
-        ss = self.get_array_slicer(params_slicer)
+        ss = tuple(self.get_array_slicer(params_slicer))
         g = self.convert_gradient(gradient)
         z = self.calculate_update_vector(g, ss=ss)
         x = x + alpha * z
         return x
  
-    def update_lambda(self, forward_model, forward_args):
-        loss_0 = forward_model.current_loss
-        loss_1 = forward_model.get_loss_function()(**forward_args)
+    def update_lambda(self, forward_model, forward_args, x=None):
+        """
+        Schedule an update of the damping factor, which compares the change of loss made by the last step with the
+        change predicted by the quadratic model. The update is applied when the next step is linearized. If the next
+        step uses the same minibatch, the loss it computes is reused; otherwise, the loss function is evaluated once
+        with forward_args, where the optimized variable is replaced by x if x is given.
+        """
         d_loss_quad = -0.5 * (np.sum(np.matmul(np.linalg.pinv(self.mat_a), self.vec_b) * self.vec_b))
+        self.pending_lambda_update = (forward_model, forward_model.current_loss, d_loss_quad, forward_args, x)
+
+    def apply_pending_lambda_update(self, differentiator):
+        if self.pending_lambda_update is None:
+            return
+        forward_model, loss_0, d_loss_quad, forward_args, x = self.pending_lambda_update
+        self.pending_lambda_update = None
+        new_args = differentiator.linearization_args
+        if forward_args['this_i_theta'] == new_args['this_i_theta'] and \
+                np.array_equal(np.asarray(forward_args['this_ind_batch']), np.asarray(new_args['this_ind_batch'])):
+            loss_1 = forward_model.current_loss
+        else:
+            forward_args = dict(forward_args)
+            if x is not None:
+                forward_args[self.name] = x
+            current_loss = forward_model.current_loss
+            with w.no_grad():
+                loss_1 = float(forward_model.get_loss_function()(**forward_args))
+            forward_model.current_loss = current_loss
         gamma = (loss_1 - loss_0) / d_loss_quad
         print_flush('  Curveball fitting factor gamma is {}.'.format(gamma), 0, rank)
         if gamma > 1.5:
@@ -593,7 +1045,11 @@ class CGOptimizer(Optimizer):
         super(CGOptimizer, self).__init__(name, output_folder=output_folder, params_list=['descent_dir_old', 's'],
                                           distribution_mode=distribution_mode, options_dict=options_dict, forward_model=forward_model)
         self.i_line_search_step = 0
+        self.linesearch_time = 0.
         self._diag_precondition_t = None
+        # The line search is kept across steps, so that each search is warm-started from the last accepted step.
+        self._linesearch = None
+        self._linesearch_settings = None
         return
 
     def _calculate_PR_beta(self, ss, i_batch):
@@ -619,7 +1075,7 @@ class CGOptimizer(Optimizer):
         return beta
 
     def apply_gradient(self, x, gradient, i_batch=None, step_size=1., linesearch_type='adaptive', max_backtracking_iter=None,
-                       normalize_alpha=True, params_slicer=None):
+                       normalize_alpha=True, params_slicer=None, interpolation='cubic'):
         """
         Use calculated gradient to update the variable being optimized.
         :param x: Array or Tensor of the optimized variable.
@@ -629,8 +1085,10 @@ class CGOptimizer(Optimizer):
         :param i_batch: Int. User-specifiable step number. When minibatching localized data using optimizers like
             Adam, i_batch may be preferably up-counted only when all voxels of the object are updated with non-zero
             gradient.
+        :param interpolation: None, 'quadratic' or 'cubic'. How the line search picks the next trial step size
+            after a trial fails the sufficient decrease condition. See adorym.linesearch.LineSearch.
         """
-        ss = self.get_array_slicer(params_slicer)
+        ss = tuple(self.get_array_slicer(params_slicer))
         g = self.convert_gradient(gradient)
         try:
             forward_model = gradient.forward_model
@@ -650,9 +1108,13 @@ class CGOptimizer(Optimizer):
         else:
             _s_t = w.to_cpu(_s_t)
 
-        self._linesearch = self.linesearch_map[linesearch_type](maxiter=max_backtracking_iter,
-                                                                initial_stepsize=step_size,
-                                                                normalize_alpha=normalize_alpha)
+        linesearch_settings = (linesearch_type, max_backtracking_iter, step_size, normalize_alpha, interpolation)
+        if self._linesearch is None or self._linesearch_settings != linesearch_settings:
+            self._linesearch = self.linesearch_map[linesearch_type](maxiter=max_backtracking_iter,
+                                                                    initial_stepsize=step_size,
+                                                                    normalize_alpha=normalize_alpha,
+                                                                    interpolation=interpolation)
+            self._linesearch_settings = linesearch_settings
         this_i_batch = i_batch if i_batch is not None else self.i_batch
         beta = self._calculate_PR_beta(ss=ss, i_batch=this_i_batch)
         s_new = self._descent_dir_t + beta * _s_t
@@ -689,9 +1151,297 @@ class CGOptimizer(Optimizer):
         self.params_whole_array_dict['s'][ss] = s_new
         self.params_whole_array_dict['descent_dir_old'][ss] = self._descent_dir_t
         self.i_batch += 1
-        self.i_line_search_step += linesearch_out.step_count
+        self.i_line_search_step += linesearch_out.n_eval
+        self.linesearch_time += linesearch_out.eval_time
         return x
 
+class LBFGSOptimizer(Optimizer):
+    """
+    Limited-memory BFGS optimizer.
+
+    The last history_size update steps s_k = x_{k+1} - x_k and gradient changes y_k = g_{k+1} - g_k are kept as
+    optimizer parameters, so they are stored in the same containers as the parameters of other optimizers (arrays
+    in data parallelism mode, slabs in distributed_object mode, and HDF5 files in shared_file mode). The two-loop
+    recursion is carried out on the coefficients of the search direction in the basis [s_i, y_i, g] using the Gram
+    matrix of the basis. Only the dot products involving the newest pair and the current gradient are new at each
+    step, so a step needs one pass over the local part of the vectors to compute them (their partial sums are
+    reduced across ranks with a single allreduce) and one pass to apply the update.
+
+    In data parallelism mode, the step length is found with a line search in which the losses of all ranks are
+    summed. In distributed_object and shared_file mode, where the loss is not available without a forward pass
+    over all ranks, quasi-Newton steps are taken with unit length. In either case, a step made without history
+    (the first step, or a step after the history is reset) has a length of step_size.
+
+    Options are step_size, history_size (default 5), linesearch_type ('backtracking', 'adaptive', or None for no
+    line search) and max_backtracking_iter. The history is not saved in checkpoints, so the first step after
+    restarting from a checkpoint is a gradient descent step.
+    """
+
+    linesearch_map = {'backtracking': BackTrackingLineSearch,
+                      'adaptive': AdaptiveLineSearch}
+
+    def __init__(self, name, output_folder='.', distribution_mode=None, options_dict=None, forward_model=None):
+        history_size = 5
+        if options_dict is not None:
+            history_size = options_dict.get('history_size', history_size)
+        params_list = ['s_{}'.format(i) for i in range(history_size)] + \
+                      ['y_{}'.format(i) for i in range(history_size)] + ['g_prev']
+        super(LBFGSOptimizer, self).__init__(name, output_folder=output_folder, params_list=params_list,
+                                             distribution_mode=distribution_mode, options_dict=options_dict,
+                                             forward_model=forward_model)
+        self.history_size = history_size
+        # Slots holding valid (s, y) pairs, oldest first.
+        self.history_slots = []
+        # Slot whose s was written at the last step, and whose y is formed with the next gradient.
+        self.pending_slot = None
+        # Gram matrix of [s_0, ..., s_{m-1}, y_0, ..., y_{m-1}, g].
+        self.gram = np.zeros([2 * history_size + 1] * 2)
+        self.i_line_search_step = 0
+        self.linesearch_time = 0.
+        return
+
+    def reset_history(self):
+        self.history_slots = []
+        self.pending_slot = None
+
+    def get_basis_index(self, vec_type, i_slot=None):
+        if vec_type == 's':
+            return i_slot
+        elif vec_type == 'y':
+            return self.history_size + i_slot
+        return 2 * self.history_size
+
+    def process_blocks(self, blocks, read_func, compute_func, write_func):
+        # Files are read and written in a pipeline; arrays in memory are processed in place.
+        if self.distribution_mode == 'shared_file':
+            stream_blocks(blocks, read_func, compute_func, write_func)
+        else:
+            for sl in blocks:
+                write_func(sl, compute_func(sl, read_func(sl)))
+
+    def update_history(self, blocks, read_param_func, write_param_func, g_func):
+        """
+        Form the pending (s, y) pair with the current gradient, save the gradient for the next step, and
+        update the Gram matrix with the dot products between the new vectors and the basis.
+        :param blocks: List of slicers covering the local part of the vectors.
+        :param read_param_func: Function; read_param_func(param_name, sl) returns a block of an optimizer parameter.
+        :param write_param_func: Function; write_param_func(param_name, sl, arr) writes a block of an optimizer
+                                 parameter.
+        :param g_func: Function; g_func(sl) returns a block of the gradient.
+        """
+        p = self.pending_slot
+        new_ind_ls = [self.get_basis_index('g')]
+        if p is not None:
+            new_ind_ls = [self.get_basis_index('s', p), self.get_basis_index('y', p)] + new_ind_ls
+        old_ls = [(self.get_basis_index('s', i), 's_{}'.format(i)) for i in self.history_slots] + \
+                 [(self.get_basis_index('y', i), 'y_{}'.format(i)) for i in self.history_slots]
+        partial = np.zeros_like(self.gram)
+
+        def read_block(sl):
+            g = g_func(sl)
+            new_arr_ls = [g]
+            if p is not None:
+                new_arr_ls = [read_param_func('s_{}'.format(p), sl), g - read_param_func('g_prev', sl), g]
+            return new_arr_ls, [read_param_func(param_name, sl) for _, param_name in old_ls]
+
+        def compute_block(sl, data):
+            new_arr_ls, old_arr_ls = data
+            for (j, _), b in zip(old_ls, old_arr_ls):
+                for i, a in zip(new_ind_ls, new_arr_ls):
+                    partial[i, j] += get_dot_product(a, b)
+                    partial[j, i] = partial[i, j]
+            for k, (i, a) in enumerate(zip(new_ind_ls, new_arr_ls)):
+                for j, b in zip(new_ind_ls[k:], new_arr_ls[k:]):
+                    partial[i, j] += get_dot_product(a, b)
+                    partial[j, i] = partial[i, j]
+            return new_arr_ls
+
+        def write_block(sl, new_arr_ls):
+            if p is not None:
+                write_param_func('y_{}'.format(p), sl, new_arr_ls[1])
+            write_param_func('g_prev', sl, new_arr_ls[-1])
+
+        self.process_blocks(blocks, read_block, compute_block, write_block)
+        # In data parallelism mode, every rank holds the whole vectors.
+        if self.distribution_mode is not None and self.comm.Get_size() > 1:
+            partial = self.allreduce(partial, 'lbfgs_dot_allreduce')
+        for i in new_ind_ls:
+            self.gram[i, :] = partial[i, :]
+            self.gram[:, i] = partial[:, i]
+        if p is not None:
+            sy = self.gram[self.get_basis_index('s', p), self.get_basis_index('y', p)]
+            yy = self.gram[self.get_basis_index('y', p), self.get_basis_index('y', p)]
+            # Pairs violating the curvature condition are dropped to keep the inverse Hessian positive definite.
+            if yy > 0 and sy > 1e-10 * yy:
+                self.history_slots.append(p)
+        self.pending_slot = None
+
+    def get_direction_coefficients(self):
+        """
+        Run the two-loop recursion on basis coefficients, and return the coefficients of the search direction
+        -H * g.
+        """
+        gram = self.gram
+        i_g = self.get_basis_index('g')
+        q = np.zeros(gram.shape[0])
+        q[i_g] = 1.
+        a_ls = []
+        for i_slot in self.history_slots[::-1]:
+            i_s, i_y = self.get_basis_index('s', i_slot), self.get_basis_index('y', i_slot)
+            a = np.dot(gram[i_s], q) / gram[i_s, i_y]
+            q[i_y] -= a
+            a_ls.append(a)
+        gamma = 1.
+        if len(self.history_slots) > 0:
+            i_s, i_y = self.get_basis_index('s', self.history_slots[-1]), self.get_basis_index('y', self.history_slots[-1])
+            gamma = gram[i_s, i_y] / gram[i_y, i_y]
+        r = gamma * q
+        for i_slot, a in zip(self.history_slots, a_ls[::-1]):
+            i_s, i_y = self.get_basis_index('s', i_slot), self.get_basis_index('y', i_slot)
+            b = np.dot(gram[i_y], r) / gram[i_s, i_y]
+            r[i_s] += a - b
+        c = -r
+        # Round-off may make the direction ascending when the history is ill-conditioned.
+        if len(self.history_slots) > 0 and np.dot(c, gram[:, i_g]) >= 0:
+            print_flush('  L-BFGS direction is not a descent direction; history is reset.', 0, rank)
+            self.reset_history()
+            c = np.zeros(gram.shape[0])
+            c[i_g] = -1.
+        return c
+
+    def get_direction_block(self, c, g, basis_arr_dict):
+        d = g * float(c[self.get_basis_index('g')])
+        for i_slot in self.history_slots:
+            for vec_type in ('s', 'y'):
+                d = d + basis_arr_dict['{}_{}'.format(vec_type, i_slot)] * float(c[self.get_basis_index(vec_type, i_slot)])
+        return d
+
+    def get_basis_param_names(self):
+        return ['{}_{}'.format(vec_type, i_slot) for i_slot in self.history_slots for vec_type in ('s', 'y')]
+
+    def get_fixed_step_length(self, c, step_size):
+        if len(self.history_slots) > 0:
+            return 1.
+        d_norm = np.sqrt(max(np.dot(c, np.dot(self.gram, c)), 0))
+        return step_size / d_norm if d_norm > 0 else 0.
+
+    def get_next_slot(self):
+        if len(self.history_slots) == self.history_size:
+            return self.history_slots.pop(0)
+        return min(set(range(self.history_size)) - set(self.history_slots))
+
+    def reduce_loss(self, loss):
+        loss = float(loss)
+        if self.comm.Get_size() > 1:
+            loss = self.allreduce(loss, 'lbfgs_loss_allreduce')
+        return loss
+
+    def apply_gradient(self, x, gradient, i_batch=None, step_size=1., linesearch_type='backtracking',
+                       max_backtracking_iter=None, interpolation='cubic', use_numpy=False, params_slicer=None,
+                       **kwargs):
+        """
+        Use calculated gradient to update the variable being optimized. In distributed_object mode, this
+        method must be called by all ranks in the communicator of the optimizer, including those holding no
+        slab (with x = None).
+        :param x: Array or Tensor of the optimized variable.
+        :param gradient: Array or adorym.Gradient. In data parallelism mode, the ForwardModel instance (which is
+            needed for providing loss function for line search) can be supplied through the Gradient instance.
+            Otherwise, it must be specified when the optimizer is instantiated.
+        """
+        ss = self.get_array_slicer(params_slicer)
+        blocks = [] if x is None else [tuple(ss)]
+        g = None if x is None else self.convert_gradient(gradient)
+
+        def read_param_func(param_name, sl):
+            return self.params_whole_array_dict[param_name][sl]
+
+        def write_param_func(param_name, sl, arr):
+            self.params_whole_array_dict[param_name][sl] = arr
+
+        self.update_history(blocks, read_param_func, write_param_func, lambda sl: g)
+        c = self.get_direction_coefficients()
+        first_step = len(self.history_slots) == 0
+        s = None
+        if x is not None:
+            basis_arr_dict = {param_name: read_param_func(param_name, blocks[0])
+                              for param_name in self.get_basis_param_names()}
+            d = self.get_direction_block(c, g, basis_arr_dict)
+            if self.distribution_mode is None and linesearch_type is not None:
+                try:
+                    forward_model = gradient.forward_model
+                except:
+                    forward_model = self.forward_model
+                    if not isinstance(forward_model, adorym.ForwardModel):
+                        raise ValueError('ForwardModel must be supplied either through Gradient object or upon '
+                                         'optimizer instantiation.')
+                loss_kwargs = forward_model.loss_args
+                loss_fn = forward_model.get_loss_function()
+
+                def _loss_and_update_fn(x, y):
+                    update = x + y
+                    if self.name == 'probe':
+                        loss_kwargs['probe_real'] = update[:, :, :, 0]
+                        loss_kwargs['probe_imag'] = update[:, :, :, 1]
+                    else:
+                        loss_kwargs[self.name] = update
+                    return self.reduce_loss(loss_fn(**loss_kwargs)), update
+
+                linesearch = self.linesearch_map[linesearch_type](maxiter=max_backtracking_iter,
+                                                                  initial_stepsize=step_size if first_step else 1.,
+                                                                  normalize_alpha=first_step,
+                                                                  interpolation=interpolation)
+                linesearch_out = linesearch.search(_loss_and_update_fn, x0=x, descent_dir=d, gradient=g,
+                                                   f0=self.reduce_loss(forward_model.current_loss))
+                s = linesearch_out.newx - x
+                x = linesearch_out.newx
+                self.i_line_search_step += linesearch_out.n_eval
+                self.linesearch_time += linesearch_out.eval_time
+            else:
+                s = d * self.get_fixed_step_length(c, step_size)
+                x = x + s
+        i_slot = self.get_next_slot()
+        if s is not None:
+            write_param_func('s_{}'.format(i_slot), blocks[0], s)
+        self.pending_slot = i_slot
+        self.i_batch += 1
+        return x
+
+    def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=1., **kwargs):
+        """
+        Update the slices of obj owned by this rank with a quasi-Newton step of unit length. All ranks must call
+        this method.
+        """
+        assert isinstance(obj, ObjectFunction)
+        assert isinstance(gradient, Gradient)
+        blocks = self.get_file_update_blocks(obj.dset.shape[0])
+        g_scale = self.get_file_gradient_scale()
+
+        self.update_history(blocks, self.get_param_slice_from_file, self.write_param_to_file,
+                            lambda sl: gradient.dset[sl] * g_scale)
+        self.params_dset_written = True
+        c = self.get_direction_coefficients()
+        alpha = self.get_fixed_step_length(c, step_size)
+        basis_param_names = self.get_basis_param_names()
+        i_slot = self.get_next_slot()
+
+        def read_block(sl):
+            return obj.dset[sl], gradient.dset[sl] * g_scale, \
+                   {param_name: self.read_param_from_file(param_name, sl) for param_name in basis_param_names}
+
+        def compute_block(sl, data):
+            x, g, basis_arr_dict = data
+            s = self.get_direction_block(c, g, basis_arr_dict) * alpha
+            return x + s, s
+
+        def write_block(sl, data):
+            x, s = data
+            obj.dset[sl] = x
+            self.write_param_to_file('s_{}'.format(i_slot), sl, s)
+
+        self.process_blocks(blocks, read_block, compute_block, write_block)
+        self.pending_slot = i_slot
+        self.i_batch += 1
+
 class ScipyOptimizer(Optimizer):
     """
     API binding to scopy.optimizer.minimize. WORKS FOR DATA-PARALLELISM MODE AND AUTOGRAD ONLY.
@@ -729,11 +1479,235 @@ class ScipyOptimizer(Optimizer):
             hvp = differentiator.func_gvp(_x)
             hvp = np.reshape(hvp, [-1])
             return hvp
+        import scipy.optimize
         x = scipy.optimize.minimize(fun, w.reshape(x, [-1]), method=method, jac=jac, hessp=hessp, options=options)
         x = x.x
         x = w.reshape(x, shape_0)
         return x
 
+def _iter_slab_chunks(arr, max_chunk_bytes=2 ** 25):
+    """
+    Yield slicers that split a NumPy array into chunks along its first axis, each no larger than
+    max_chunk_bytes (but at least one slab), so that update kernels only need chunk-sized scratch buffers.
+    """
+    if arr.ndim == 0:
+        yield Ellipsis
+        return
+    slab_bytes = max(get_nbytes(arr[0:1]), 1)
+    n_slabs = max(int(max_chunk_bytes // slab_bytes), 1)
+    for i in range(0, arr.shape[0], n_slabs):
+        yield slice(i, min(i + n_slabs, arr.shape[0]))
+
+
+def get_dot_product(a, b):
+    """
+    Dot product of two arrays or tensors of the same shape, returned as a Python float.
+    """
+    if isinstance(a, np.ndarray):
+        return float(np.dot(a.ravel(), b.ravel()))
+    return float(w.sum(a * b))
+
+
+def get_nbytes(arr):
+    if isinstance(arr, np.ndarray):
+        return arr.nbytes
+    return arr.element_size() * arr.nelement()
+
+
+def get_state_storage_dtype(state_dtype):
+    """
+    Get the data type of the arrays or datasets that store optimizer parameters of the given state_dtype.
+    bfloat16 values are stored as the upper 16 bits of their float32 representation in int16.
+    """
+    if state_dtype == 'bfloat16':
+        return 'int16'
+    return state_dtype
+
+
+def get_state_row_scale(arr, target=2. ** 14):
+    """
+    Get power-of-two factors for each slice of arr along the first axis that bring the maximum magnitude of
+    the slice to at most target when storing it in float16. Slices of zeros get inf.
+    """
+    if isinstance(arr, np.ndarray):
+        a_max = np.abs(arr).reshape([arr.shape[0], -1]).max(axis=1)
+    else:
+        a_max = w.to_numpy(arr.abs().reshape([arr.shape[0], -1]).amax(dim=1))
+    with np.errstate(divide='ignore'):
+        return 2. ** np.floor(np.log2(target / a_max.astype('float64')))
+
+
+def encode_optimizer_state(arr, state_dtype, row_scale=None, stochastic_rounding=True, rng=None):
+    """
+    Convert a float32 array or tensor of optimizer parameters to its bfloat16 or float16 storage format.
+    :param row_scale: None or 1-D array. Factors that slices along the first axis are multiplied with before
+                      being cast to float16.
+    :param stochastic_rounding: Bool. If True, values are rounded up or down randomly with probabilities given
+                                by their distance to the two neighbouring representable values, so that
+                                rounding errors do not accumulate over many small updates.
+    """
+    # Number of low-order float32 mantissa bits that do not fit into the storage format.
+    n_dropped = 16 if state_dtype == 'bfloat16' else 13
+    if isinstance(arr, np.ndarray):
+        a = np.array(arr, dtype=np.float32, copy=True)
+        if row_scale is not None:
+            a *= row_scale.astype(np.float32).reshape([-1] + [1] * (a.ndim - 1))
+        bits = a.view(np.uint32)
+        if stochastic_rounding:
+            rng = rng if rng is not None else np.random.default_rng()
+            bits += rng.integers(0, 2 ** n_dropped, size=bits.shape, dtype=np.uint32)
+        elif state_dtype == 'bfloat16':
+            # Round to nearest even.
+            bits += np.uint32(2 ** (n_dropped - 1) - 1) + ((bits >> n_dropped) & np.uint32(1))
+        if state_dtype == 'bfloat16':
+            return (bits >> 16).astype(np.uint16).view(np.int16)
+        if stochastic_rounding:
+            bits &= ~np.uint32(2 ** n_dropped - 1)
+        return a.astype(np.float16)
+    else:
+        tc = w.tc
+        a = arr.to(tc.float32, copy=True)
+        if row_scale is not None:
+            a.mul_(tc.as_tensor(row_scale, dtype=tc.float32, device=a.device).reshape([-1] + [1] * (a.ndim - 1)))
+        bits = a.view(tc.int32)
+        if stochastic_rounding:
+            bits.add_(tc.randint_like(bits, 0, 2 ** n_dropped))
+        elif state_dtype == 'bfloat16':
+            bits.add_((bits >> n_dropped).bitwise_and_(1).add_(2 ** (n_dropped - 1) - 1))
+        if state_dtype == 'bfloat16':
+            return (bits >> 16).to(tc.int16)
+        if stochastic_rounding:
+            bits.bitwise_and_(~(2 ** n_dropped - 1))
+        return a.half()
+
+
+def decode_optimizer_state(stored, state_dtype, row_scale=None):
+    """
+    Convert optimizer parameters in bfloat16 or float16 storage format back to float32.
+    """
+    if isinstance(stored, np.ndarray):
+        if state_dtype == 'bfloat16':
+            a = (stored.view(np.uint16).astype(np.uint32) << np.uint32(16)).view(np.float32)
+        else:
+            a = stored.astype(np.float32)
+        if row_scale is not None:
+            a /= row_scale.astype(np.float32).reshape([-1] + [1] * (a.ndim - 1))
+    else:
+        tc = w.tc
+        if state_dtype == 'bfloat16':
+            a = (stored.to(tc.int32) << 16).view(tc.float32)
+        else:
+            a = stored.to(tc.float32)
+        if row_scale is not None:
+            a.div_(tc.as_tensor(row_scale, dtype=tc.float32, device=a.device).reshape([-1] + [1] * (a.ndim - 1)))
+    return a
+
+
+def apply_adam_update_inplace(x, g, m, v, i_batch, step_size=0.001, b1=0.9, b2=0.999, eps=1e-7, g_scale=1.):
+    """
+    Adam update that modifies x, m and v in place without allocating object-sized temporaries.
+    NumPy arrays are processed in chunks of slabs with a single chunk-sized scratch buffer;
+    PyTorch tensors use in-place tensor operations with one temporary for the denominator.
+    :param step_size: Float, or array of the same shape as x holding the step size of each element.
+    :param g_scale: Float. Factor the gradient is multiplied with before being used.
+    """
+    q1 = 1 - b1 ** (i_batch + 1)
+    q2 = 1 - b2 ** (i_batch + 1)
+    if isinstance(x, np.ndarray):
+        buf = None
+        for sl in _iter_slab_chunks(x):
+            x_c, g_c, m_c, v_c = x[sl], g[sl], m[sl], v[sl]
+            if buf is None or buf.shape != x_c.shape:
+                buf = np.empty_like(x_c)
+            # First moment estimate.
+            np.multiply(g_c, (1 - b1) * g_scale, out=buf)
+            m_c *= b1
+            m_c += buf
+            # Second moment estimate.
+            np.multiply(g_c, g_scale, out=buf)
+            np.square(buf, out=buf)
+            buf *= (1 - b2)
+            v_c *= b2
+            v_c += buf
+            # Bias-corrected step.
+            np.divide(v_c, q2, out=buf)
+            np.sqrt(buf, out=buf)
+            buf += eps
+            np.divide(m_c, buf, out=buf)
+            if np.isscalar(step_size):
+                buf *= step_size / q1
+            else:
+                buf *= step_size[sl]
+                buf /= q1
+            x_c -= buf
+    else:
+        with w.no_grad(override_backend='pytorch'):
+            m.mul_(b1).add_(g, alpha=(1 - b1) * g_scale)
+            v.mul_(b2).addcmul_(g, g, value=(1 - b2) * g_scale ** 2)
+            denom = (v / q2).sqrt_().add_(eps)
+            if np.isscalar(step_size):
+                x.addcdiv_(m, denom, value=-step_size / q1)
+            else:
+                x.addcmul_(m / denom, step_size, value=-1. / q1)
+            del denom
+    return x, m, v
+
+
+def apply_momentum_update_inplace(x, g, v, step_size=0.001, gamma=0.9, g_scale=1.):
+    """
+    Momentum update that modifies x and v in place without allocating object-sized temporaries.
+    """
+    if isinstance(x, np.ndarray):
+        buf = None
+        for sl in _iter_slab_chunks(x):
+            x_c, g_c, v_c = x[sl], g[sl], v[sl]
+            if buf is None or buf.shape != x_c.shape:
+                buf = np.empty_like(x_c)
+            np.multiply(g_c, step_size * g_scale, out=buf)
+            v_c *= gamma
+            v_c += buf
+            x_c -= v_c
+    else:
+        with w.no_grad(override_backend='pytorch'):
+            v.mul_(gamma).add_(g, alpha=step_size * g_scale)
+            x.sub_(v)
+    return x, v
+
+
+def apply_gd_update_inplace(x, g, step_size=0.001, g_scale=1.):
+    """
+    Gradient descent update that modifies x in place without allocating object-sized temporaries.
+    """
+    if isinstance(x, np.ndarray):
+        buf = None
+        for sl in _iter_slab_chunks(x):
+            x_c, g_c = x[sl], g[sl]
+            if buf is None or buf.shape != x_c.shape:
+                buf = np.empty_like(x_c)
+            np.multiply(g_c, step_size * g_scale, out=buf)
+            x_c -= buf
+    else:
+        with w.no_grad(override_backend='pytorch'):
+            x.add_(g, alpha=-step_size * g_scale)
+    return x
+
+
+def get_gd_step_size(step_size, i_batch, first_downrate_iteration=92, verbose=False):
+    """
+    Get the step size of GD with dynamic rate, which is halved after first_downrate_iteration iterations,
+    and then every time the number of iterations after that doubles.
+    """
+    threshold_iteration = first_downrate_iteration
+    i = 1
+    while threshold_iteration < i_batch:
+        threshold_iteration += first_downrate_iteration * 2 ** i
+        i += 1
+        step_size /= 2.
+        if verbose:
+            print_flush('  -- Step size halved.', 0, comm.Get_rank(), save_stdout=False)
+    return step_size
+
+
 def apply_gradient_adam(x, g, i_batch, m=None, v=None, step_size=0.001, b1=0.9, b2=0.999, eps=1e-7, **kwargs):
 
     g = np.array(g)
@@ -966,10 +1940,11 @@ def update_parameter_gradients(opt_ls, grads, use_numpy=False):
         if opt.name == 'obj':
             continue
         elif opt.name == 'probe':
+            i = opt.index_in_grad_returns
             if not use_numpy:
-                opt.grads += w.stack(grads[1:3], axis=-1)
+                opt.grads += w.stack(grads[i:i + 2], axis=-1)
             else:
-                g = w.to_numpy(w.stack(grads[1:3], axis=-1))
+                g = w.to_numpy(w.stack(grads[i:i + 2], axis=-1))
                 opt.grads = opt.grads + g
         else:
             if not use_numpy:
@@ -979,6 +1954,7 @@ def update_parameter_gradients(opt_ls, grads, use_numpy=False):
     return opt_ls
 
 
+@timed()
 def update_parameters(opt_ls, optimizable_params, kwargs):
 
     i_epoch = kwargs['i_epoch']
@@ -991,93 +1967,313 @@ def update_parameters(opt_ls, optimizable_params, kwargs):
     stdout_options = kwargs['stdout_options']
     forward_model = kwargs['forward_model']
     device = kwargs['device_obj']
+    param_group = kwargs.get('param_group', None)
+    param_scheduler = kwargs.get('param_scheduler', None)
+    sync = kwargs.get('sync', None)
 
     if probe_update_limit is None:
         probe_update_limit = np.inf
 
+    active_opt_ls = []
     for opt in opt_ls:
 
         if opt.forward_model is None:
             opt.forward_model = forward_model
-        if isinstance(opt, CurveballOptimizer):
-            diff = kwargs['diff']
-            diff.get_l_h_hessian_and_h_x_jacobian_mvps(forward_model, 0, **forward_model.loss_args)
-            opt.calculate_dz(diff, use_numpy=True)
-            opt.calculate_beta_rho(diff, use_numpy=True)
-            opt.update_lambda(forward_model, forward_model.loss_args)
-
         if opt.name == 'obj':
             continue
+        elif param_scheduler is not None and not param_scheduler.is_due(opt):
+            continue
         elif opt.name == 'probe':
             if i_batch + i_epoch * n_batch >= probe_update_delay and i_batch + i_epoch * n_batch < probe_update_limit:
-                with w.no_grad():
-                    opt.grads = comm.allreduce(w.to_numpy(opt.grads))
-                    opt.grads = w.create_variable(opt.grads, requires_grad=False, device=device)
-                    probe_temp = opt.apply_gradient(w.stack([optimizable_params['probe_real'], optimizable_params['probe_imag']], axis=-1), opt.grads,
-                                                          i_full_angle, **opt.options_dict)
-                    optimizable_params['probe_real'], optimizable_params['probe_imag'] = w.split_channel(probe_temp)
-                    del opt.grads, probe_temp
-                w.reattach(optimizable_params['probe_real'])
-                w.reattach(optimizable_params['probe_imag'])
+                active_opt_ls.append(opt)
             else:
                 print_flush('  Probe is not updated because current batch is out of the specified range ({}, {}).'.format(
                     probe_update_delay, probe_update_limit), 0, rank, **stdout_options)
 
         elif i_batch + i_epoch * n_batch >= other_params_update_delay:
-
-            if opt.name == 'probe_pos_correction':
-                with w.no_grad():
-                    opt.grads = comm.allreduce(w.to_numpy(opt.grads))
-                    opt.grads = w.create_variable(opt.grads, requires_grad=False, device=device)
-                    probe_pos_correction = optimizable_params['probe_pos_correction']
-                    probe_pos_correction = opt.apply_gradient(probe_pos_correction, opt.grads, i_full_angle,
-                                                                        **opt.options_dict)
-                    # Prevent position drifting
-                    slicer = tuple(range(len(probe_pos_correction.shape) - 1))
-                    optimizable_params['probe_pos_correction'] = probe_pos_correction - w.mean(probe_pos_correction, axis=slicer)
-                w.reattach(optimizable_params['probe_pos_correction'])
-
-            elif opt.name == 'slice_pos_cm_ls':
-                with w.no_grad():
-                    opt.grads = comm.allreduce(w.to_numpy(opt.grads))
-                    opt.grads = w.create_variable(opt.grads, requires_grad=False, device=device)
-                    slice_pos_cm_ls = optimizable_params['slice_pos_cm_ls']
-                    slice_pos_cm_ls = opt.apply_gradient(slice_pos_cm_ls, opt.grads, i_full_angle,
-                                                                   **opt.options_dict)
-                    # Prevent position drifting
-                    optimizable_params['slice_pos_cm_ls'] = slice_pos_cm_ls - slice_pos_cm_ls[0]
-                w.reattach(optimizable_params['slice_pos_cm_ls'])
-
-            elif opt.name == 'prj_affine_ls':
-                with w.no_grad():
-                    opt.grads = comm.allreduce(w.to_numpy(opt.grads))
-                    opt.grads = w.create_variable(opt.grads, requires_grad=False, device=device)
-                    optimizable_params['prj_affine_ls'] = opt.apply_gradient(optimizable_params['prj_affine_ls'], opt.grads, i_full_angle,
-                                                                  **opt.options_dict)
-                    # Regularize transformation of image 0.
-                    optimizable_params['prj_affine_ls'][0, 0, 0] = 1.
-                    optimizable_params['prj_affine_ls'][0, 0, 1] = 0.
-                    optimizable_params['prj_affine_ls'][0, 0, 2] = 0.
-                    optimizable_params['prj_affine_ls'][0, 1, 0] = 0.
-                    optimizable_params['prj_affine_ls'][0, 1, 1] = 1.
-                    optimizable_params['prj_affine_ls'][0, 1, 2] = 0.
-                w.reattach(optimizable_params['prj_affine_ls'])
-
-            else:
-                with w.no_grad():
-                    opt.grads = comm.allreduce(w.to_numpy(opt.grads))
-                    opt.grads = w.create_variable(opt.grads, requires_grad=False, device=device)
-                    var = optimizable_params[opt.name]
-                    optimizable_params[opt.name] = opt.apply_gradient(var, opt.grads, i_full_angle, **opt.options_dict)
-                w.reattach(optimizable_params[opt.name])
+            active_opt_ls.append(opt)
 
         else:
             print_flush(
                 'Params are not updated because current epoch is smaller than specified delay ({}).'.format(
                     other_params_update_delay), 0, rank, **stdout_options)
+
+    if param_group is not None:
+        param_group.step(optimizable_params, active_opt_ls, i_full_angle, sync=sync)
+    else:
+        for opt in active_opt_ls:
+            with timer(opt.name), w.no_grad():
+                with timer('allreduce'):
+                    if sync is not None:
+                        opt.grads = sync.allreduce(w.to_numpy(opt.grads), 'param_grad_allreduce')
+                    else:
+                        opt.grads = comm.allreduce(w.to_numpy(opt.grads))
+                opt.grads = w.create_variable(opt.grads, requires_grad=False, device=device)
+                var = get_optimizable_parameter(optimizable_params, opt.name)
+                var = opt.apply_gradient(var, opt.grads, i_full_angle, **opt.options_dict)
+                var = apply_parameter_projection(opt.name, var)
+            set_optimizable_parameter(optimizable_params, opt.name, var)
+    if param_scheduler is not None:
+        param_scheduler.finish_update_step()
     return optimizable_params
 
 
+class ParameterUpdateScheduler(object):
+    """
+    Schedules the updates of the optimizable parameters other than the object function according to the update
+    period and gradient policy of their optimizers (see Optimizer.set_update_schedule). For each minibatch, it
+    builds the list of arguments whose gradients are requested from the differentiator, so that the gradients of
+    parameters that are not going to be updated are not calculated.
+
+    :param opt_ls: List of adorym.Optimizer, the first being the optimizer of the object function.
+    :param opt_args_ls: List of Int. Indices of all optimizable arguments, as returned by
+                        create_and_initialize_parameter_optimizers.
+    :param update_schedule: Dict. Update schedule overriding that of the optimizers, keyed by optimizer name.
+                            Values are either the update period or a tuple of (period, gradient_policy).
+    """
+    def __init__(self, opt_ls, opt_args_ls, update_schedule=None):
+        self.opt_ls = [opt for opt in opt_ls if opt.name != 'obj']
+        self.i_update_step = 0
+        self.arg_index_dict = {}
+        for opt in self.opt_ls:
+            n_args = 2 if opt.name == 'probe' else 1
+            self.arg_index_dict[opt.name] = opt_args_ls[opt.index_in_grad_returns:opt.index_in_grad_returns + n_args]
+        if update_schedule is not None:
+            for name, schedule in update_schedule.items():
+                opt = self.get_optimizer(name)
+                if isinstance(schedule, (tuple, list)):
+                    opt.set_update_schedule(*schedule)
+                else:
+                    opt.set_update_schedule(schedule)
+        # Names of parameters which have seen the last batch of an angle since their last update.
+        self.angle_done_set = set()
+        # Optimizers whose gradient buffers must be zeroed before the next accumulation.
+        self.reset_opt_ls = list(self.opt_ls)
+
+    def get_optimizer(self, name):
+        for opt in self.opt_ls:
+            if opt.name == name:
+                return opt
+        raise ValueError('{} is not an optimizable parameter.'.format(name))
+
+    def is_due(self, opt):
+        """
+        Whether the parameter is updated in the current update step.
+        """
+        if opt.update_period == 'angle':
+            return opt.name in self.angle_done_set
+        return (self.i_update_step + 1) % opt.update_period == 0
+
+    def prepare_batch(self, is_last_batch_of_this_theta):
+        """
+        Select the parameters whose gradients are calculated for the current minibatch, and set the indices of
+        their gradients in the list returned by the differentiator.
+        :return: The list of argument indices to be passed to Differentiator.set_opt_args_ls, and the list of
+                 optimizers to be passed to update_parameter_gradients.
+        """
+        opt_args_ls = [0]
+        grad_opt_ls = []
+        for opt in self.opt_ls:
+            if opt.update_period == 'angle':
+                requested = opt.gradient_policy == 'accumulate' or is_last_batch_of_this_theta
+                if is_last_batch_of_this_theta:
+                    self.angle_done_set.add(opt.name)
+            else:
+                requested = opt.gradient_policy == 'accumulate' or self.is_due(opt)
+            if requested:
+                opt.set_index_in_grad_return(len(opt_args_ls))
+                opt_args_ls = opt_args_ls + self.arg_index_dict[opt.name]
+                grad_opt_ls.append(opt)
+        return opt_args_ls, grad_opt_ls
+
+    def finish_update_step(self):
+        for opt in self.opt_ls:
+            if self.is_due(opt):
+                self.reset_opt_ls.append(opt)
+                self.angle_done_set.discard(opt.name)
+        self.i_update_step += 1
+
+    def pop_reset_opt_ls(self):
+        """
+        Get the optimizers whose gradient buffers must be zeroed before accumulating the gradients of a new update
+        step, i.e. those updated in the last update step.
+        """
+        opt_ls = self.reset_opt_ls
+        self.reset_opt_ls = []
+        return opt_ls
+
+
+class ParameterGroupOptimizer(object):
+    """
+    Updates the optimizable parameters other than the object function as one group. The gradients of all members
+    are packed into one flat buffer, which is reduced across ranks with a single allreduce and moved to the device
+    once. Members using AdamOptimizer are updated with one fused Adam step (one for each set of b1, b2 and eps) on
+    flat buffers of the parameters and moments, with the step size of each member broadcast over its segment;
+    other members are updated with their own optimizers. After the update, the projection registered for each
+    member with register_parameter_projection is applied.
+
+    :param opt_ls: List of adorym.Optimizer. The optimizer of the object function is skipped.
+    :param device: Device object of the parameters.
+    """
+    def __init__(self, opt_ls, device=None):
+        self.opt_ls = [opt for opt in opt_ls if opt.name != 'obj']
+        self.device = device
+        # Flat moments of fused members, keyed by Adam settings and dtype.
+        self.fused_state_dict = {}
+
+    def get_fused_key(self, opt):
+        if type(opt) is not AdamOptimizer or opt.is_state_encoded() or opt.get_gradient_scale() != 1:
+            return None
+        options = opt.options_dict if opt.options_dict is not None else {}
+        return (options.get('b1', 0.9), options.get('b2', 0.999), options.get('eps', 1e-7))
+
+    def pack(self, arr_ls, dtype):
+        return w.concatenate([w.reshape(w.cast(arr, dtype) if w.get_dtype(arr) != dtype else arr, [-1])
+                              for arr in arr_ls])
+
+    def unpack(self, flat, like_ls):
+        arr_ls = []
+        i = 0
+        for like in like_ls:
+            n = int(np.prod(like.shape))
+            arr = w.reshape(flat[i:i + n], list(like.shape))
+            if w.get_dtype(like) != w.get_dtype(flat):
+                arr = w.cast(arr, w.get_dtype(like))
+            arr_ls.append(arr)
+            i += n
+        return arr_ls
+
+    @timed()
+    def reduce_gradients(self, active_opt_ls, sync=None):
+        """
+        :param sync: adorym.SyncCounter in which the wait time of the allreduce is counted.
+        """
+        grads_ls = [opt.grads for opt in active_opt_ls]
+        dtype = 'float64' if any(w.get_dtype(g) == 'float64' for g in grads_ls) else 'float32'
+        if sync is not None:
+            flat = sync.allreduce(w.to_numpy(self.pack(grads_ls, dtype)), 'param_grad_allreduce')
+        else:
+            flat = comm.allreduce(w.to_numpy(self.pack(grads_ls, dtype)))
+        flat = w.create_variable(flat, dtype=dtype, requires_grad=False, device=self.device)
+        return self.unpack(flat, grads_ls)
+
+    def get_fused_state(self, key, member_ls, dtype):
+        """
+        Get the flat moments of the fused members. When the set of members changes (e.g. when the probe update
+        starts or stops), the moments of the previous set are written back to the member optimizers first.
+        """
+        names = [opt.name for opt, _ in member_ls]
+        state = self.fused_state_dict.get(key, None)
+        if state is not None and state['names'] == names:
+            return state
+        if state is not None:
+            for param_name in ('m', 'v'):
+                like_ls = [opt.params_whole_array_dict[param_name] for opt in state['opt_ls']]
+                for opt, arr in zip(state['opt_ls'], self.unpack(state[param_name], like_ls)):
+                    opt.params_whole_array_dict[param_name] = arr
+        opt_ls = [opt for opt, _ in member_ls]
+        step_size = np.concatenate([np.full(int(np.prod(g.shape)), opt.options_dict.get('step_size', 0.001))
+                                    for opt, g in member_ls])
+        state = {'names': names, 'opt_ls': opt_ls, 'dtype': dtype,
+                 'm': self.pack([opt.params_whole_array_dict['m'] for opt in opt_ls], dtype),
+                 'v': self.pack([opt.params_whole_array_dict['v'] for opt in opt_ls], dtype),
+                 'step_size': w.create_variable(step_size, dtype=dtype, requires_grad=False, device=self.device)}
+        self.fused_state_dict[key] = state
+        return state
+
+    def step(self, optimizable_params, active_opt_ls, i_batch, sync=None):
+        if len(active_opt_ls) == 0:
+            return
+        var_dict = {}
+        with w.no_grad():
+            grads_ls = self.reduce_gradients(active_opt_ls, sync=sync)
+            fused_dict = {}
+            for opt, g in zip(active_opt_ls, grads_ls):
+                opt.grads = g
+                key = self.get_fused_key(opt)
+                if key is None:
+                    var = get_optimizable_parameter(optimizable_params, opt.name)
+                    var_dict[opt.name] = opt.apply_gradient(var, g, i_batch, **opt.options_dict)
+                else:
+                    # Parameters are fused only with parameters of the same dtype.
+                    dtype = w.get_dtype(get_optimizable_parameter(optimizable_params, opt.name))
+                    fused_dict.setdefault(key + (dtype,), []).append((opt, g))
+            for (b1, b2, eps, dtype), member_ls in fused_dict.items():
+                state = self.get_fused_state((b1, b2, eps, dtype), member_ls, dtype)
+                var_ls = [get_optimizable_parameter(optimizable_params, opt.name) for opt, _ in member_ls]
+                x = self.pack(var_ls, dtype)
+                apply_adam_update_inplace(x, self.pack([g for _, g in member_ls], dtype), state['m'], state['v'],
+                                          i_batch, step_size=state['step_size'], b1=b1, b2=b2, eps=eps)
+                for (opt, _), var in zip(member_ls, self.unpack(x, var_ls)):
+                    # Segments are copied so that each parameter owns its memory.
+                    var_dict[opt.name] = var * 1
+                    opt.i_batch += 1
+            for opt in active_opt_ls:
+                var_dict[opt.name] = apply_parameter_projection(opt.name, var_dict[opt.name])
+        for opt in active_opt_ls:
+            set_optimizable_parameter(optimizable_params, opt.name, var_dict[opt.name])
+
+
+def get_optimizable_parameter(optimizable_params, name):
+    if name == 'probe':
+        return w.stack([optimizable_params['probe_real'], optimizable_params['probe_imag']], axis=-1)
+    return optimizable_params[name]
+
+
+def set_optimizable_parameter(optimizable_params, name, var):
+    if name == 'probe':
+        optimizable_params['probe_real'], optimizable_params['probe_imag'] = w.split_channel(var)
+        w.reattach(optimizable_params['probe_real'])
+        w.reattach(optimizable_params['probe_imag'])
+    else:
+        optimizable_params[name] = var
+        w.reattach(optimizable_params[name])
+
+
+# Projections applied to optimizable parameters after each update, keyed by parameter name.
+parameter_projection_hooks = {}
+
+
+def register_parameter_projection(name, func):
+    """
+    Register a projection applied to an optimizable parameter after each update, e.g. to remove drift.
+    :param name: String. Name of the parameter (same as the name of its optimizer).
+    :param func: Function that takes the updated parameter and returns the projected parameter.
+    """
+    parameter_projection_hooks[name] = func
+
+
+def apply_parameter_projection(name, var):
+    if name in parameter_projection_hooks:
+        return parameter_projection_hooks[name](var)
+    return var
+
+
+def remove_probe_pos_drift(probe_pos_correction):
+    slicer = tuple(range(len(probe_pos_correction.shape) - 1))
+    return probe_pos_correction - w.mean(probe_pos_correction, axis=slicer)
+
+
+def remove_slice_pos_drift(slice_pos_cm_ls):
+    return slice_pos_cm_ls - slice_pos_cm_ls[0]
+
+
+def fix_first_prj_affine(prj_affine_ls):
+    # Regularize transformation of image 0.
+    prj_affine_ls[0, 0, 0] = 1.
+    prj_affine_ls[0, 0, 1] = 0.
+    prj_affine_ls[0, 0, 2] = 0.
+    prj_affine_ls[0, 1, 0] = 0.
+    prj_affine_ls[0, 1, 1] = 1.
+    prj_affine_ls[0, 1, 2] = 0.
+    return prj_affine_ls
+
+
+register_parameter_projection('probe_pos_correction', remove_probe_pos_drift)
+register_parameter_projection('slice_pos_cm_ls', remove_slice_pos_drift)
+register_parameter_projection('prj_affine_ls', fix_first_prj_affine)
+
+
 def create_parameter_output_folders(opt_ls, output_folder):
 
     for opt in opt_ls:
@@ -1,21 +1,13 @@
 import numpy as np
-import dxchange
 import h5py
 import warnings
 import time
 import datetime
 from math import ceil, floor
-
-try:
-    import sys
-    from scipy.ndimage import gaussian_filter
-    from scipy.ndimage import fourier_shift
-except:
-    warnings.warn('Some dependencies are screwed up.')
+import sys
 import os
 import pickle
 import glob
-from scipy.special import erf
 
 from adorym.constants import *
 import adorym.wrappers as w
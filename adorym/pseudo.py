@@ -1,3 +1,5 @@
+import os
+
 # A pseudo Horovod class in case Horovod cannot be imported.
 
 class Hvd(object):
@@ -53,8 +55,24 @@ class Comm():
     def Allreduce(self, a):
         return a
 
+    def allgather(self, a):
+        return [a]
+
+    def Split(self, color=0, key=0):
+        return self
+
+
+def get_comm_world():
+    """
+    Return a LocalComm if this process was started by adorym-run, or a single-rank Comm otherwise.
+    """
+    if os.environ.get('ADORYM_LOCAL_RANK') is not None:
+        from adorym.local_comm import LocalComm
+        return LocalComm.from_environ()
+    return Comm()
+
 
 class MPI(object):
 
-    COMM_WORLD = Comm()
+    COMM_WORLD = get_comm_world()
 
@@ -1,5 +1,4 @@
 import numpy as np
-import dxchange
 import time
 import datetime
 import os
@@ -10,6 +9,7 @@ import pickle
 
 from adorym.util import *
 from adorym.misc import *
+from adorym.timing import *
 from adorym.propagate import *
 from adorym.array_ops import *
 from adorym.optimizers import *
@@ -19,6 +19,10 @@ import adorym.global_settings as global_settings
 from adorym.forward_model import *
 from adorym.regularizers import *
 from adorym.conventional import *
+from adorym.local_comm import LocalComm
+from adorym.lazy import LazyModule
+
+dxchange = LazyModule('dxchange')
 
 project_config = check_config_indept_mpi()
 try:
@@ -64,7 +68,7 @@ def reconstruct_ptychography(
     optimize_object=True,
     # Keep True in most cases. Setting to False forbids the object from being updated using gradients, which
     # might be desirable when you just want to refine parameters for other reconstruction algorithms.
-    optimizer='adam', # Provide adorym.Optimizer type, or choose from 'gd' or 'adam' or 'curveball' or 'momentum' or 'cg'
+    optimizer='adam', # Provide adorym.Optimizer type, or choose from 'gd' or 'adam' or 'curveball' or 'momentum' or 'cg' or 'lbfgs'
     learning_rate=1e-5, # Ignored when optimizer is an adorym.Optimizer type
     update_using_external_algorithm=None,
     # Applies to optimizers that use the current batch number for calculation, such as Adam. If 'angle', batch
@@ -107,15 +111,43 @@ def reconstruct_ptychography(
     # |I/O|_________________________________________________________________
     save_path='.', output_folder=None, save_intermediate=False, save_intermediate_level='batch', save_history=False,
     store_checkpoint=True, use_checkpoint=True, force_to_use_checkpoint=False, n_batch_per_checkpoint=10,
+    async_checkpoint=True, # If True, checkpoints are copied to host buffers and written by a background thread.
+    checkpoint_format='npy', # Choose from 'npy' (full .npy files) or 'tiled' (manifest and compressed files of
+                             # the tiles changed since the last checkpoint).
+    checkpoint_tile_size=64,
+    do_output_format='hdf5', # Object output format in distributed_object mode. Choose from 'hdf5' (one file written
+                             # collectively by all ranks) or 'tiff' (one file per rank).
+    output_preview_downsample=None, # If given with do_output_format='hdf5', also output a preview of the object
+                                    # downsampled by this factor.
+    async_intermediate_output=True, # If True, intermediate output is converted and written by a background thread.
+    intermediate_queue_size=1, # Maximum number of intermediate outputs of each kind (object or parameters)
+                               # waiting to be written. When full, the oldest one of that kind is dropped.
     save_stdout=False,
     # _____________
     # |Performance|_________________________________________________________
     cpu_only=False, core_parallelization=True, gpu_index=0,
+    timing=False, # If True, time the main steps on each rank, and write the statistics and a Chrome trace to
+                  # [output_folder]/timing at the end.
+    memory_profiling=False, # If True, record the memory high-water marks of the timed steps (this also turns on
+                            # timing) and write them to [output_folder]/timing/memory.csv at the end.
     n_dp_batch=20,
     distribution_mode=None, # Choose from None (for data parallelism), 'shared_file', 'distributed_object'
     dist_mode_n_batch_per_update=None, # If None, object is updated only after all DPs on an angle are processed.
+    n_ranks_per_object_group=None,
+    # Applies to distributed_object mode only. If not None, the object is distributed among groups of this many
+    # ranks instead of all ranks, and each group holds a replica of the object that processes a different angle.
+    # Object gradients are summed across replicas before update. Must divide the number of ranks.
     precalculate_rotation_coords=True,
+    sparse_update=False,
+    sparse_update_tile_size=32,
+    # Applies to simple data parallelism and shared_file modes with Adam, Momentum, and GD. If True, the object
+    # and optimizer parameters are updated only in the tiles touched by the probe footprints of the batches
+    # since the last update; decay of Adam/momentum parameters in skipped tiles is applied lazily.
     cache_dtype='float32',
+    optimizer_state_dtype=None,
+    # Storage data type of object optimizer parameters (e.g., Adam moments). Choose from None (same as the object
+    # in distributed modes), 'float32', 'bfloat16', or 'float16'.
+    stochastic_rounding=True, # Use stochastic rounding when optimizer_state_dtype is 'bfloat16' or 'float16'.
     rotate_out_of_loop=False,
     n_split_mpi_ata='auto', # Number of segments that the arrays should be split into for MPI AlltoAll
     # Applies to simple data parallelism mode only. If True, DP will do rotation outside the loss function
@@ -137,6 +169,13 @@ def reconstruct_ptychography(
     optimize_tilt=False, tilt_learning_rate=1e-3, optimizer_tilt=None, initial_tilt=None,
     optimize_ctf_lg_kappa=False, ctf_lg_kappa_learning_rate=1e-3, optimizer_ctf_lg_kappa=None,
     other_params_update_delay=0,
+    fuse_parameter_updates=True, # If True, parameters other than the object are updated as one group, with a single
+                                 # gradient reduction and fused Adam steps.
+    update_schedule=None, # Dict. Update period of parameters other than the object, keyed by optimizer name (e.g.
+                          # {'probe': 4, 'probe_pos_correction': 'angle'}). Values are Int (update every N update
+                          # steps), 'angle' (once per angle), or a tuple of (period, gradient_policy), where
+                          # gradient_policy is 'sample' (default; gradient is only calculated in steps where the
+                          # parameter is updated) or 'accumulate' (gradient is summed over the period).
     # _________________________
     # |Alternative algorithms |_____________________________________________
     use_epie=False, epie_alpha=0.8,
@@ -149,6 +188,11 @@ def reconstruct_ptychography(
     # At the end of a batch, terminate the program with s tatus 0 if total time exceeds the set value.
     # Useful for working with supercomputers' job dependency system, where the dependent may start only
     # if the parent job exits with status 0.
+    max_n_batch=None,
+    # If not None, stop after this many batches have been processed in this run. The remaining batches of the
+    # epoch are skipped, and the epoch ends as usual (with output of the reconstruction). Useful for benchmarking.
+    random_seed=None,
+    # Seed of the random number generator, shared by all ranks. If None, it is derived from the current time.
     **kwargs,
     ):
   
@@ -170,8 +214,6 @@ def reconstruct_ptychography(
            To perform large fullfield reconstruction efficiently, divide the data into sub-chunks.
     """
 
-    breakpoint()
-
     t_zero = time.time()
 
     comm = MPI.COMM_WORLD
@@ -179,9 +221,13 @@ def reconstruct_ptychography(
     rank = comm.Get_rank()
     t_zero = time.time()
     global_settings.backend = backend
+    timers.reset()
+    timers.enable(timing or memory_profiling)
     device_obj = None if cpu_only else gpu_index
     device_obj = w.get_device(device_obj)
     w.set_device(device_obj)
+    timers.set_memory_profiler(MemoryProfiler(track_gpu=backend == 'pytorch' and not cpu_only)
+                               if memory_profiling else None)
 
 
     if rank == 0:
@@ -196,6 +242,27 @@ def reconstruct_ptychography(
         timestr = None
     timestr = comm.bcast(timestr, root=0)
 
+    if distribution_mode == 'shared_file' and isinstance(comm, LocalComm) and n_ranks > 1:
+        raise ValueError('distribution_mode = shared_file needs MPI-IO and cannot be used with adorym-run. Use '
+                         'mpirun, or choose distribution_mode = None or distributed_object.')
+
+    # ================================================================================
+    # Create sub-communicators for hybrid parallelism. obj_comm connects the ranks sharing
+    # an object; replica_comm connects the ranks holding the same slab in different
+    # replicas.
+    # ================================================================================
+    obj_comm = comm
+    replica_comm = None
+    n_replicas = 1
+    if n_ranks_per_object_group is not None and n_ranks_per_object_group < n_ranks:
+        if distribution_mode != 'distributed_object':
+            raise ValueError('n_ranks_per_object_group can only be used with distribution_mode = distributed_object.')
+        obj_comm, replica_comm = split_hybrid_communicators(comm, n_ranks_per_object_group)
+        n_replicas = n_ranks // n_ranks_per_object_group
+    obj_rank = obj_comm.Get_rank()
+    obj_n_ranks = obj_comm.Get_size()
+    i_replica = rank // obj_n_ranks
+
     # ================================================================================
     # Set output folder name if not specified.
     # ================================================================================
@@ -387,7 +454,7 @@ def reconstruct_ptychography(
         # Unify random seed for all threads.
         # ================================================================================
         comm.Barrier()
-        seed = int(time.time() / 60)
+        seed = int(time.time() / 60) if random_seed is None else random_seed
         seed = comm.bcast(seed, root=0)
         np.random.seed(seed)
 
@@ -416,6 +483,10 @@ def reconstruct_ptychography(
                 optimizer_options_obj = {'step_size': learning_rate}
                 opt = CGOptimizer('obj', output_folder=output_folder, distribution_mode=distribution_mode,
                                   options_dict=optimizer_options_obj)
+            elif optimizer == 'lbfgs':
+                optimizer_options_obj = {'step_size': learning_rate}
+                opt = LBFGSOptimizer('obj', output_folder=output_folder, distribution_mode=distribution_mode,
+                                     options_dict=optimizer_options_obj)
             elif optimizer == 'momentum':
                 optimizer_options_obj = {'step_size': learning_rate}
                 opt = MomentumOptimizer('obj', output_folder=output_folder, distribution_mode=distribution_mode,
@@ -427,8 +498,15 @@ def reconstruct_ptychography(
                 opt = ScipyOptimizer('obj', output_folder=output_folder,
                                      distribution_mode=distribution_mode, options_dict=optimizer_options_obj)
             else:
-                raise ValueError('Invalid optimizer type. Must be "gd" or "adam" or "cg" or "scipy".')
-        opt.create_container([*this_obj_size, 2], use_checkpoint, device_obj, use_numpy=True)
+                raise ValueError('Invalid optimizer type. Must be "gd" or "adam" or "cg" or "lbfgs" or "scipy".')
+        if sparse_update:
+            if distribution_mode == 'distributed_object':
+                raise ValueError('sparse_update is not supported in distributed_object mode.')
+            if not opt.supports_sparse_update:
+                raise ValueError('sparse_update is not supported by {}.'.format(opt.__class__.__name__))
+        opt.create_container([*this_obj_size, 2], use_checkpoint, device_obj, use_numpy=True, dtype=cache_dtype,
+                             comm=obj_comm, probe_size=probe_size, state_dtype=optimizer_state_dtype,
+                             stochastic_rounding=stochastic_rounding)
         opt.set_index_in_grad_return(0)
         opt_ls = [opt]
 
@@ -439,7 +517,7 @@ def reconstruct_ptychography(
         needs_initialize = False if use_checkpoint else True
         if use_checkpoint:
             try:
-                optimizable_params = load_params_checkpoint(os.path.join(output_folder, 'checkpoint', 'params_{}'.format(rank)))
+                optimizable_params = restore_params_checkpoint(output_folder, distribution_mode)
             except:
                 optimizable_params = None
             if distribution_mode == 'shared_file':
@@ -470,10 +548,10 @@ def reconstruct_ptychography(
         # Create object class.
         # ================================================================================
         obj = ObjectFunction([*this_obj_size, 2], distribution_mode=distribution_mode,
-                             output_folder=output_folder, ds_level=ds_level, object_type=object_type)
+                             output_folder=output_folder, ds_level=ds_level, object_type=object_type, comm=obj_comm)
         if distribution_mode == 'shared_file':
-            obj.create_file_object(use_checkpoint)
-            obj.create_temporary_file_object()
+            obj.create_file_object(use_checkpoint, dtype=cache_dtype, probe_size=probe_size)
+            obj.create_temporary_file_object(dtype=cache_dtype, probe_size=probe_size)
             if needs_initialize:
                 print_flush('Initializing object function in file...', sto_rank, rank, **stdout_options)
                 obj.initialize_file_object(save_stdout=save_stdout, timestr=timestr,
@@ -487,6 +565,8 @@ def reconstruct_ptychography(
                                      not_first_level=not_first_level, initial_guess=initial_guess,
                                      random_guess_means_sigmas=random_guess_means_sigmas, unknown_type=unknown_type,
                                      dtype=cache_dtype, non_negativity=non_negativity)
+                if replica_comm is not None:
+                    obj.arr = replica_comm.bcast(obj.arr, root=0)
             else:
                 obj.arr = obj_arr
 
@@ -546,8 +626,7 @@ def reconstruct_ptychography(
         # ================================================================================
         gradient = Gradient(obj, forward_model=forward_model)
         if distribution_mode == 'shared_file':
-            gradient.create_file_object()
-            gradient.initialize_gradient_file()
+            gradient.create_file_object(dtype=cache_dtype, probe_size=probe_size)
         elif distribution_mode == 'distributed_object':
             gradient.initialize_distributed_array_with_zeros(dtype=cache_dtype)
         else:
@@ -562,9 +641,9 @@ def reconstruct_ptychography(
         mask = None
         if finite_support_mask_path is not None:
             mask = Mask(this_obj_size, finite_support_mask_path, distribution_mode=distribution_mode,
-                        output_folder=output_folder, ds_level=ds_level)
+                        output_folder=output_folder, ds_level=ds_level, comm=obj_comm)
             if distribution_mode == 'shared_file':
-                mask.create_file_object(use_checkpoint=use_checkpoint)
+                mask.create_file_object(use_checkpoint=use_checkpoint, dtype=cache_dtype)
                 mask.initialize_file_object(dtype=cache_dtype)
             elif distribution_mode == 'distributed_object':
                 mask_arr = dxchange.read_tiff(finite_support_mask_path)
@@ -711,6 +790,8 @@ def reconstruct_ptychography(
                 optimizable_params['ctf_lg_kappa'] = w.create_variable([ctf_lg_kappa], requires_grad=True, device=device_obj, dtype='float64')
 
         opt_ls, opt_args_ls = create_and_initialize_parameter_optimizers(optimizable_params, locals())
+        param_group = ParameterGroupOptimizer(opt_ls, device=device_obj) if fuse_parameter_updates else None
+        param_scheduler = ParameterUpdateScheduler(opt_ls, opt_args_ls, update_schedule=update_schedule)
 
 
         # ================================================================================
@@ -746,6 +827,40 @@ def reconstruct_ptychography(
         f_conv = open(os.path.join(output_folder, 'convergence', 'loss_rank_{}.txt'.format(rank)), 'w')
         f_conv.write('i_epoch,i_batch,loss,time\n')
 
+        # ================================================================================
+        # Synchronization points in the loop go through this counter, which reports
+        # the time each rank spends waiting in them at the end of every epoch.
+        # ================================================================================
+        sync = SyncCounter(comm)
+        for o in opt_ls:
+            o.sync = sync
+        if checkpoint_format == 'tiled':
+            checkpoint_writer = TiledCheckpointWriter(output_folder, distribution_mode=distribution_mode,
+                                                      asynchronous=async_checkpoint, tile_size=checkpoint_tile_size)
+            # With sparse updates, only the tiles under the footprints of the minibatches change, so they
+            # are tracked instead of comparing checksums.
+            checkpoint_tile_mask = get_footprint_tile_mask([], probe_size, this_obj_size, checkpoint_tile_size) \
+                if sparse_update else None
+        elif checkpoint_format == 'npy':
+            checkpoint_writer = CheckpointWriter(output_folder, distribution_mode=distribution_mode,
+                                                 asynchronous=async_checkpoint)
+        else:
+            raise ValueError('checkpoint_format must be \'npy\' or \'tiled\'.')
+        intermediate_writer = IntermediateOutputWriter(max_pending=intermediate_queue_size,
+                                                       asynchronous=async_intermediate_output)
+
+        # ================================================================================
+        # The convergence monitor decides when to stop the epoch loop. In multiscale
+        # reconstructions, the full-resolution level runs n_epoch_final_pass epochs
+        # if given.
+        # ================================================================================
+        if n_epochs == 'auto' and multiscale_level > 1 and ds_level == 1 and n_epoch_final_pass is not None:
+            this_n_epochs = n_epoch_final_pass
+        else:
+            this_n_epochs = n_epochs
+        conv_monitor = ConvergenceMonitor(sync, n_epochs=this_n_epochs, crit_conv_rate=crit_conv_rate,
+                                          max_nepochs=max_nepochs)
+
         # ================================================================================
         # Create parameter summary file.
         # ================================================================================
@@ -758,20 +873,21 @@ def reconstruct_ptychography(
         # ================================================================================
         cont = True
         i_epoch = starting_epoch
+        n_batch_done = 0
         while cont:
             t0 = time.time()
 
             n_tot_per_batch = minibatch_size * n_ranks
+            n_tot_per_group_batch = minibatch_size * obj_n_ranks
 
             t00 = time.time()
             print_flush('Allocating jobs over threads...', sto_rank, rank, **stdout_options)
             # Make a list of all thetas and spot positions'
             np.random.seed(i_epoch)
-            comm.Barrier()
             if not two_d_mode:
                 theta_ind_ls = np.arange(n_theta)
                 np.random.shuffle(theta_ind_ls)
-                comm.Bcast(theta_ind_ls, root=0)
+                sync.Bcast(theta_ind_ls, 'theta_shuffle', root=0)
             else:
                 temp = abs(theta_ls - theta_ls[0]) < 1e-5
                 i_theta = np.nonzero(temp)[0][0]
@@ -795,9 +911,9 @@ def reconstruct_ptychography(
                     spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % minibatch_size],
                                                                     minibatch_size - (n_pos % minibatch_size),
                                                                     replace=False))
-                elif (distribution_mode is not None or update_scheme == 'per angle') and n_pos % n_tot_per_batch != 0:
-                    spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % n_tot_per_batch],
-                                                                    n_tot_per_batch - (n_pos % n_tot_per_batch),
+                elif (distribution_mode is not None or update_scheme == 'per angle') and n_pos % n_tot_per_group_batch != 0:
+                    spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % n_tot_per_group_batch],
+                                                                    n_tot_per_group_batch - (n_pos % n_tot_per_group_batch),
                                                                     replace=False))
                 # ================================================================================
                 # Create task list for the current angle.
@@ -821,7 +937,11 @@ def reconstruct_ptychography(
                     else:
                         temp = np.stack([np.array([i_theta] * len(spots_ls)), spots_ls], axis=1)
                         ind_list_rand = np.concatenate([ind_list_rand, temp], axis=0)
-            ind_list_rand = split_tasks(ind_list_rand, n_tot_per_batch)
+            ind_list_rand = split_tasks(ind_list_rand, n_tot_per_group_batch)
+            if n_replicas > 1:
+                # A batch contains one group batch for each replica, so replicas may be at different angles.
+                ind_list_rand = [np.concatenate(ind_list_rand[i:i + n_replicas])
+                                 for i in range(0, len(ind_list_rand), n_replicas)]
             n_batch = len(ind_list_rand)
             i_opt_batch = starting_epoch * n_batch + starting_batch
 
@@ -833,17 +953,33 @@ def reconstruct_ptychography(
             current_i_theta = -1
             initialize_gradients = True
             shared_file_update_flag = False
+            sparse_tile_mask = None
+            t_batch_start = None
 
             for i_batch in range(starting_batch, n_batch):
 
+                # The duration of a batch, including the batches that only accumulate gradients, is recorded
+                # when the next one starts.
+                if t_batch_start is not None:
+                    timers.record('batch', 'batch', t_batch_start, time.time() - t_batch_start)
+                    t_batch_start = None
+
                 # ================================================================================
-                # Time limit check.
+                # Time limit check. Rank 0's clock is broadcast so that all ranks exit
+                # at the same batch; nothing needs to be synchronized without a limit.
                 # ================================================================================
-                t_elapsed = (time.time() - t_zero) / 60
-                t_elapsed = comm.bcast(t_elapsed, root=0)
-                if t_max_min is not None and t_elapsed >= t_max_min:
-                    print_flush('Terminating program because maximum time limit is reached.', sto_rank, rank, **stdout_options)
-                    sys.exit()
+                if t_max_min is not None:
+                    t_elapsed = (time.time() - t_zero) / 60
+                    t_elapsed = sync.bcast(t_elapsed, 'time_limit', root=0)
+                    if t_elapsed >= t_max_min:
+                        print_flush('Terminating program because maximum time limit is reached.', sto_rank, rank, **stdout_options)
+                        sys.exit()
+                if max_n_batch is not None and n_batch_done >= max_n_batch:
+                    print_flush('Stopping because max_n_batch = {} batches are done.'.format(max_n_batch),
+                                sto_rank, rank, **stdout_options)
+                    break
+                n_batch_done += 1
+                t_batch_start = time.time()
 
                 # ================================================================================
                 # Initialize batch.
@@ -866,11 +1002,21 @@ def reconstruct_ptychography(
                         cp_path = os.path.join(output_folder, 'checkpoint')
                         create_directory_multirank(cp_path)
                         if (distribution_mode is None and rank == 0) or (distribution_mode is not None):
-                            if obj_arr is not None:
-                                save_checkpoint(i_epoch, i_batch, output_folder, distribution_mode=distribution_mode,
-                                                obj_array=obj_arr, optimizer=opt)
-                            save_params_checkpoint(os.path.join(cp_path, 'params_{}'.format(rank)), optimizable_params)
-                comm.Barrier()
+                            t_cp = timer('checkpoint').start()
+                            if checkpoint_format == 'tiled':
+                                checkpoint_writer.save(i_epoch, i_batch, obj_array=obj_arr,
+                                                       optimizer=opt if obj_arr is not None else None,
+                                                       params=optimizable_params, tile_mask=checkpoint_tile_mask)
+                                if checkpoint_tile_mask is not None:
+                                    checkpoint_tile_mask[...] = False
+                            else:
+                                checkpoint_writer.save(i_epoch, i_batch, obj_array=obj_arr,
+                                                       optimizer=opt if obj_arr is not None else None,
+                                                       params=optimizable_params)
+                            print_flush('  Checkpoint snapshot taken in {} s.'.format(t_cp.stop()),
+                                        sto_rank, rank, **stdout_options)
+                    if distribution_mode == 'shared_file' or not async_checkpoint:
+                        sync.Barrier('checkpoint')
 
                 # ================================================================================
                 # Get scan position, rotation angle indices, and raw data for current batch.
@@ -881,12 +1027,22 @@ def reconstruct_ptychography(
                     ind_list_rand[i_batch] = np.concatenate([ind_list_rand[i_batch], ind_list_rand[0][:n_supp]])
 
                 this_ind_batch_allranks = ind_list_rand[i_batch]
-                this_i_theta = this_ind_batch_allranks[rank * minibatch_size, 0]
-                this_ind_batch = np.sort(this_ind_batch_allranks[rank * minibatch_size:(rank + 1) * minibatch_size, 1])
+                if n_replicas > 1:
+                    this_ind_batch_allranks = this_ind_batch_allranks[i_replica * n_tot_per_group_batch:
+                                                                      (i_replica + 1) * n_tot_per_group_batch]
+                this_i_theta = this_ind_batch_allranks[obj_rank * minibatch_size, 0]
+                this_ind_batch = np.sort(this_ind_batch_allranks[obj_rank * minibatch_size:(obj_rank + 1) * minibatch_size, 1])
                 probe_pos_int = probe_pos_int if common_probe_pos else probe_pos_int_ls[this_i_theta]
                 this_pos_batch = probe_pos_int[this_ind_batch]
-                is_last_batch_of_this_theta = i_batch == n_batch - 1 or ind_list_rand[i_batch + 1][0, 0] != this_i_theta
-                comm.Barrier()
+                if n_replicas > 1:
+                    # Replicas update the object together after summing their gradients, so the update
+                    # is due as soon as any replica moves to a new angle.
+                    is_last_batch_of_this_theta = i_batch == n_batch - 1 or \
+                        any([len(ind_list_rand[i_batch + 1]) <= i * n_tot_per_group_batch or
+                             ind_list_rand[i_batch + 1][i * n_tot_per_group_batch, 0] !=
+                             ind_list_rand[i_batch][i * n_tot_per_group_batch, 0] for i in range(n_replicas)])
+                else:
+                    is_last_batch_of_this_theta = i_batch == n_batch - 1 or ind_list_rand[i_batch + 1][0, 0] != this_i_theta
                 print_flush('  Current rank is processing angle ID {}.'.format(this_i_theta), sto_rank, rank, **stdout_options)
 
                 # ================================================================================
@@ -896,7 +1052,7 @@ def reconstruct_ptychography(
                 if (not (distribution_mode is None and not rotate_out_of_loop)) and \
                         (this_i_theta != current_i_theta or shared_file_update_flag):
                     print_flush('  Rotating dataset...', sto_rank, rank, **stdout_options)
-                    t_rot_0 = time.time()
+                    t_rot = timer('rotation').start()
                     if precalculate_rotation_coords:
                         coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
                                                       theta_ls[this_i_theta], reverse=False)
@@ -917,8 +1073,11 @@ def reconstruct_ptychography(
                                          precalculate_rotation_coords=precalculate_rotation_coords,
                                          apply_to_arr_rot=False, override_device=device_obj)
                     # if mask is not None: mask.rotate_data_in_file(coord_ls[this_i_theta], interpolation=interpolation)
-                    comm.Barrier()
-                    print_flush('  Dataset rotation done in {} s.'.format(time.time() - t_rot_0), sto_rank, rank, **stdout_options)
+                    # Ranks read chunks from slices rotated by other ranks, and gradient file is re-zeroed
+                    # by its slice owners after each update, so the file must be complete before reading.
+                    if distribution_mode == 'shared_file':
+                        sync.Barrier('rotation')
+                    print_flush('  Dataset rotation done in {} s.'.format(t_rot.stop()), sto_rank, rank, **stdout_options)
 
 
                 if this_i_theta != current_i_theta:
@@ -929,7 +1088,7 @@ def reconstruct_ptychography(
                     # ================================================================================
                     # Get values for local chunks of object_delta and beta; interpolate and read directly from HDF5
                     # ================================================================================
-                    t_read_0 = time.time()
+                    t_read = timer('chunk_reading').start()
                     # If probe for each image is a part of the full probe, pad the object with safe_zone_width.
                     if distribution_mode == 'shared_file':
                         if subdiv_probe:
@@ -938,14 +1097,13 @@ def reconstruct_ptychography(
                                                                 dset_2=obj.dset_rot, device=device_obj, unknown_type=unknown_type)
                         else:
                             obj_rot = obj.read_chunks_from_file(this_pos_batch, probe_size, dset_2=obj.dset_rot, device=device_obj, unknown_type=unknown_type)
-                        opt.get_params_from_file(this_pos_batch, probe_size)
                     elif distribution_mode == 'distributed_object':
                         if subdiv_probe:
                             obj_rot = obj.read_chunks_from_distributed_object(probe_pos_int - np.array([safe_zone_width] * 2),
                                                                               this_ind_batch_allranks,
                                                                               minibatch_size, subprobe_size + np.array([safe_zone_width] * 2) * 2,
                                                                               device=device_obj, unknown_type=unknown_type, apply_to_arr_rot=True,
-                                                                              dtype=cache_dtype, n_split=n_split_mpi_ata)
+                                                                              dtype=cache_dtype, n_split=n_split_mpi_ata, sync=sync)
                             if isinstance(opt, CurveballOptimizer):
                                 opt.z_chunk = opt.read_chunks_from_distributed_object(probe_pos_int - np.array([safe_zone_width] * 2),
                                                                                       this_ind_batch_allranks,
@@ -956,14 +1114,13 @@ def reconstruct_ptychography(
                             obj_rot = obj.read_chunks_from_distributed_object(probe_pos_int, this_ind_batch_allranks,
                                                                               minibatch_size, probe_size, device=device_obj,
                                                                               unknown_type=unknown_type, apply_to_arr_rot=True,
-                                                                              dtype=cache_dtype, n_split=n_split_mpi_ata)
+                                                                              dtype=cache_dtype, n_split=n_split_mpi_ata, sync=sync)
                             if isinstance(opt, CurveballOptimizer):
                                 opt.z_chunk = opt.read_chunks_from_distributed_object(probe_pos_int, this_ind_batch_allranks,
                                                                                       minibatch_size, probe_size, device=device_obj,
                                                                                       unknown_type=unknown_type, apply_to_arr_rot=True,
                                                                                       dtype=cache_dtype, n_split=n_split_mpi_ata)
-                    comm.Barrier()
-                    print_flush('  Chunk reading done in {} s.'.format(time.time() - t_read_0), sto_rank, rank, **stdout_options)
+                    print_flush('  Chunk reading done in {} s.'.format(t_read.stop()), sto_rank, rank, **stdout_options)
                     obj.chunks = obj_rot
 
                 # ================================================================================
@@ -983,7 +1140,7 @@ def reconstruct_ptychography(
                 # After gradient is calculated, any modification to optimizable arrays must be
                 # inside a no_grad() block!
                 # ================================================================================
-                t_grad_0 = time.time()
+                t_grad = timer('gradient').start()
                 grad_func_args = {}
                 if distribution_mode is None:
                     if rotate_out_of_loop:
@@ -1004,7 +1161,9 @@ def reconstruct_ptychography(
                             grad_func_args[arg] = optimizable_params[arg]
                         except:
                             grad_func_args[arg] = locals()[arg]
-                comm.Barrier()
+                # Only request gradients of parameters that are scheduled to use them.
+                this_opt_args_ls, grad_opt_ls = param_scheduler.prepare_batch(is_last_batch_of_this_theta)
+                diff.set_opt_args_ls(this_opt_args_ls)
                 print_flush('  Entering differentiation loop...', sto_rank, rank, **stdout_options)
                 # Update the loss argument dictionary saved in ForwardModel class. Needed for CG but done for all
                 # optimizers for now.
@@ -1015,8 +1174,7 @@ def reconstruct_ptychography(
                     opt.calculate_beta_rho(diff, use_numpy=True)
                 else:
                     grads = diff.get_gradients(**grad_func_args)
-                comm.Barrier()
-                print_flush('  Gradient calculation done in {} s.'.format(time.time() - t_grad_0), sto_rank, rank, **stdout_options)
+                print_flush('  Gradient calculation done in {} s.'.format(t_grad.stop()), sto_rank, rank, **stdout_options)
                 grads = list(grads)
 
                 # ================================================================================
@@ -1024,18 +1182,17 @@ def reconstruct_ptychography(
                 # ================================================================================
                 if distribution_mode == 'shared_file':
                     obj_grads = grads[0]
-                    t_grad_write_0 = time.time()
-                    gradient.write_chunks_to_file(this_pos_batch, *w.split_channel(obj_grads), probe_size,
-                                                  write_difference=False, dtype=cache_dtype)
-                    print_flush('  Gradient writing done in {} s.'.format(time.time() - t_grad_write_0), 0, rank,
+                    t_grad_write = timer('gradient_accumulation').start()
+                    gradient.accumulate_chunks(this_pos_batch, *w.split_channel(obj_grads), probe_size, dtype=cache_dtype)
+                    print_flush('  Gradient accumulation done in {} s.'.format(t_grad_write.stop()), 0, rank,
                                 **stdout_options)
                 elif distribution_mode == 'distributed_object':
                     obj_grads = w.to_numpy(grads[0])
-                    t_grad_write_0 = time.time()
+                    t_grad_write = timer('gradient_syncing').start()
                     gradient.sync_chunks_to_distributed_object(obj_grads, probe_pos_int, this_ind_batch_allranks,
-                                                               minibatch_size, probe_size, dtype=cache_dtype, n_split=n_split_mpi_ata)
-                    comm.Barrier()
-                    print_flush('  Gradient syncing done in {} s.'.format(time.time() - t_grad_write_0), 0, rank,
+                                                               minibatch_size, probe_size, dtype=cache_dtype, n_split=n_split_mpi_ata,
+                                                               sync=sync)
+                    print_flush('  Gradient syncing done in {} s.'.format(t_grad_write.stop()), 0, rank,
                                 **stdout_options)
                 else:
                     if initialize_gradients:
@@ -1058,12 +1215,32 @@ def reconstruct_ptychography(
                     print_flush('  Average gradient is {} for rank 0.'.format(w.mean(grads[0])), 0, rank,
                                 **stdout_options)
 
+                # ================================================================================
+                # For sparse update, add the footprints of all ranks to the mask of tiles to be
+                # updated. Footprints at non-zero angles only restrict the y-range.
+                # ================================================================================
+                if sparse_update and optimize_object:
+                    if common_probe_pos:
+                        pos_allranks = probe_pos_int[this_ind_batch_allranks[:, 1]]
+                    else:
+                        pos_allranks = np.array([probe_pos_int_ls[i_theta][i] for i_theta, i in this_ind_batch_allranks])
+                    sparse_tile_mask = get_footprint_tile_mask(
+                        pos_allranks, probe_size, this_obj_size, sparse_update_tile_size,
+                        restrict_x=np.all(np.abs(theta_ls[this_ind_batch_allranks[:, 0]]) < 1e-8),
+                        margin=(safe_zone_width if subdiv_probe else 0) + 1, tile_mask=sparse_tile_mask)
+                    if checkpoint_format == 'tiled':
+                        # Sparse updates rewrite whole update tiles, so checkpoint tiles overlapping them are marked.
+                        checkpoint_tile_mask = get_footprint_tile_mask(
+                            np.argwhere(sparse_tile_mask) * sparse_update_tile_size,
+                            [sparse_update_tile_size] * 2, this_obj_size, checkpoint_tile_size, margin=0,
+                            tile_mask=checkpoint_tile_mask)
+
                 # Initialize gradients for non-object variables if necessary.
                 if initialize_gradients:
                     initialize_gradients = False
-                    initialize_parameter_gradients(opt_ls, device_obj)
+                    initialize_parameter_gradients(param_scheduler.pop_reset_opt_ls(), device_obj)
 
-                opt_ls = update_parameter_gradients(opt_ls, grads)
+                update_parameter_gradients(grad_opt_ls, grads)
 
                 # if ((update_scheme == 'per angle' or distribution_mode) and not is_last_batch_of_this_theta):
                 #     continue
@@ -1089,20 +1266,27 @@ def reconstruct_ptychography(
                 # All reduce object gradient buffer.
                 # ================================================================================
                 if distribution_mode is None:
-                    gradient.arr = comm.allreduce(gradient.arr)
+                    gradient.arr = sync.allreduce(gradient.arr, 'obj_grad_allreduce')
 
                 # ================================================================================
                 # Update object function with optimizer if not distribution_mode; otherwise,
                 # just save the gradient chunk into the gradient file.
                 # ================================================================================
-                with w.no_grad():
+                with timer('object_update'), w.no_grad():
                     if distribution_mode is None and optimize_object:
                         if isinstance(opt, ScipyOptimizer):
                             obj.arr = opt.apply_gradient(obj.arr, forward_model=forward_model, differentiator=diff, **opt.options_dict)
+                        elif sparse_update:
+                            obj.arr = opt.apply_gradient_to_tiles(obj.arr, gradient, i_opt_batch, sparse_tile_mask,
+                                                                  sparse_update_tile_size, **opt.options_dict)
+                            sparse_tile_mask = None
                         else:
                             obj.arr = opt.apply_gradient(obj.arr, gradient, i_opt_batch, **opt.options_dict)
                         if isinstance(opt, CurveballOptimizer) and i_batch % 10 == 0:
-                             opt.update_lambda(forward_model, grad_func_args)
+                             opt.update_lambda(forward_model, grad_func_args, x=None if rotate_out_of_loop else obj.arr)
+                        if isinstance(opt, (CGOptimizer, LBFGSOptimizer)):
+                            print_flush('  Line search: {} loss evaluations in {} s so far.'.format(
+                                opt.i_line_search_step, opt.linesearch_time), sto_rank, rank, **stdout_options)
                 if distribution_mode is None:
                     w.reattach(obj.arr)
 
@@ -1152,8 +1336,13 @@ def reconstruct_ptychography(
                     else:
                         coord_new = -theta_ls[this_i_theta]
                     print_flush('  Rotating gradient dataset back...', sto_rank, rank, **stdout_options)
-                    t_rot_0 = time.time()
+                    t_rot = timer('gradient_rotation').start()
                     if distribution_mode == 'shared_file':
+                        # Sum the local gradient buffers of all ranks into the gradient file. The file is
+                        # overwritten as a whole, so it need not be zeroed after each update. All slabs
+                        # must be written before slice owners rotate it.
+                        gradient.write_tile_buffer_to_file(dtype=cache_dtype, sync=sync)
+                        sync.Barrier('grad_write')
                         gradient.rotate_data_in_file(coord_new, interpolation=interpolation,
                                                      precalculate_rotation_coords=precalculate_rotation_coords)
                     elif distribution_mode == 'distributed_object':
@@ -1161,21 +1350,25 @@ def reconstruct_ptychography(
                                               precalculate_rotation_coords=precalculate_rotation_coords,
                                               apply_to_arr_rot=False, overwrite_arr=True, override_backend='autograd',
                                               dtype=cache_dtype, override_device='cpu')
-                    comm.Barrier()
-                    print_flush('  Gradient rotation done in {} s.'.format(time.time() - t_rot_0), sto_rank, rank, **stdout_options)
+                        if replica_comm is not None and gradient.arr is not None:
+                            gradient.arr = sync.allreduce(gradient.arr, 'obj_grad_replica_allreduce', comm=replica_comm)
+                    print_flush('  Gradient rotation done in {} s.'.format(t_rot.stop()), sto_rank, rank, **stdout_options)
 
-                    t_apply_grad_0 = time.time()
+                    t_apply_grad = timer('object_update').start()
                     if distribution_mode == 'shared_file' and optimize_object:
-                        opt.apply_gradient_to_file(obj, gradient, i_batch=i_opt_batch, **optimizer_options_obj)
-                        gradient.initialize_gradient_file()
-                    elif distribution_mode == 'distributed_object' and obj.arr is not None and optimize_object:
+                        if sparse_update:
+                            opt.apply_gradient_to_file_tiles(obj, gradient, sparse_tile_mask, sparse_update_tile_size,
+                                                             i_batch=i_opt_batch, **optimizer_options_obj)
+                            sparse_tile_mask = None
+                        else:
+                            opt.apply_gradient_to_file(obj, gradient, i_batch=i_opt_batch, **optimizer_options_obj)
+                    elif distribution_mode == 'distributed_object' and optimize_object and \
+                            (obj.arr is not None or isinstance(opt, LBFGSOptimizer)):
+                        # L-BFGS reduces dot products over all ranks, so ranks holding no slab also take part.
                         obj.arr = opt.apply_gradient(obj.arr, gradient, i_opt_batch, use_numpy=True, **optimizer_options_obj)
                         gradient.initialize_distributed_array_with_zeros(dtype=cache_dtype)
+                    print_flush('  Object update done in {} s.'.format(t_apply_grad.stop()), sto_rank, rank, **stdout_options)
 
-                    comm.Barrier()
-                    print_flush('  Object update done in {} s.'.format(time.time() - t_apply_grad_0), sto_rank, rank, **stdout_options)
-
-                    comm.Barrier()
                     t0_nonify = time.time()
                     del obj.arr_rot
                     obj.arr_rot = None
@@ -1210,18 +1403,39 @@ def reconstruct_ptychography(
                 or save_intermediate_level == 'batch'):
                     create_directory_multirank(os.path.join(output_folder, 'intermediate', 'object'))
                     create_parameter_output_folders(opt_ls, output_folder)
-                    if distribution_mode != 'distributed_object' and rank == 0 and is_last_batch_of_this_theta:
-                        output_object(obj, distribution_mode, os.path.join(output_folder, 'intermediate', 'object'),
-                                      unknown_type, full_output=False, i_epoch=i_epoch, i_batch=i_batch,
-                                      save_history=save_history)
-                        output_intermediate_parameters(opt_ls, optimizable_params, locals())
-                    elif distribution_mode == 'distributed_object' and is_last_batch_of_this_theta:
-                        output_object(obj, distribution_mode, os.path.join(output_folder, 'intermediate', 'object'),
-                                      unknown_type, full_output=False, i_epoch=i_epoch, i_batch=i_batch,
-                                      save_history=save_history)
+                    if distribution_mode == 'shared_file' and is_last_batch_of_this_theta:
+                        # Rank 0 reads the whole object file, so it waits for the other ranks' updates.
+                        sync.wait_on_root('intermediate_output', root=0)
+                    # Snapshots of the object and parameters are written by the intermediate writer's thread.
+                    # The shared file is modified by other ranks and the collective HDF5 output involves all
+                    # ranks of the object group, so these are written here.
+                    if is_last_batch_of_this_theta:
+                        obj_output_kwargs = {'full_output': False, 'i_epoch': i_epoch, 'i_batch': i_batch,
+                                             'save_history': save_history}
+                        obj_output_args = (distribution_mode, os.path.join(output_folder, 'intermediate', 'object'),
+                                           unknown_type)
+                        if distribution_mode is None and rank == 0:
+                            intermediate_writer.submit(output_object, intermediate_writer.snapshot_object(obj),
+                                                       *obj_output_args, **obj_output_kwargs)
+                        elif distribution_mode == 'shared_file' and rank == 0:
+                            output_object(obj, *obj_output_args, **obj_output_kwargs)
+                        elif distribution_mode == 'distributed_object' and i_replica == 0:
+                            if do_output_format == 'hdf5':
+                                output_object(obj, *obj_output_args, do_output_format=do_output_format,
+                                              preview_downsample=output_preview_downsample, **obj_output_kwargs)
+                            else:
+                                intermediate_writer.submit(output_object, intermediate_writer.snapshot_object(obj),
+                                                           *obj_output_args, do_output_format=do_output_format,
+                                                           **obj_output_kwargs)
                         if rank == 0:
-                            output_intermediate_parameters(opt_ls, optimizable_params, locals())
-                comm.Barrier()
+                            param_names = [opt.name for opt in opt_ls] + ['probe_real', 'probe_imag']
+                            param_output_kwargs = {'output_folder': output_folder, 'i_epoch': i_epoch,
+                                                   'i_batch': i_batch, 'save_history': save_history,
+                                                   'n_theta': n_theta, 'is_multi_dist': is_multi_dist}
+                            intermediate_writer.submit(output_intermediate_parameters, opt_ls,
+                                                       intermediate_writer.snapshot_params(optimizable_params,
+                                                                                           param_names),
+                                                       param_output_kwargs)
 
                 # ================================================================================
                 # Finishing a batch.
@@ -1235,37 +1449,60 @@ def reconstruct_ptychography(
                         w.get_gpu_memory_usage_mb(), w.get_peak_gpu_memory_usage_mb(), w.get_gpu_memory_cache_mb()), sto_rank, rank, **stdout_options)
                 f_conv.write('{},{},{},{}\n'.format(i_epoch, i_batch, current_loss, time.time() - t_zero))
                 f_conv.flush()
+                conv_monitor.add_loss(current_loss)
 
                 # ================================================================================
                 # Update object optimizer's count.
                 # ================================================================================
                 if optimizer_batch_number_increment == 'angle':
-                    if i_batch == n_batch - 1 or ind_list_rand[i_batch + 1][0, 0] != current_i_theta:
+                    if is_last_batch_of_this_theta:
                         i_opt_batch += 1
                 elif optimizer_batch_number_increment == 'batch':
                     i_opt_batch += 1
 
+            if t_batch_start is not None:
+                timers.record('batch', 'batch', t_batch_start, time.time() - t_batch_start)
+
             # ================================================================================
             # Stopping criterion.
             # ================================================================================
-            if n_epochs == 'auto':
-                    pass
-            else:
-                if i_epoch == n_epochs - 1: cont = False
+            cont = conv_monitor.end_epoch(i_epoch, save_folder=output_folder, **stdout_options)
+            if max_n_batch is not None and n_batch_done >= max_n_batch:
+                cont = False
 
             print_flush(
                 'Epoch {} (rank {}); Delta-t = {} s; current time = {} s,'.format(i_epoch, rank,
                                                                     time.time() - t0, time.time() - t_zero),
                 sto_rank, rank, **stdout_options)
+            sync.report(i_epoch, save_folder=output_folder, **stdout_options)
             i_epoch = i_epoch + 1
 
             # ================================================================================
             # Save reconstruction after an epoch.
             # ================================================================================
-            if rank == 0:
+            if distribution_mode == 'shared_file':
+                sync.wait_on_root('epoch_output', root=0)
+            if distribution_mode == 'distributed_object' and do_output_format == 'hdf5':
+                # All ranks of the first object group write their slabs.
+                if i_replica == 0:
+                    output_object(obj, distribution_mode, output_folder, unknown_type, full_output=True,
+                                  ds_level=ds_level, do_output_format=do_output_format,
+                                  preview_downsample=output_preview_downsample)
+            elif rank == 0:
                 output_object(obj, distribution_mode, output_folder, unknown_type,
                               full_output=True, ds_level=ds_level)
+            if rank == 0:
                 output_probe(optimizable_params['probe_real'], optimizable_params['probe_imag'], output_folder,
                              full_output=True, ds_level=ds_level)
             print_flush('Current iteration finished.', sto_rank, rank, **stdout_options)
+        checkpoint_writer.wait()
+        intermediate_writer.wait()
+        if intermediate_writer.n_dropped > 0:
+            print_flush('{} intermediate outputs were dropped because the writer fell behind.'.format(
+                intermediate_writer.n_dropped), None, rank, **stdout_options)
         comm.Barrier()
+
+    if timing or memory_profiling:
+        timers.export(output_folder, comm)
+        timers.enable(False)
+        timers.set_memory_profiler(None)
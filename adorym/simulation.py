@@ -1,5 +1,4 @@
 import numpy as np
-import dxchange
 import time
 import datetime
 import os
@@ -10,6 +9,7 @@ import pickle
 
 from adorym.util import *
 from adorym.misc import *
+from adorym.timing import *
 from adorym.propagate import *
 from adorym.array_ops import *
 from adorym.optimizers import *
@@ -18,6 +18,9 @@ import adorym.wrappers as w
 import adorym.global_settings as global_settings
 from adorym.forward_model import *
 from adorym.conventional import *
+from adorym.lazy import LazyModule
+
+dxchange = LazyModule('dxchange')
 
 project_config = check_config_indept_mpi()
 try:
@@ -105,6 +108,10 @@ def simulate_ptychography(
         # _____________
         # |Performance|_________________________________________________________
         cpu_only=False, core_parallelization=True, gpu_index=0,
+        timing=False,  # If True, time the main steps on each rank, and write the statistics and a Chrome trace to
+                       # [output_folder]/timing at the end.
+        memory_profiling=False,  # If True, record the memory high-water marks of the timed steps (this also turns
+                                 # on timing) and write them to [output_folder]/timing/memory.csv at the end.
         n_dp_batch=20,
         distribution_mode=None,  # Choose from None (for data parallelism), 'shared_file', 'distributed_object'
         dist_mode_n_batch_per_update=None,  # If None, object is updated only after all DPs on an angle are processed.
@@ -158,10 +165,18 @@ def simulate_ptychography(
     rank = comm.Get_rank()
     t_zero = time.time()
     global_settings.backend = backend
+    timers.reset()
+    timers.enable(timing or memory_profiling)
     device_obj = None if cpu_only else gpu_index
     device_obj = w.get_device(device_obj)
     print(device_obj)
+    timers.set_memory_profiler(MemoryProfiler(track_gpu=backend == 'pytorch' and not cpu_only)
+                               if memory_profiling else None)
     n_pos = len(probe_pos)
+    if free_prop_cm in [None, 'inf'] or np.array(free_prop_cm).size == 1:
+        is_multi_dist = False
+    else:
+        is_multi_dist = True
 
     if rank == 0:
         timestr = str(datetime.datetime.today())
@@ -197,7 +212,10 @@ def simulate_ptychography(
     except:
         f = h5py.File(os.path.join(save_path, fname), 'a')
     try:
-        prj = f.create_group('exchange').create_dataset('data', shape=[n_theta, n_pos, *probe_size], dtype=np.complex64)
+        # For multi-distance data, images of all blocks at the first distance come first, followed by those at the
+        # second distance, and so on.
+        n_images = n_pos * len(free_prop_cm) if is_multi_dist else n_pos
+        prj = f.create_group('exchange').create_dataset('data', shape=[n_theta, n_images, *probe_size], dtype=np.complex64)
     except:
         prj = f['exchange/data']
 
@@ -216,7 +234,6 @@ def simulate_ptychography(
     not_first_level = False
     this_obj_size = obj_size
     ds_level = 1
-    is_multi_dist = True if free_prop_cm not in [None, 'inf'] and len(free_prop_cm) > 1 else False
     is_sparse_multislice = True if slice_pos_cm_ls is not None else False
 
     if is_multi_dist:
@@ -231,6 +248,12 @@ def simulate_ptychography(
         probe_size = prj.shape[-2:]
         subprobe_size = probe_size
 
+    if is_multi_dist:
+        u_free, v_free = gen_freq_mesh(np.array([psize_cm * 1e7] * 3),
+                                       [subprobe_size[i] + 2 * safe_zone_width for i in range(2)])
+        u_free = w.create_variable(u_free, requires_grad=False, device=device_obj)
+        v_free = w.create_variable(v_free, requires_grad=False, device=device_obj)
+
     if not common_probe_pos:
         n_pos_ls = []
         for i in range(n_theta):
@@ -569,7 +592,7 @@ def simulate_ptychography(
                 (this_i_theta != current_i_theta or shared_file_update_flag):
             current_i_theta = this_i_theta
             print_flush('  Rotating dataset...', sto_rank, rank, **stdout_options)
-            t_rot_0 = time.time()
+            t_rot = timer('rotation').start()
             if precalculate_rotation_coords:
                 coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
                                               theta_ls[this_i_theta], reverse=False)
@@ -589,14 +612,14 @@ def simulate_ptychography(
                                  apply_to_arr_rot=False, override_device=device_obj)
             # if mask is not None: mask.rotate_data_in_file(coord_ls[this_i_theta], interpolation=interpolation)
             comm.Barrier()
-            print_flush('  Dataset rotation done in {} s.'.format(time.time() - t_rot_0), sto_rank, rank,
+            print_flush('  Dataset rotation done in {} s.'.format(t_rot.stop()), sto_rank, rank,
                         **stdout_options)
 
         if distribution_mode:
             # ================================================================================
             # Get values for local chunks of object_delta and beta; interpolate and read directly from HDF5
             # ================================================================================
-            t_read_0 = time.time()
+            t_read = timer('chunk_reading').start()
             # If probe for each image is a part of the full probe, pad the object with safe_zone_width.
             if distribution_mode == 'shared_file':
                 if subdiv_probe:
@@ -623,7 +646,7 @@ def simulate_ptychography(
                                                                       apply_to_arr_rot=True,
                                                                       dtype=cache_dtype)
             comm.Barrier()
-            print_flush('  Chunk reading done in {} s.'.format(time.time() - t_read_0), sto_rank, rank,
+            print_flush('  Chunk reading done in {} s.'.format(t_read.stop()), sto_rank, rank,
                         **stdout_options)
             obj.chunks = obj_rot
 
@@ -633,7 +656,7 @@ def simulate_ptychography(
         # After gradient is calculated, any modification to optimizable arrays must be
         # inside a no_grad() block!
         # ================================================================================
-        t_grad_0 = time.time()
+        t_grad = timer('simulation').start()
         grad_func_args = {}
         if distribution_mode is None:
             if rotate_out_of_loop:
@@ -659,17 +682,21 @@ def simulate_ptychography(
         this_pred_batch = forward_model.predict(**grad_func_args)
         complex_output = True if isinstance(this_pred_batch, tuple) else False
         comm.Barrier()
-        print_flush('  Batch simulation calculation done in {} s.'.format(time.time() - t_grad_0), sto_rank, rank,
+        print_flush('  Batch simulation calculation done in {} s.'.format(t_grad.stop()), sto_rank, rank,
                     **stdout_options)
 
         # ================================================================================
         # Write data.
         # ================================================================================
+        t_write = timer('data_writing').start()
+        if is_multi_dist:
+            this_ind_batch = np.concatenate([this_ind_batch + i * n_pos for i in range(len(free_prop_cm))])
         if complex_output:
             prj[this_i_theta, this_ind_batch] = np.stack(w.to_numpy(this_pred_batch[0])) + 1j * w.to_numpy(np.stack(this_pred_batch[1]))
         else:
             prj[this_i_theta, this_ind_batch] = w.to_numpy(this_pred_batch) + 1j * 0
         f.flush()
+        t_write.stop()
 
         # ================================================================================
         # Finishing a batch.
@@ -690,4 +717,7 @@ def simulate_ptychography(
                         **stdout_options)
             sys.exit()
 
-
+    if timing or memory_profiling:
+        timers.export(output_folder, comm)
+        timers.enable(False)
+        timers.set_memory_profiler(None)
@@ -0,0 +1,440 @@
+import os
+import time
+import json
+import glob
+import threading
+import functools
+import inspect
+import re
+import numpy as np
+
+__all__ = ['Timer', 'TimingRegistry', 'MemoryProfiler', 'timers', 'timer', 'timed', 'merge_chrome_traces']
+
+
+class Timer(object):
+    """
+    A named timer of a TimingRegistry. Use it as a context manager, or call start() and stop() around the timed
+    section. Timers started while another timer of the same thread is running are nested in it, and are recorded
+    under the path "outer/inner". The elapsed time is measured even if the registry is disabled, so that it can
+    replace ad-hoc time.time() deltas.
+    """
+    __slots__ = ('registry', 'name', 'path', 't0', 't0_wall', 'elapsed', 'active')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.path = name
+        self.elapsed = 0.
+        self.active = False
+
+    def start(self):
+        self.active = self.registry.enabled
+        if self.active:
+            self.path = self.registry.push(self.name)
+            self.registry.enter_memory_phase(self.path)
+        self.t0_wall = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def stop(self):
+        """
+        :return: Elapsed time in seconds.
+        """
+        self.elapsed = time.perf_counter() - self.t0
+        if self.active:
+            self.registry.exit_memory_phase()
+            self.registry.pop()
+            self.registry.record(self.path, self.name, self.t0_wall, self.elapsed)
+            self.active = False
+        return self.elapsed
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class TimingRegistry(object):
+    """
+    Collects the durations of named timers on the current rank. Nothing is recorded unless the registry is
+    enabled. For each timer path, summarize() gives the number of calls, the total time, and the median, 95th
+    percentile and maximum of single calls; gather_summary() collects these of all ranks, so that ranks that are
+    consistently slower than the others (stragglers) can be found. Individual calls are also kept as events (up to
+    max_events per rank) for export as a Chrome trace, which can be viewed in chrome://tracing or Perfetto.
+
+    If a MemoryProfiler is attached with set_memory_profiler, the timers of the main thread also delimit the
+    phases whose memory high-water marks are recorded.
+
+    :param enabled: Bool.
+    :param max_events: Int. Maximum number of events kept for the trace. Durations for the summary are always kept.
+    """
+    def __init__(self, enabled=False, max_events=100000):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.memory_profiler = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.duration_dict = {}
+            self.event_ls = []
+            self.n_dropped_events = 0
+
+    def set_memory_profiler(self, memory_profiler):
+        """
+        :param memory_profiler: MemoryProfiler or None.
+        """
+        self.memory_profiler = memory_profiler
+
+    def enter_memory_phase(self, path):
+        if self.memory_profiler is not None and threading.current_thread() is threading.main_thread():
+            self.memory_profiler.enter(path)
+
+    def exit_memory_phase(self):
+        if self.memory_profiler is not None and threading.current_thread() is threading.main_thread():
+            self.memory_profiler.exit()
+
+    def get_stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def push(self, name):
+        stack = self.get_stack()
+        stack.append(name)
+        return '/'.join(stack)
+
+    def pop(self):
+        self.get_stack().pop()
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def timed(self, name=None):
+        """
+        Decorator that times each call of the decorated function under name (default: its qualified name).
+        """
+        def decorator(f):
+            timer_name = f.__qualname__ if name is None else name
+            @functools.wraps(f)
+            def func(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with Timer(self, timer_name):
+                    return f(*args, **kwargs)
+            # Keep the signature visible to inspect.getfullargspec (used to get the arguments of forward models).
+            func.__signature__ = inspect.signature(f)
+            return func
+        return decorator
+
+    def record(self, path, name, t0_wall, elapsed):
+        """
+        Record a call of elapsed seconds started at wall time t0_wall. Can also be called directly for durations
+        measured elsewhere.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.duration_dict.setdefault(path, []).append(elapsed)
+            if len(self.event_ls) < self.max_events:
+                self.event_ls.append((path, name, t0_wall, elapsed, threading.get_ident()))
+            else:
+                self.n_dropped_events += 1
+
+    def summarize(self):
+        """
+        :return: Dict keyed by timer path. Values are dicts of count, total, p50, p95 and max (in seconds).
+        """
+        summary = {}
+        with self.lock:
+            for path, t_ls in self.duration_dict.items():
+                t_arr = np.array(t_ls)
+                summary[path] = {'count': len(t_arr), 'total': float(t_arr.sum()),
+                                 'p50': float(np.percentile(t_arr, 50)), 'p95': float(np.percentile(t_arr, 95)),
+                                 'max': float(t_arr.max())}
+        return summary
+
+    def gather_summary(self, comm):
+        """
+        Collective over comm. Returns the list of the summaries of all ranks of comm, indexed by rank.
+        """
+        return comm.allgather(self.summarize())
+
+    def get_straggler_report(self, summary_ls, n_entries=10):
+        """
+        :return: String listing, for the timer paths with the largest total time, the mean total over ranks and the
+                 rank with the largest total.
+        """
+        path_ls = set()
+        for s in summary_ls:
+            path_ls.update(s.keys())
+        row_ls = []
+        for path in path_ls:
+            t_tot = np.array([s[path]['total'] if path in s.keys() else 0. for s in summary_ls])
+            row_ls.append((path, t_tot.mean(), t_tot.max(), int(np.argmax(t_tot))))
+        row_ls = sorted(row_ls, key=lambda r: -r[2])[:n_entries]
+        l = max([len(r[0]) for r in row_ls] + [5])
+        lines = ['{:<{}} {:>12} {:>12} {:>8}'.format('timer', l, 'mean tot (s)', 'max tot (s)', 'max rank')]
+        for path, t_mean, t_max, i_rank in row_ls:
+            lines.append('{:<{}} {:>12.4f} {:>12.4f} {:>8d}'.format(path, l, t_mean, t_max, i_rank))
+        return '\n'.join(lines)
+
+    def export_csv(self, fname, summary_ls):
+        """
+        Write the summaries of all ranks into one CSV file with a row per rank and timer path.
+        """
+        f = open(fname, 'w')
+        f.write('rank,timer,count,total,p50,p95,max\n')
+        for i_rank, s in enumerate(summary_ls):
+            for path in sorted(s.keys()):
+                d = s[path]
+                f.write('{},{},{},{},{},{},{}\n'.format(i_rank, path, d['count'], d['total'], d['p50'], d['p95'],
+                                                       d['max']))
+        f.close()
+
+    def export_chrome_trace(self, fname, t_origin=None, pid=0):
+        """
+        Write the events of this rank in the Chrome trace event format.
+
+        :param t_origin: Float. Wall time subtracted from the timestamps. Use the same value on all ranks so that
+                         their traces can be merged with merge_chrome_traces.
+        :param pid: Int. Process ID of the events; use the rank.
+        """
+        with self.lock:
+            event_ls = list(self.event_ls)
+        if t_origin is None:
+            t_origin = min([e[2] for e in event_ls]) if len(event_ls) > 0 else 0.
+        tid_dict = {}
+        trace_ls = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'rank {}'.format(pid)}}]
+        for path, name, t0_wall, elapsed, ident in event_ls:
+            tid = tid_dict.setdefault(ident, len(tid_dict))
+            trace_ls.append({'name': name, 'cat': path.split('/')[0], 'ph': 'X', 'pid': pid, 'tid': tid,
+                             'ts': (t0_wall - t_origin) * 1e6, 'dur': elapsed * 1e6, 'args': {'path': path}})
+        f = open(fname, 'w')
+        json.dump({'traceEvents': trace_ls, 'displayTimeUnit': 'ms'}, f)
+        f.close()
+
+    def export(self, output_folder, comm, verbose=True):
+        """
+        Collective over comm. Write [output_folder]/timing/timing.csv with the summaries of all ranks, the trace of
+        each rank to [output_folder]/timing/trace_rank_[rank].json, and the merged trace to
+        [output_folder]/timing/trace.json. Rank 0 also prints the timers with the largest total time.
+        If a memory profiler is attached, its summaries are written to [output_folder]/timing/memory.csv.
+        """
+        path = os.path.join(output_folder, 'timing')
+        if comm.Get_rank() == 0:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        comm.Barrier()
+        summary_ls = self.gather_summary(comm)
+        with self.lock:
+            t_start = min([e[2] for e in self.event_ls]) if len(self.event_ls) > 0 else np.inf
+        t_origin = min(comm.allgather(t_start))
+        self.export_chrome_trace(os.path.join(path, 'trace_rank_{}.json'.format(comm.Get_rank())), t_origin,
+                                 pid=comm.Get_rank())
+        comm.Barrier()
+        if comm.Get_rank() == 0:
+            self.export_csv(os.path.join(path, 'timing.csv'), summary_ls)
+            merge_chrome_traces(sorted(glob.glob(os.path.join(path, 'trace_rank_*.json'))),
+                                os.path.join(path, 'trace.json'))
+            if verbose:
+                print(self.get_straggler_report(summary_ls))
+        if self.memory_profiler is not None:
+            self.memory_profiler.export(os.path.join(path, 'memory.csv'), comm, verbose=verbose)
+        return summary_ls
+
+
+class MemoryProfiler(object):
+    """
+    Records the memory high-water marks of phases, which are delimited by the timers of a TimingRegistry (see
+    TimingRegistry.set_memory_profiler). The resident set size (RSS) of the process is tracked, and so is the
+    memory allocated by PyTorch on the GPU if track_gpu is True.
+
+    Peaks are sampled at each phase boundary and the peak counters are then reset, so the peak of every interval
+    between two boundaries is known: on Linux, the RSS peak is read from VmHWM in /proc/self/status and reset
+    through /proc/self/clear_refs; elsewhere, the RSS is only sampled at the boundaries. The GPU peak is read from
+    torch.cuda.max_memory_allocated and reset with torch.cuda.reset_peak_memory_stats. For each phase, the
+    summary gives:
+
+    - peak: the largest peak during the phase (including nested phases);
+    - growth: the largest increase of the peak over the memory at the start of the phase, i.e. the temporary
+      memory the phase needs;
+    - hwm_increase: the total increase of the process-wide high-water mark while the phase was the innermost
+      running phase, i.e. how much the phase is responsible for the memory the process must be given.
+
+    Increases outside of any phase are attributed to the phase '(none)'; the memory already in use when the
+    profiler is created is not attributed. All values are in MB.
+
+    :param track_gpu: Bool. Track the GPU memory allocated by PyTorch.
+    """
+    def __init__(self, track_gpu=False):
+        self.track_gpu = track_gpu
+        if track_gpu:
+            import torch
+            self.torch = torch
+        self.resettable_hwm = True
+        self.stack = []
+        self.stat_dict = {}
+        self.hwm = [0., 0.]
+        # Memory in use when profiling starts is not attributed to any phase.
+        self.baseline = self.sample()
+        self.stat_dict = {}
+
+    def get_rss(self):
+        """
+        :return: (current RSS, peak RSS since last reset) in MB.
+        """
+        try:
+            f = open('/proc/self/status', 'r')
+            s = f.read()
+            f.close()
+            rss = int(re.search(r'VmRSS:\s+(\d+)', s).group(1)) / 1024
+            rss_peak = int(re.search(r'VmHWM:\s+(\d+)', s).group(1)) / 1024
+            if self.resettable_hwm:
+                try:
+                    f = open('/proc/self/clear_refs', 'w')
+                    f.write('5')
+                    f.close()
+                except (IOError, OSError):
+                    self.resettable_hwm = False
+            if not self.resettable_hwm:
+                rss_peak = rss
+        except (IOError, OSError, AttributeError):
+            import psutil
+            rss = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+            rss_peak = rss
+        return rss, rss_peak
+
+    def get_gpu(self):
+        """
+        :return: (current allocation, peak allocation since last reset) on the GPU in MB.
+        """
+        if not self.track_gpu:
+            return 0., 0.
+        current = self.torch.cuda.memory_allocated() / 1024 ** 2
+        peak = self.torch.cuda.max_memory_allocated() / 1024 ** 2
+        self.torch.cuda.reset_peak_memory_stats()
+        return current, peak
+
+    def sample(self):
+        """
+        Read and reset the peaks, fold them into the running phases, and attribute increases of the high-water
+        marks to the innermost running phase.
+
+        :return: [current RSS, current GPU allocation] in MB.
+        """
+        (rss, rss_peak), (gpu, gpu_peak) = self.get_rss(), self.get_gpu()
+        peak_ls = [rss_peak, gpu_peak]
+        for frame in self.stack:
+            for i in range(2):
+                frame['peak'][i] = max(frame['peak'][i], peak_ls[i])
+        stat = self.get_stat(self.stack[-1]['path'] if len(self.stack) > 0 else '(none)')
+        for i in range(2):
+            if peak_ls[i] > self.hwm[i]:
+                stat['hwm_increase'][i] += peak_ls[i] - self.hwm[i]
+                self.hwm[i] = peak_ls[i]
+        return [rss, gpu]
+
+    def get_stat(self, path):
+        if path not in self.stat_dict.keys():
+            self.stat_dict[path] = {'count': 0, 'peak': [0., 0.], 'growth': [0., 0.], 'hwm_increase': [0., 0.]}
+        return self.stat_dict[path]
+
+    def enter(self, path):
+        current = self.sample()
+        self.stack.append({'path': path, 'start': current, 'peak': list(current)})
+
+    def exit(self):
+        self.sample()
+        frame = self.stack.pop()
+        stat = self.get_stat(frame['path'])
+        stat['count'] += 1
+        for i in range(2):
+            stat['peak'][i] = max(stat['peak'][i], frame['peak'][i])
+            stat['growth'][i] = max(stat['growth'][i], frame['peak'][i] - frame['start'][i])
+
+    def summarize(self):
+        """
+        :return: Dict keyed by phase path. Values are dicts of count, and peak, growth and hwm_increase of RSS and
+                 GPU memory (in MB).
+        """
+        self.sample()
+        summary = {}
+        for path, stat in self.stat_dict.items():
+            summary[path] = {'count': stat['count']}
+            for key in ['peak', 'growth', 'hwm_increase']:
+                summary[path]['rss_' + key] = stat[key][0]
+                summary[path]['gpu_' + key] = stat[key][1]
+        return summary
+
+    def get_report(self, summary_ls, n_entries=10):
+        """
+        :return: String listing the phases responsible for the largest increases of the high-water marks, with
+                 the largest peak and growth over all ranks.
+        """
+        key = 'gpu_hwm_increase' if self.track_gpu else 'rss_hwm_increase'
+        path_ls = set()
+        for s in summary_ls:
+            path_ls.update(s.keys())
+        row_ls = []
+        for path in path_ls:
+            row = [path]
+            for k in [key, 'rss_peak', 'rss_growth', 'gpu_peak', 'gpu_growth']:
+                row.append(max([s[path][k] if path in s.keys() else 0. for s in summary_ls]))
+            row_ls.append(row)
+        row_ls = sorted(row_ls, key=lambda r: -r[1])[:n_entries]
+        l = max([len(r[0]) for r in row_ls] + [5])
+        lines = ['{:<{}} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('phase', l, 'hwm inc', 'rss peak', 'rss grow',
+                                                                   'gpu peak', 'gpu grow')]
+        for row in row_ls:
+            lines.append('{:<{}} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(row[0], l, *row[1:]))
+        lines.append('(MB; maxima over ranks; hwm inc is of {} memory; RSS at start on rank 0 is {:.1f} MB)'.format(
+            'GPU' if self.track_gpu else 'RSS', self.baseline[0]))
+        return '\n'.join(lines)
+
+    def export(self, fname, comm, verbose=True):
+        """
+        Collective over comm. Write the summaries of all ranks into one CSV file with a row per rank and phase.
+        """
+        summary_ls = comm.allgather(self.summarize())
+        if comm.Get_rank() == 0:
+            key_ls = ['count', 'rss_peak', 'rss_growth', 'rss_hwm_increase', 'gpu_peak', 'gpu_growth',
+                      'gpu_hwm_increase']
+            f = open(fname, 'w')
+            f.write('rank,phase,{}\n'.format(','.join(key_ls)))
+            for i_rank, s in enumerate(summary_ls):
+                for path in sorted(s.keys()):
+                    f.write('{},{},{}\n'.format(i_rank, path, ','.join([str(s[path][k]) for k in key_ls])))
+            f.close()
+            if verbose:
+                print(self.get_report(summary_ls))
+        return summary_ls
+
+
+def merge_chrome_traces(fname_ls, out_fname):
+    """
+    Merge Chrome trace files (e.g., of different ranks) into one.
+    """
+    trace_ls = []
+    for fname in fname_ls:
+        f = open(fname, 'r')
+        trace_ls += json.load(f)['traceEvents']
+        f.close()
+    f = open(out_fname, 'w')
+    json.dump({'traceEvents': trace_ls, 'displayTimeUnit': 'ms'}, f)
+    f.close()
+
+
+# Registry used throughout adorym.
+timers = TimingRegistry()
+timer = timers.timer
+timed = timers.timed
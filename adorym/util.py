@@ -1,32 +1,29 @@
 import numpy as np
-import dxchange
 import h5py
-import matplotlib.pyplot as plt
-import matplotlib
 import warnings
 import datetime
 from math import ceil, floor
-from scipy.ndimage import rotate as sp_rotate
 import time
 import re
-
-try:
-    import sys
-    from scipy.ndimage import gaussian_filter, uniform_filter
-    from scipy.ndimage import fourier_shift
-except:
-    warnings.warn('Some dependencies are screwed up.')
+import threading
+import queue
+import sys
 import os
 import pickle
 import glob
-from scipy.special import erf
 
+from adorym.lazy import LazyModule
 from adorym.constants import *
 import adorym.wrappers as w
 from adorym.propagate import *
 from adorym.misc import *
+from adorym.timing import timer, timed
 import adorym.global_settings as global_settings
 
+dxchange = LazyModule('dxchange')
+ndimage = LazyModule('scipy.ndimage')
+special = LazyModule('scipy.special')
+
 project_config = check_config_indept_mpi()
 try:
     independent_mpi = project_config['independent_mpi']
@@ -48,9 +45,9 @@ rank = comm.Get_rank()
 
 def timeit(fun):
     def func(*args, **kwargs):
-        t0 = time.time()
-        a = fun(*args, **kwargs)
-        print('[{}][{}]'.format(rank, fun.__name__), time.time() - t0)
+        with timer(fun.__name__) as t:
+            a = fun(*args, **kwargs)
+        print('[{}][{}]'.format(rank, fun.__name__), t.elapsed)
         return a
     return func
 
@@ -136,7 +133,10 @@ def initialize_object_for_sf(this_obj_size, dset=None, ds_level=1, object_type='
 def initialize_object_for_do(this_obj_size, slice_catalog=None, ds_level=1, object_type='normal', initial_guess=None,
                              output_folder=None, save_stdout=False, timestr='',
                              not_first_level=False, random_guess_means_sigmas=(8.7e-7, 5.1e-8, 1e-7, 1e-8),
-                             unknown_type='delta_beta', dtype='float32', non_negativity=False):
+                             unknown_type='delta_beta', dtype='float32', non_negativity=False, comm=None):
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
     if slice_catalog[rank] is None:
         return None
     else:
@@ -298,7 +298,7 @@ def create_probe_initial_guess_ptycho(data_fname, noise=False, raw_data_type='in
         stop_center_x = np.sum(beamstop_mask * xx) / np.sum(beamstop_mask)
         sigma = np.sqrt(np.count_nonzero(beamstop_mask) / PI)
         gaussian_filler = np.exp(((yy - stop_center_y) ** 2 + (xx - stop_center_x) ** 2) / (-4 * sigma ** 2))
-        edge_mask = uniform_filter(beamstop_mask, size=3) - beamstop_mask
+        edge_mask = ndimage.uniform_filter(beamstop_mask, size=3) - beamstop_mask
         edge_mask[edge_mask > 0] = 1
         edge_mask[edge_mask < 0] = 0
         edge_val = np.sum(edge_mask * wavefront) / np.sum(edge_mask)
@@ -329,7 +329,7 @@ def preprocess(dat, blur=None, normalize_bg=False):
     dat = -np.log(dat)
     dat[np.where(np.isnan(dat) == True)] = 0
     if blur is not None:
-        dat = gaussian_filter(dat, blur)
+        dat = ndimage.gaussian_filter(dat, blur)
 
     return dat
 
@@ -359,7 +359,7 @@ def realign_image(arr, shift):
         temp = np.roll(arr, int(shift[0]), axis=0)
         temp = np.roll(temp, int(shift[1]), axis=1)
     else:
-        temp = fourier_shift(np.fft.fftn(arr), shift)
+        temp = ndimage.fourier_shift(np.fft.fftn(arr), shift)
         temp = np.fft.ifftn(temp)
     return temp
 
@@ -567,7 +567,7 @@ def apply_rotation_primitive(obj, coord_old, interpolation='bilinear', axis=0, d
         slicer = [slice(None), slice(None), slice(None)]
         slicer[axes_rot[0]] = coord_old_1
         slicer[axes_rot[1]] = coord_old_2
-        obj_rot = w.reshape(obj[slicer], s, override_backend=override_backend)
+        obj_rot = w.reshape(obj[tuple(slicer)], s, override_backend=override_backend)
     else:
         coord_old_floor_1 = w.floor_and_cast(coord_old_1, dtype='int64', override_backend=override_backend)
         coord_old_ceil_1 = coord_old_floor_1 + 1
@@ -674,7 +674,7 @@ def apply_rotation_transpose(obj, coord_old, interpolation='bilinear', axis=0, d
 
             slicer_obj = [slice(None), slice(None), slice(None)]
             slicer_obj[axis] = i_slice
-            obj_slice = w.reshape(obj[slicer_obj], [-1, 2])
+            obj_slice = w.reshape(obj[tuple(slicer_obj)], [-1, 2])
             obj_rot[tuple(slicer_ff)] += obj_slice * fac_ff
             obj_rot[tuple(slicer_fc)] += obj_slice * fac_fc
             obj_rot[tuple(slicer_cf)] += obj_slice * fac_cf
@@ -742,7 +742,7 @@ def apply_rotation_to_hdf5(dset, coord_old, rank, n_ranks, interpolation='biline
     else:
         for i_slice in slice_ls:
             obj = dset[i_slice]
-            obj_rot = sp_rotate(obj, -coord_old, axes=(1, 2), reshape=False, order=1, mode='nearest')
+            obj_rot = ndimage.rotate(obj, -coord_old, axes=(1, 2), reshape=False, order=1, mode='nearest')
             dset_2[i_slice] = obj_rot
 
     return None
@@ -810,7 +810,7 @@ def revert_rotation_to_hdf5(dset, coord_old, rank, n_ranks, interpolation='bilin
     else:
         for i_slice in slice_ls:
             obj = dset[i_slice]
-            obj_rot = sp_rotate(obj, -coord_old, axes=(1, 2), reshape=False, order=1)
+            obj_rot = ndimage.rotate(obj, -coord_old, axes=(1, 2), reshape=False, order=1)
             dset[i_slice] = obj_rot
 
     return None
@@ -835,6 +835,176 @@ def initialize_hdf5_with_gaussian(dset, rank, n_ranks, delta_mu, delta_sigma, be
     return None
 
 
+# MPI-IO hints for files opened with the mpio driver: collective buffering for the slab writes of gradients
+# and parameters, and no data sieving, which turns independent non-contiguous writes into locked read-modify-writes.
+MPI_IO_HINTS = {'romio_cb_write': 'enable',
+                'romio_cb_read': 'automatic',
+                'romio_ds_write': 'disable'}
+
+
+def plan_hdf5_layout(full_size, dtype='float32', probe_size=None, target_chunk_bytes=2 ** 20,
+                     max_cache_bytes=2 ** 28):
+    """
+    Choose the chunk shape and chunk cache size of object-sized datasets in shared_file mode.
+
+    These datasets are accessed in two ways: whole y-slices (rotation, optimizer updates, gradient slab writes)
+    and probe-footprint blocks spanning the full depth (chunk reading). Chunks are therefore one slice thick, so
+    that ranks updating interleaved slices never share a chunk, and extend over the full depth and as many
+    x-pixels as fit in target_chunk_bytes, but not more than the probe width. The cache holds the chunks touched
+    by one footprint so that overlapping positions in a batch are read from memory.
+
+    :param full_size: Shape of the dataset, e.g. [y, x, z, 2].
+    :param probe_size: Shape of the footprint in y and x. If None, chunk width is set by target_chunk_bytes only.
+    :return: (chunk_shape, cache_bytes).
+    """
+    item_bytes = np.dtype(dtype).itemsize * int(np.prod(full_size[3:]))
+    column_bytes = full_size[2] * item_bytes
+    if column_bytes >= target_chunk_bytes:
+        chunk_x = 1
+        chunk_z = max([1, min([full_size[2], target_chunk_bytes // item_bytes])])
+    else:
+        chunk_x = target_chunk_bytes // column_bytes
+        if probe_size is not None:
+            chunk_x = min([chunk_x, probe_size[1]])
+        chunk_x = max([1, min([chunk_x, full_size[1]])])
+        chunk_z = full_size[2]
+    chunk_shape = (1, chunk_x, chunk_z, *full_size[3:])
+    chunk_bytes = chunk_x * chunk_z * item_bytes
+    if probe_size is not None:
+        n_chunks = probe_size[0] * (ceil(probe_size[1] / chunk_x) + 1) * ceil(full_size[2] / chunk_z)
+    else:
+        n_chunks = ceil(full_size[1] / chunk_x) * ceil(full_size[2] / chunk_z)
+    cache_bytes = int(min([max([n_chunks * chunk_bytes, 2 ** 20]), max_cache_bytes]))
+    return chunk_shape, cache_bytes
+
+
+def open_hdf5_file_mpi(fname, fmode, comm=None, cache_bytes=None, chunk_bytes=2 ** 20, mpi_io_hints=MPI_IO_HINTS):
+    """
+    Open an HDF5 file with the mpio driver, or with the default driver if h5py is not built with MPI.
+
+    :param cache_bytes: Size of the chunk cache of each dataset in the file. If None, the HDF5 default is used.
+    :param chunk_bytes: Typical chunk size, used to choose the number of cache hash slots.
+    :param mpi_io_hints: Dict of MPI-IO hints passed through MPI.Info. Ignored without mpi4py.
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    cache_kwargs = {}
+    if cache_bytes is not None:
+        # HDF5 recommends about 100 hash slots per chunk that fits in the cache.
+        cache_kwargs = {'rdcc_nbytes': cache_bytes, 'rdcc_nslots': int(100 * max([1, cache_bytes // chunk_bytes])) | 1,
+                        'rdcc_w0': 0.75}
+    try:
+        mpi_kwargs = {}
+        if mpi_io_hints is not None and hasattr(MPI, 'Info'):
+            info = MPI.Info.Create()
+            for k, v in mpi_io_hints.items():
+                info.Set(k, v)
+            mpi_kwargs['info'] = info
+        f = h5py.File(fname, fmode, driver='mpio', comm=comm, **mpi_kwargs, **cache_kwargs)
+    except:
+        f = h5py.File(fname, fmode, **cache_kwargs)
+    return f
+
+
+def create_dataset_without_fill(f, name, shape, dtype='float32', chunks=None):
+    """
+    Create a dataset whose storage is never filled with the fill value. Callers must write every element before
+    reading it, or treat the dataset as zero until it has been written once.
+    If the dataset already exists (e.g., when restarting from a checkpoint), return it instead.
+    """
+    if name in f:
+        return f[name]
+    try:
+        return f.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks, fill_time='never')
+    except TypeError:
+        # fill_time is not supported by old h5py.
+        return f.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks)
+
+
+def write_rows_collective(dset, row_st, arr):
+    """
+    Write arr to the rows of dset starting at row_st with one collective write of a file opened with the mpio
+    driver. Must be called by all ranks of the file's communicator; ranks that have nothing to write pass
+    arr = None and take part with an empty selection.
+    """
+    with dset.collective:
+        if arr is not None:
+            dset[row_st:row_st + arr.shape[0]] = arr
+        else:
+            # h5py skips the write for empty selections, which would leave the other ranks waiting.
+            fspace = dset.id.get_space()
+            fspace.select_none()
+            mspace = h5py.h5s.create_simple((1,))
+            mspace.select_none()
+            dset.id.write(mspace, fspace, np.zeros(1, dtype=dset.dtype), dxpl=dset._dxpl)
+
+
+def stream_blocks(block_ls, read_func, compute_func, write_func, n_prefetch=1):
+    """
+    Process a list of blocks as a three-stage pipeline. A reader thread runs data = read_func(block) up to
+    n_prefetch blocks ahead, the calling thread runs result = compute_func(block, data), and a writer thread runs
+    write_func(block, result) for the previous block while the next one is being computed. Exceptions raised in
+    any stage stop the pipeline and are re-raised in the calling thread.
+    """
+    read_q = queue.Queue(maxsize=n_prefetch)
+    write_q = queue.Queue(maxsize=1)
+    stop_event = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for block in block_ls:
+                if stop_event.is_set():
+                    break
+                read_q.put((block, read_func(block)))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            read_q.put(None)
+
+    def writer():
+        while True:
+            item = write_q.get()
+            if item is None:
+                break
+            if stop_event.is_set():
+                continue
+            try:
+                write_func(*item)
+            except BaseException as e:
+                errors.append(e)
+                stop_event.set()
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+    try:
+        while not stop_event.is_set():
+            item = read_q.get()
+            if item is None:
+                break
+            block, data = item
+            write_q.put((block, compute_func(block, data)))
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        if len(errors) > 0:
+            stop_event.set()
+        write_q.put(None)
+        writer_thread.join()
+        # Unblock the reader if it is waiting on a full queue.
+        stop_event.set()
+        while reader_thread.is_alive() or not read_q.empty():
+            try:
+                read_q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
 def initialize_hdf5_with_constant(dset, rank, n_ranks, constant_value=0, dtype='float32'):
 
     s = dset.shape
@@ -873,9 +1043,18 @@ def print_alltoall_data_shape(chunk_batch_ls_ls, i_split=0):
     return
 
 
+@timed()
 def get_subblocks_from_distributed_object_mpi(obj, slice_catalog, probe_pos, this_ind_batch_allranks, minibatch_size,
                                               probe_size, whole_object_size, unknown_type='delta_beta', output_folder='.',
-                                              n_split='auto', dtype='float32', debug=False):
+                                              n_split='auto', dtype='float32', debug=False, comm=None, sync=None):
+    """
+    :param comm: Communicator among the ranks holding the slabs of the object. Default is MPI.COMM_WORLD.
+    :param sync: adorym.SyncCounter in which the wait time of the alltoall is counted.
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    n_ranks = comm.Get_size()
 
     if n_split == 'auto':
         chunk_thickness = ceil(whole_object_size[0] / n_ranks)
@@ -924,7 +1103,11 @@ def get_subblocks_from_distributed_object_mpi(obj, slice_catalog, probe_pos, thi
     # Broadcast data.
     for i_split in range(n_split):
         if debug: print_alltoall_data_shape(chunk_batch_ls_ls, i_split=i_split)
-        chunk_batch_ls_ls[i_split] = comm.alltoall(chunk_batch_ls_ls[i_split])
+        with timer('alltoall'):
+            if sync is not None:
+                chunk_batch_ls_ls[i_split] = sync.alltoall(chunk_batch_ls_ls[i_split], 'chunk_read_alltoall', comm=comm)
+            else:
+                chunk_batch_ls_ls[i_split] = comm.alltoall(chunk_batch_ls_ls[i_split])
     chunk_batch_ls = []
     for i_rank in range(n_ranks):
         if chunk_batch_ls_ls[0][i_rank] is None:
@@ -990,9 +1173,18 @@ def get_subblocks_from_distributed_object_mpi(obj, slice_catalog, probe_pos, thi
     return my_chunk_ls
 
 
+@timed()
 def sync_subblocks_among_distributed_object_mpi(obj, my_slab, slice_catalog, probe_pos, this_ind_batch_allranks,
                                                 minibatch_size, probe_size, whole_object_size, output_folder='.', n_split='auto',
-                                                dtype='float32', debug=False):
+                                                dtype='float32', debug=False, comm=None, sync=None):
+    """
+    :param comm: Communicator among the ranks holding the slabs of the object. Default is MPI.COMM_WORLD.
+    :param sync: adorym.SyncCounter in which the wait time of the alltoall is counted.
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    n_ranks = comm.Get_size()
     s = obj.shape[1:]
     obj = obj.astype(dtype)
 
@@ -1035,12 +1227,15 @@ def sync_subblocks_among_distributed_object_mpi(obj, my_slab, slice_catalog, pro
             if len(send_chunk_ls_ls[0]) > 0:
                 for i_split in range(n_split):
                     chunk_batch_ls_ls[i_split][i_rank] = send_chunk_ls_ls[i_split]
-    comm.Barrier()
 
     # Broadcast data.
     for i_split in range(n_split):
         if debug: print_alltoall_data_shape(chunk_batch_ls_ls, i_split=i_split)
-        chunk_batch_ls_ls[i_split] = comm.alltoall(chunk_batch_ls_ls[i_split])
+        with timer('alltoall'):
+            if sync is not None:
+                chunk_batch_ls_ls[i_split] = sync.alltoall(chunk_batch_ls_ls[i_split], 'grad_sync_alltoall', comm=comm)
+            else:
+                chunk_batch_ls_ls[i_split] = comm.alltoall(chunk_batch_ls_ls[i_split])
     chunk_batch_ls = []
     for i_rank in range(n_ranks):
         if chunk_batch_ls_ls[0][i_rank] is None:
@@ -1089,6 +1284,7 @@ def sync_subblocks_among_distributed_object_mpi(obj, my_slab, slice_catalog, pro
         return None
 
 
+@timed()
 def get_subblocks_from_distributed_object(obj, slice_catalog, probe_pos, this_ind_batch_allranks, minibatch_size,
                                           probe_size, whole_object_size, unknown_type='delta_beta', output_folder='.',
                                           dtype='float32'):
@@ -1173,6 +1369,7 @@ def get_subblocks_from_distributed_object(obj, slice_catalog, probe_pos, this_in
     return my_chunk_ls
 
 
+@timed()
 def sync_subblocks_among_distributed_object(obj, slice_catalog, probe_pos, this_ind_batch_allranks,
                                            minibatch_size, probe_size, whole_object_size, output_folder='.'):
 
@@ -1311,6 +1508,157 @@ def write_subblocks_to_file(dset, this_pos_batch, obj_delta, obj_beta, probe_siz
     return
 
 
+def accumulate_subblocks_to_tiles(tile_dict, this_pos_batch, obj_delta, obj_beta, probe_size, whole_object_size,
+                                  tile_shape, monochannel=False, dtype='float32'):
+    """
+    Add sub-blocks to a rank-local tile buffer instead of writing them to the HDF5 dataset. The buffer is a dict
+    keyed by (i_tile_y, i_tile_x); each tile covers tile_shape[0] x tile_shape[1] pixels in the y-x plane and the
+    full depth of the object. Tiles are allocated only when a sub-block touches them.
+    If monochannel, give None to obj_beta.
+    """
+    if not monochannel:
+        obj = np.stack([obj_delta, obj_beta], axis=-1)
+    else:
+        obj = obj_delta
+    obj = obj.astype(dtype)
+    th, tw = tile_shape
+    for i_batch, coords in enumerate(this_pos_batch):
+        if len(coords) == 2:
+            this_y, this_x = coords
+            line_st, line_end = (this_y, this_y + probe_size[0])
+            px_st, px_end = (this_x, this_x + probe_size[1])
+        else:
+            line_st, line_end, px_st, px_end = coords
+        line_st_clip = max([0, line_st])
+        line_end_clip = min([whole_object_size[0], line_end])
+        px_st_clip = max([0, px_st])
+        px_end_clip = min([whole_object_size[1], px_end])
+        if line_st_clip >= line_end_clip or px_st_clip >= px_end_clip:
+            continue
+        this_block = obj[i_batch, line_st_clip - line_st:line_end_clip - line_st, px_st_clip - px_st:px_end_clip - px_st]
+        for i_ty in range(line_st_clip // th, (line_end_clip - 1) // th + 1):
+            for i_tx in range(px_st_clip // tw, (px_end_clip - 1) // tw + 1):
+                tile = tile_dict.get((i_ty, i_tx))
+                if tile is None:
+                    tile = np.zeros([min(th, whole_object_size[0] - i_ty * th), min(tw, whole_object_size[1] - i_tx * tw),
+                                     *this_block.shape[2:]], dtype=dtype)
+                    tile_dict[(i_ty, i_tx)] = tile
+                y0, y1 = max([line_st_clip, i_ty * th]), min([line_end_clip, (i_ty + 1) * th])
+                x0, x1 = max([px_st_clip, i_tx * tw]), min([px_end_clip, (i_tx + 1) * tw])
+                tile[y0 - i_ty * th:y1 - i_ty * th, x0 - i_tx * tw:x1 - i_tx * tw] += \
+                    this_block[y0 - line_st_clip:y1 - line_st_clip, x0 - px_st_clip:x1 - px_st_clip]
+    return tile_dict
+
+
+@timed()
+def write_tiles_to_file_mpi(dset, tile_dict, tile_shape, whole_object_size, dtype='float32', comm=None, sync=None):
+    """
+    Sum the tile buffers of all ranks and write the result to dset, overwriting its previous content.
+    The rows of the object are divided into contiguous slabs. Each rank receives the parts of all ranks' tiles
+    that fall in its slab, adds them up in memory, and writes the slab with a single (collective if MPI-IO is
+    available) write, so no rank ever reads from or writes to a region of dset owned by another rank.
+    Collective; must be called by all ranks even if their buffers are empty.
+
+    :param tile_dict: Dict of tiles created by accumulate_subblocks_to_tiles. Can be empty.
+    :param sync: adorym.SyncCounter in which the wait time of the collectives is counted.
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    n_ranks = comm.Get_size()
+    slice_catalog = get_multiprocess_distribution_index(whole_object_size[0], n_ranks)
+    th, tw = tile_shape if tile_shape is not None else (1, 1)
+
+    send_ls = [[] for _ in range(n_ranks)]
+    n_bytes = 0
+    for (i_ty, i_tx), tile in tile_dict.items():
+        y0 = i_ty * th
+        for i_rank, their_slice_range in enumerate(slice_catalog):
+            if their_slice_range is None:
+                continue
+            st, end = max([y0, their_slice_range[0]]), min([y0 + tile.shape[0], their_slice_range[1]])
+            if st < end:
+                send_ls[i_rank].append((st, i_tx * tw, tile[st - y0:end - y0]))
+                n_bytes += tile[st - y0:end - y0].nbytes
+    # Split along depth if any rank sends more than what a single MPI message can hold.
+    if sync is not None:
+        n_split_ls = sync.allgather(ceil(n_bytes / 2 ** 31), 'grad_write_allgather', comm=comm)
+    else:
+        n_split_ls = comm.allgather(ceil(n_bytes / 2 ** 31))
+    n_split = max(n_split_ls + [1])
+    s2 = dset.shape[2]
+    bounds = np.linspace(0, s2, n_split + 1).astype(int)
+
+    my_slice_range = slice_catalog[rank]
+    slab = None
+    if my_slice_range is not None:
+        slab = np.zeros([my_slice_range[1] - my_slice_range[0], *dset.shape[1:]], dtype=dtype)
+    for i_split in range(n_split):
+        this_send_ls = [[(y, x, block[:, :, bounds[i_split]:bounds[i_split + 1]]) for y, x, block in ls] for ls in send_ls]
+        with timer('alltoall'):
+            if sync is not None:
+                recv_ls = sync.alltoall(this_send_ls, 'grad_write_alltoall', comm=comm)
+            else:
+                recv_ls = comm.alltoall(this_send_ls)
+        if slab is not None:
+            for ls in recv_ls:
+                for y, x, block in ls:
+                    slab[y - my_slice_range[0]:y - my_slice_range[0] + block.shape[0], x:x + block.shape[1],
+                         bounds[i_split]:bounds[i_split + 1]] += block
+
+    if hasattr(dset, 'collective'):
+        write_rows_collective(dset, my_slice_range[0] if slab is not None else 0, slab)
+    elif slab is not None:
+        dset[my_slice_range[0]:my_slice_range[1]] = slab
+    return
+
+
+def get_footprint_tile_mask(this_pos_batch, probe_size, whole_object_size, tile_size, restrict_x=True, margin=1,
+                            tile_mask=None):
+    """
+    Get a boolean mask of the (y, x) tiles of the object touched by the probes at the given positions.
+    :param this_pos_batch: Array of shape [n, 2] giving the top-left corners (y, x) of the probes.
+    :param tile_size: Int. Edge length of square tiles in pixels.
+    :param restrict_x: Bool. If False, all tiles in the touched rows are marked. This is needed when the
+                       footprints are taken at a non-zero rotation angle, because rotation about the y-axis
+                       does not preserve x-coordinates.
+    :param margin: Int. Number of pixels each footprint is padded with to account for interpolation and
+                   subpixel position shifts.
+    :param tile_mask: If given, the footprints are added to this mask (in place) instead of a new one.
+    """
+    n_ty = int(np.ceil(whole_object_size[0] / tile_size))
+    n_tx = int(np.ceil(whole_object_size[1] / tile_size))
+    if tile_mask is None:
+        tile_mask = np.zeros([n_ty, n_tx], dtype=bool)
+    for this_y, this_x in this_pos_batch:
+        line_st = max([0, int(this_y) - margin])
+        line_end = min([whole_object_size[0], int(this_y) + probe_size[0] + margin])
+        if restrict_x:
+            px_st = max([0, int(this_x) - margin])
+            px_end = min([whole_object_size[1], int(this_x) + probe_size[1] + margin])
+        else:
+            px_st, px_end = 0, whole_object_size[1]
+        if line_st >= line_end or px_st >= px_end:
+            continue
+        tile_mask[line_st // tile_size:(line_end - 1) // tile_size + 1,
+                  px_st // tile_size:(px_end - 1) // tile_size + 1] = True
+    return tile_mask
+
+
+def get_tile_mask_runs(tile_mask):
+    """
+    Split each row of a tile mask into runs of consecutive True tiles.
+    Returns a list of (i_ty, i_tx_start, i_tx_end).
+    """
+    run_ls = []
+    for i_ty in range(tile_mask.shape[0]):
+        row = np.concatenate([[False], tile_mask[i_ty], [False]]).astype(int)
+        edges = np.nonzero(np.diff(row))[0]
+        for i_tx_st, i_tx_end in zip(edges[0::2], edges[1::2]):
+            run_ls.append((i_ty, int(i_tx_st), int(i_tx_end)))
+    return run_ls
+
+
 def pad_object(obj_rot, this_obj_size, probe_pos, probe_size, mode='constant', unknown_type='delta_beta', override_backend=None):
     """
     Pad the object with 0 if any of the probes' extents go beyond the object boundary.
@@ -1332,8 +1680,8 @@ def pad_object(obj_rot, this_obj_size, probe_pos, probe_size, mode='constant', u
             args_2 = {}
             if mode == 'constant': args_1['constant_values'] = 1
             if mode == 'constant': args_2['constant_values'] = 0
-            obj_rot = w.stack([w.pad(obj_rot[slicer0], pad_arr.tolist() + paap, mode=mode, override_backend=override_backend, **args_1),
-                               w.pad(obj_rot[slicer1], pad_arr.tolist() + paap, mode=mode, override_backend=override_backend, **args_2)],
+            obj_rot = w.stack([w.pad(obj_rot[tuple(slicer0)], pad_arr.tolist() + paap, mode=mode, override_backend=override_backend, **args_1),
+                               w.pad(obj_rot[tuple(slicer1)], pad_arr.tolist() + paap, mode=mode, override_backend=override_backend, **args_2)],
                                axis=-1)
     return obj_rot, pad_arr
 
@@ -1456,7 +1804,7 @@ def generate_sphere(shape, radius, anti_aliasing=5):
     res[center_res[0] - int(a.shape[0] / 2):center_res[0] + int(a.shape[0] / 2),
         center_res[1] - int(a.shape[0] / 2):center_res[1] + int(a.shape[0] / 2),
         center_res[2] - int(a.shape[0] / 2):center_res[2] + int(a.shape[0] / 2)] = a
-    res = gaussian_filter(res, 0.5 * anti_aliasing)
+    res = ndimage.gaussian_filter(res, 0.5 * anti_aliasing)
     res = res[::anti_aliasing, ::anti_aliasing, ::anti_aliasing]
     return res
 
@@ -1515,6 +1863,8 @@ def fourier_shell_correlation(obj, ref, step_size=1, save_path='fsc', save_mask=
         fsc_ls.append(fsc)
         np.save(os.path.join(save_path, 'fsc.npy'), fsc_ls)
 
+    import matplotlib
+    import matplotlib.pyplot as plt
     matplotlib.rcParams['pdf.fonttype'] = 'truetype'
     fontProperties = {'family': 'serif', 'serif': ['Times New Roman'], 'weight': 'normal', 'size': 12}
     plt.rc('font', **fontProperties)
@@ -1553,6 +1903,8 @@ def fourier_ring_correlation(obj, ref, step_size=1, save_path='frc', save_mask=F
         fsc_ls.append(fsc)
         np.save(os.path.join(save_path, 'fsc.npy'), fsc_ls)
 
+    import matplotlib
+    import matplotlib.pyplot as plt
     matplotlib.rcParams['pdf.fonttype'] = 'truetype'
     fontProperties = {'family': 'serif', 'serif': ['Times New Roman'], 'weight': 'normal', 'size': 12}
     plt.rc('font', **fontProperties)
@@ -1571,7 +1923,7 @@ def upsample_2x(arr):
     else:
         out_arr = np.zeros([arr.shape[0] * 2, arr.shape[1] * 2, arr.shape[2] * 2])
         out_arr[::2, ::2, ::2] = arr[:, :, :]
-        out_arr = gaussian_filter(out_arr, 1)
+        out_arr = ndimage.gaussian_filter(out_arr, 1)
     return out_arr
 
 
@@ -1604,7 +1956,7 @@ def multidistance_ctf(prj_ls, dist_cm_ls, psize_cm, energy_kev, kappa=50, sigma_
 
     abs_nu = np.sqrt(u ** 2 + v ** 2)
     nu_cut = 0.6 * u_max
-    f = 0.5 * (1 - erf((abs_nu - nu_cut) / sigma_cut))
+    f = 0.5 * (1 - special.erf((abs_nu - nu_cut) / sigma_cut))
     alpha = alpha_1 * f + alpha_2 * (1 - f)
     phase = np.sum(np.fft.fftshift(np.fft.fft2(prj_ls - 1, axes=(-2, -1)), axes=(-2, -1)) * (np.sin(xi_ls) + 1. / kappa * np.cos(xi_ls)), axis=0)
     phase /= (np.sum(2 * (np.sin(xi_ls) + 1. / kappa * np.cos(xi_ls)) ** 2, axis=0) + alpha)
@@ -1943,7 +2295,23 @@ def write_subblocks_to_file_with_tilt(dset, this_pos_batch, obj_delta, obj_beta,
 
 
 def output_object(obj, distribution_mode, output_folder, unknown_type='delta_beta',
-                  full_output=True, ds_level=1, i_epoch=0, i_batch=0, save_history=True):
+                  full_output=True, ds_level=1, i_epoch=0, i_batch=0, save_history=True,
+                  do_output_format='tiff', preview_downsample=None):
+    """
+    :param do_output_format: String. Output format in distributed_object mode. If 'tiff', each rank writes its slab
+                             to [name]_rank_[rank].tiff. If 'hdf5', all ranks of obj.comm must call this function
+                             and write their slabs into one HDF5 file with output_distributed_object.
+    :param preview_downsample: Int. If given with do_output_format='hdf5', a preview downsampled by this factor is
+                               written alongside.
+    """
+    if distribution_mode == 'distributed_object' and do_output_format == 'hdf5':
+        if full_output:
+            fname = 'obj_ds_{}'.format(ds_level)
+        else:
+            fname = 'obj_{}_{}'.format(i_epoch, i_batch) if save_history else 'obj'
+        output_distributed_object(obj, os.path.join(output_folder, fname), unknown_type=unknown_type,
+                                  preview_downsample=preview_downsample)
+        return
 
     if distribution_mode == 'shared_file':
         obj0 = obj.dset[:, :, :, 0]
@@ -1993,6 +2361,84 @@ def output_object(obj, distribution_mode, output_folder, unknown_type='delta_bet
             dxchange.write_tiff(np.arctan2(obj1, obj0), os.path.join(output_folder, fname1), dtype='float32', overwrite=True)
 
 
+
+def output_distributed_object(obj, fname, unknown_type='delta_beta', preview_downsample=None, dtype='float32'):
+    """
+    Write the object of a distributed_object reconstruction into one HDF5 file, [fname].h5, in which each rank
+    writes its slab at its offset along y. The file is opened with the mpio driver if h5py is built with MPI, and
+    each dataset is written with one collective write; otherwise, ranks write their slabs in turn. Must be called by all ranks of obj.comm.
+    The file has two datasets of the full object size, named 'delta' and 'beta' (or 'mag' and 'phase' if
+    unknown_type is 'real_imag').
+
+    :param obj: adorym.ObjectFunction in distributed_object mode.
+    :param preview_downsample: Int. If given, every preview_downsample-th voxel along each axis is also written to
+                               '[name]_preview' datasets and to [fname]_preview_[name].tiff.
+    """
+    comm = obj.comm
+    obj_rank = comm.Get_rank()
+    obj_n_ranks = comm.Get_size()
+    full_size = obj.full_size[:-1]
+    names = ['delta', 'beta'] if unknown_type == 'delta_beta' else ['mag', 'phase']
+
+    slab_ls = None
+    my_range = obj.slice_catalog[obj_rank]
+    if my_range is not None and obj.arr is not None:
+        obj0 = np.take(obj.arr, 0, -1)
+        obj1 = np.take(obj.arr, 1, -1)
+        if unknown_type == 'real_imag':
+            obj0, obj1 = np.sqrt(obj0 ** 2 + obj1 ** 2), np.arctan2(obj1, obj0)
+        slab_ls = [obj0.astype(dtype), obj1.astype(dtype)]
+
+    if preview_downsample is not None:
+        ds = preview_downsample
+        preview_size = [int(np.ceil(s / ds)) for s in full_size]
+        if slab_ls is not None:
+            # Rows of the slab on the global preview grid.
+            y_st = int(np.ceil(my_range[0] / ds)) * ds
+            preview_ls = [slab[y_st - my_range[0]::ds, ::ds, ::ds] for slab in slab_ls]
+            preview_range = [y_st // ds, y_st // ds + preview_ls[0].shape[0]]
+
+    chunk_shape, cache_bytes = plan_hdf5_layout(full_size, dtype=dtype)
+
+    def write_slabs(f, collective=False):
+        for i, name in enumerate(names):
+            dset = create_dataset_without_fill(f, name, full_size, dtype=dtype, chunks=chunk_shape)
+            slab = slab_ls[i] if slab_ls is not None else None
+            if collective:
+                write_rows_collective(dset, my_range[0] if slab is not None else 0, slab)
+            elif slab is not None:
+                dset[my_range[0]:my_range[1]] = slab
+            if preview_downsample is not None:
+                dset = create_dataset_without_fill(f, name + '_preview', preview_size, dtype=dtype)
+                preview = preview_ls[i] if slab_ls is not None and preview_range[1] > preview_range[0] else None
+                if collective:
+                    write_rows_collective(dset, preview_range[0] if preview is not None else 0, preview)
+                elif preview is not None:
+                    dset[preview_range[0]:preview_range[1]] = preview
+
+    # The mpio driver needs parallel HDF5 and an mpi4py communicator.
+    if h5py.get_config().mpi and hasattr(MPI, 'Comm') and isinstance(comm, MPI.Comm):
+        f = open_hdf5_file_mpi(fname + '.h5', 'w', comm=comm, cache_bytes=cache_bytes)
+        write_slabs(f, collective=True)
+        f.close()
+    else:
+        # Without parallel HDF5, ranks take turns. Rank 0 creates the file.
+        if obj_rank > 0:
+            comm.recv(source=obj_rank - 1, tag=43)
+        f = h5py.File(fname + '.h5', 'w' if obj_rank == 0 else 'a')
+        write_slabs(f)
+        f.close()
+        if obj_rank < obj_n_ranks - 1:
+            comm.send(True, dest=obj_rank + 1, tag=43)
+    comm.Barrier()
+
+    if preview_downsample is not None and obj_rank == 0:
+        f = h5py.File(fname + '.h5', 'r')
+        for name in names:
+            dxchange.write_tiff(f[name + '_preview'][...], '{}_preview_{}'.format(fname, name), dtype=dtype,
+                                overwrite=True)
+        f.close()
+
 def output_probe(probe_real, probe_imag, output_folder, full_output=True, ds_level=1,
                  i_epoch=0, i_batch=0, save_history=True, custom_name=None):
 
@@ -2061,6 +2507,27 @@ def subdivide_image(img, block_range_ls, override_backend=None):
     return block_ls
 
 
+def split_hybrid_communicators(comm, n_ranks_per_group):
+    """
+    Split a communicator for hybrid parallelism. Consecutive ranks are put into object groups of n_ranks_per_group
+    ranks; the object is distributed among the ranks of a group as in distributed_object mode, and each group
+    holds a full replica of the object.
+
+    :param comm: Communicator to split (usually MPI.COMM_WORLD).
+    :param n_ranks_per_group: Int. Number of ranks in each object group. Must divide the size of comm.
+    :return: (group_comm, replica_comm). group_comm connects the ranks in the same object group; replica_comm
+             connects the ranks holding the same slab in different groups.
+    """
+    this_rank = comm.Get_rank()
+    this_n_ranks = comm.Get_size()
+    if this_n_ranks % n_ranks_per_group != 0:
+        raise ValueError('Number of ranks ({}) must be a multiple of n_ranks_per_object_group ({}).'.format(
+            this_n_ranks, n_ranks_per_group))
+    group_comm = comm.Split(this_rank // n_ranks_per_group, this_rank % n_ranks_per_group)
+    replica_comm = comm.Split(this_rank % n_ranks_per_group, this_rank // n_ranks_per_group)
+    return group_comm, replica_comm
+
+
 def get_multiprocess_distribution_index(size, n_ranks):
     task_ls = []
     n_task_per_rank = floor(size / n_ranks)
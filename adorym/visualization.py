@@ -1,10 +1,9 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import glob, os, re
 
 
 def parse_loss_data(src_dir):
+    import pandas as pd
 
     flist = glob.glob(os.path.join(src_dir, 'loss_rank_*.txt'))
     flist.sort()
@@ -1,31 +1,33 @@
 import warnings
 import os
 import gc
+import importlib.util
 import numpy as np
-import scipy
-import scipy.signal
 
 import adorym.global_settings as global_settings
+from adorym.timing import timer
+from adorym.lazy import LazyModule
 
+# Backend engines are imported on first use, so that processes that use only one backend (or none, like the
+# launcher) do not pay for importing the others.
 engine_dict = {}
-try:
-    import autograd.numpy as anp
-    import autograd as ag
+anp = LazyModule('autograd.numpy')
+ag = LazyModule('autograd')
+if importlib.util.find_spec('autograd') is not None:
     engine_dict['autograd'] = anp
     flag_autograd_avail = True
-except:
+else:
     warnings.warn('Autograd backend is not available.')
     flag_autograd_avail = False
-try:
-    import torch as tc
-    import torch.autograd as tag
+tc = LazyModule('torch')
+tag = LazyModule('torch.autograd')
+if importlib.util.find_spec('torch') is not None:
     engine_dict['pytorch'] = tc
     flag_pytorch_avail = True
-except:
+else:
     warnings.warn('PyTorch backend is not available.')
     flag_pytorch_avail = False
 
-
 func_mapping_dict = {'zeros':       {'autograd': 'zeros',      'tensorflow': 'zeros',      'pytorch': 'zeros',      'numpy': 'zeros'},
                      'ones':        {'autograd': 'ones',       'tensorflow': 'ones',       'pytorch': 'ones',       'numpy': 'ones'},
                      'zeros_like':  {'autograd': 'zeros_like', 'tensorflow': 'zeros_like', 'pytorch': 'zeros_like', 'numpy': 'zeros_like'},
@@ -64,16 +66,25 @@ dtype_mapping_dict = {'float32':    {'autograd': 'float32',    'tensorflow': 'fl
                       'bool':       {'autograd': 'bool',       'tensorflow': 'bool',       'pytorch': 'bool',   'numpy': 'bool'},
                       }
 
-if flag_pytorch_avail:
-    try:
-        pytorch_dtype_query_mapping_dict = {tc.float32: 'float32',
-                                            tc.float64: 'float64',
-                                            'float32': 'float32',
-                                            'float64': 'float64',
-                                            'single': 'float32',
-                                            'double': 'float64'}
-    except:
-        pass
+
+
+class _PytorchDtypeQueryDict(dict):
+    """
+    Maps PyTorch dtypes and their names to dtype names. The PyTorch dtypes are added when first queried, so that
+    PyTorch is not imported with this module.
+    """
+    def __missing__(self, key):
+        if flag_pytorch_avail and tc.float32 not in self.keys():
+            self[tc.float32] = 'float32'
+            self[tc.float64] = 'float64'
+            return self[key]
+        raise KeyError(key)
+
+
+pytorch_dtype_query_mapping_dict = _PytorchDtypeQueryDict({'float32': 'float32',
+                                                           'float64': 'float64',
+                                                           'single': 'float32',
+                                                           'double': 'float64'})
 
 
 def set_bn(f):
@@ -271,12 +282,14 @@ def get_gradients(loss_node, opt_args_ls=None, backend='autograd', **kwargs):
         return loss_node(*list(kwargs.values()))
     elif backend == 'pytorch':
         # For PyTorch, loss_node is the loss function itself.
-        l = loss_node(**kwargs)
+        with timer('forward'):
+            l = loss_node(**kwargs)
         kwargs_ls = list(kwargs.values())
         dx_ls = []
         for i, node in enumerate(kwargs_ls):
             if i in opt_args_ls: dx_ls.append(node)
-        grads = tag.grad(l, dx_ls, retain_graph=True, create_graph=False, allow_unused=False)
+        with timer('backward'):
+            grads = tag.grad(l, dx_ls, retain_graph=True, create_graph=False, allow_unused=False)
         # grads = []
         # l.backward(retain_graph=True)
         # for n in dx_ls:
@@ -333,7 +346,46 @@ def hvp(func, x, backend='autograd'):
     if backend == 'autograd':
         return ag.differential_operators.make_hvp(func, x)
     elif backend == 'pytorch':
-        raise NotImplementedError('VJP for Pytorch backend is not implemented yet.')
+        if not isinstance(x, int):
+            raise NotImplementedError('HVP for Pytorch backend only supports a single Int argument index.')
+        def constructor(*args):
+            args = list(args)
+            args[x] = args[x].detach().requires_grad_()
+            grad = tag.grad(func(*args), args[x], create_graph=True)[0]
+            def func_hvp(v):
+                return tag.grad(grad, args[x], v, retain_graph=True)[0]
+            return func_hvp, grad.detach()
+        return constructor
+
+
+@set_bn
+def linearize(func, x, backend='autograd'):
+    """
+    Returns a constructor that would evaluate func once, and generate functions that compute the VJP and the JVP
+    between their arguments and the Jacobian of func at that point. The JVP function is the transpose of the VJP
+    function, which is linear in its argument, so func is not evaluated again to build it.
+    :param func: Function handle.
+    :param x: Int. Index of the argument of func with respect to which the Jacobian is taken.
+    :return: The returned constructor receives the input of func as input, and returns the output of func, the
+             VJP function, and the JVP function.
+    """
+    if backend == 'autograd':
+        def constructor(*args):
+            func_vjp, ans = ag.make_vjp(func, x)(*args)
+            func_jvp, _ = ag.make_vjp(func_vjp)(anp.zeros_like(ans))
+            return ans, func_vjp, func_jvp
+        return constructor
+    elif backend == 'pytorch':
+        def constructor(*args):
+            ans = func(*args)
+            u = tc.zeros_like(ans, requires_grad=True)
+            vjp_u = tag.grad(ans, args[x], u, create_graph=True)[0]
+            def func_vjp(v):
+                return tag.grad(ans, args[x], v, retain_graph=True)[0]
+            def func_jvp(v):
+                return tag.grad(vjp_u, u, v, retain_graph=True)[0]
+            return ans.detach(), func_vjp, func_jvp
+        return constructor
 
 
 @set_bn
@@ -425,6 +477,19 @@ def reattach(var, backend='autograd'):
     else:
         return var
 
+@set_bn
+def copy(var, backend='autograd'):
+    """
+    Return a copy of var detached from the graph on the same device. For PyTorch, the copy is queued on the device
+    without waiting for it, unlike to_numpy.
+    """
+    if isinstance(var, np.ndarray):
+        return np.copy(var)
+    elif backend == 'pytorch':
+        return var.detach().clone()
+    else:
+        return np.copy(to_numpy(var))
+
 # ________________
 # |Maths functions|_____________________________________________________________
 
@@ -1119,6 +1184,7 @@ def rotate(arr, theta, axis=0, backend='autograd', device=None):
     :param arr: a 3D object in [len_y, len_x, len_z, n_channels].
     """
     if backend == 'autograd':
+        import scipy.ndimage
         warnings.warn('Rotate (with grad) in Autograd is not yet implemented. Use Pytorch backend instead.')
         axes = []
         for i in range(3):
@@ -1164,11 +1230,11 @@ def pcc(obj, backend='autograd'):
     slicer_z = [slice(None)] * (len(obj.shape) - 1)
     for i_slice in range(obj.shape[-1]):
         if i_slice == 0:
-            nom = obj[slicer_z + [i_slice]] - mean(obj[slicer_z + [i_slice]])
-            denom = std(obj[slicer_z + [i_slice]])
+            nom = obj[tuple(slicer_z + [i_slice])] - mean(obj[tuple(slicer_z + [i_slice])])
+            denom = std(obj[tuple(slicer_z + [i_slice])])
         else:
-            nom = nom * (obj[slicer_z + [i_slice]] - mean(obj[slicer_z + [i_slice]]))
-            denom = denom * std(obj[slicer_z + [i_slice]])
+            nom = nom * (obj[tuple(slicer_z + [i_slice])] - mean(obj[tuple(slicer_z + [i_slice])]))
+            denom = denom * std(obj[tuple(slicer_z + [i_slice])])
     nom = sum(nom)
     return abs(nom / denom)
 
@@ -1182,6 +1248,7 @@ def tomography_filter(arr, axis=2, filter_type='hamming', backend='autograd'):
     :param axis: Axis of slice projection.
     :return:
     """
+    import scipy.signal
     func = getattr(scipy.signal.windows, filter_type)
     filter = func(arr.shape[axis])
     if axis != len(arr.shape) - 1:
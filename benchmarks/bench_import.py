@@ -0,0 +1,43 @@
+"""
+Import-time benchmarks of adorym. Each call runs the statement in a new Python interpreter, as every rank of a job
+does at startup; "interpreter" is the startup time of Python itself, for reference.
+
+Examples:
+
+    python benchmarks/bench_import.py --output results/import_HEAD.json
+    python benchmarks/bench_import.py --compare results/import_HEAD.json
+"""
+import os
+import sys
+import subprocess
+import collections
+
+import adorym.wrappers as w
+
+from common import benchmark, main
+
+STATEMENTS = collections.OrderedDict(
+    [('interpreter', 'pass'),
+     ('package', 'import adorym'),
+     ('reconstruction', 'from adorym.ptychography import reconstruct_ptychography'),
+     ('autograd_engine', "import adorym.wrappers as w; w.engine_dict['autograd'].zeros(1)"),
+     ('pytorch_engine', "import adorym.wrappers as w; w.engine_dict['pytorch'].zeros(1)")])
+if not w.flag_autograd_avail:
+    del STATEMENTS['autograd_engine']
+if not w.flag_pytorch_avail:
+    del STATEMENTS['pytorch_engine']
+
+
+@benchmark(group='import', params=collections.OrderedDict(target=list(STATEMENTS.keys())))
+def time_import(target):
+    cmd = [sys.executable, '-c', STATEMENTS[target]]
+    # Check the statement once, so that a failing import is reported as an error rather than timed.
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def run():
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return run
+
+
+if __name__ == '__main__':
+    sys.exit(main(description='Import-time benchmarks of adorym.'))
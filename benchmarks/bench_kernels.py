@@ -0,0 +1,287 @@
+"""
+Micro-benchmarks of the numerical kernels of adorym, run on synthetic inputs on the CPU.
+
+Examples:
+
+    python benchmarks/bench_kernels.py --quick --output results/kernels_HEAD.json
+    python benchmarks/bench_kernels.py --filter multislice --backend pytorch
+    python benchmarks/bench_kernels.py --output new.json --compare results/kernels_HEAD.json
+
+CGOptimizer and ScipyOptimizer are not benchmarked here, since their steps are dominated by the loss evaluations
+of the line search; they are covered by the end-to-end benchmarks.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import collections
+
+import numpy as np
+import h5py
+
+import adorym.wrappers as w
+from adorym.util import *
+from adorym.propagate import *
+from adorym.optimizers import *
+from adorym.regularizers import *
+
+from common import benchmark, use_backend, main
+
+BACKENDS = ['autograd', 'pytorch']
+ENERGY_EV = 5000.
+PSIZE_CM = 1e-7
+SEED = 1234
+
+
+def _params(**kwargs):
+    return collections.OrderedDict(kwargs)
+
+
+def _variable(arr, backend):
+    if backend == 'autograd':
+        return arr
+    return w.create_variable(arr, requires_grad=False, override_backend=backend)
+
+
+def _random_object(shape, seed=SEED):
+    rng = np.random.RandomState(seed)
+    obj = np.zeros(list(shape) + [2])
+    obj[..., 0] = rng.uniform(0, 1e-5, shape)
+    obj[..., 1] = rng.uniform(0, 1e-6, shape)
+    return obj
+
+
+def _random_probe(shape, seed=SEED):
+    rng = np.random.RandomState(seed)
+    return rng.normal(size=shape), rng.normal(size=shape)
+
+
+def _get_voxel_nm():
+    return np.array([PSIZE_CM] * 3) * 1e7
+
+
+def _get_lmbda_nm():
+    return 1240. / ENERGY_EV
+
+
+# ==========================================
+# Propagation
+# ==========================================
+
+@benchmark(group='propagate',
+           params=_params(size=[64, 128], n_slices=[16, 64], binning=[1, 4], n_modes=[1, 3], backend=BACKENDS))
+def time_multislice_propagate_batch(size, n_slices, binning, n_modes, backend, minibatch_size=4):
+    use_backend(backend)
+    grid_batch = _variable(_random_object([minibatch_size, size, size, n_slices]), backend)
+    probe_ls = [[_variable(p, backend) for p in _random_probe([minibatch_size, size, size], seed=SEED + i)]
+                for i in range(n_modes)]
+    voxel_nm = _get_voxel_nm()
+    h = get_kernel(voxel_nm[-1] * binning, _get_lmbda_nm(), voxel_nm, [size, size])
+
+    def run():
+        # Probe modes are propagated one at a time, as in the forward models.
+        for probe_real, probe_imag in probe_ls:
+            multislice_propagate_batch(grid_batch, probe_real, probe_imag, ENERGY_EV, PSIZE_CM, kernel=h,
+                                       free_prop_cm='inf', binning=binning)
+    return run
+
+
+@benchmark(group='propagate', params=_params(size=[64, 128], n_slices=[16, 64], backend=BACKENDS))
+def time_sparse_multislice_propagate_batch(size, n_slices, backend, minibatch_size=4):
+    use_backend(backend)
+    grid_batch = _variable(_random_object([minibatch_size, size, size, n_slices]), backend)
+    probe_real, probe_imag = [_variable(p, backend) for p in _random_probe([minibatch_size, size, size])]
+    u, v = gen_freq_mesh(_get_voxel_nm(), [size, size])
+    u = _variable(u, backend)
+    v = _variable(v, backend)
+    # Unevenly spaced slices.
+    slice_pos_cm_ls = np.cumsum(np.random.RandomState(SEED).uniform(0.5, 2, n_slices)) * PSIZE_CM
+
+    def run():
+        sparse_multislice_propagate_batch(u, v, grid_batch, probe_real, probe_imag, ENERGY_EV, PSIZE_CM,
+                                          slice_pos_cm_ls, free_prop_cm='inf')
+    return run
+
+
+@benchmark(group='propagate', params=_params(size=[128, 256, 512], minibatch_size=[1, 8], backend=BACKENDS))
+def time_fresnel_propagate(size, minibatch_size, backend):
+    use_backend(backend)
+    probe_real, probe_imag = [_variable(p, backend) for p in _random_probe([minibatch_size, size, size])]
+    voxel_nm = _get_voxel_nm()
+    lmbda_nm = _get_lmbda_nm()
+    h = get_kernel(1e4, lmbda_nm, voxel_nm, [size, size])
+
+    def run():
+        fresnel_propagate(probe_real, probe_imag, 1e4, lmbda_nm, voxel_nm, h=h)
+    return run
+
+
+# ==========================================
+# Rotation, alignment and padding
+# ==========================================
+
+def _get_rotation_coords(size, theta=0.3):
+    array_size = [size] * 3
+    coord_new = get_cooridnates_stack_for_rotation(array_size, axis=0)
+    coord_old = calculate_original_coordinates_for_rotation(array_size, coord_new, theta,
+                                                            override_backend='autograd')
+    return np.asarray(coord_old).astype('float64')
+
+
+@benchmark(group='rotation', params=_params(size=[32, 64, 128], interpolation=['bilinear', 'nearest'],
+                                            backend=BACKENDS))
+def time_apply_rotation(size, interpolation, backend):
+    use_backend(backend)
+    obj = _variable(_random_object([size] * 3), backend)
+    coord_old = _get_rotation_coords(size)
+
+    def run():
+        apply_rotation(obj, coord_old, interpolation=interpolation)
+    return run
+
+
+@benchmark(group='rotation', params=_params(size=[32, 64], backend=BACKENDS))
+def time_apply_rotation_transpose(size, backend):
+    use_backend(backend)
+    obj = _variable(_random_object([size] * 3), backend)
+    coord_old = _get_rotation_coords(size)
+
+    def run():
+        apply_rotation_transpose(obj, coord_old)
+    return run
+
+
+@benchmark(group='rotation', params=_params(size=[128, 256], minibatch_size=[1, 8], backend=BACKENDS))
+def time_realign_image_fourier(size, minibatch_size, backend):
+    use_backend(backend)
+    a_real, a_imag = [_variable(p, backend) for p in _random_probe([minibatch_size, size, size])]
+
+    def run():
+        realign_image_fourier(a_real, a_imag, [1.3, -2.7], axes=(1, 2))
+    return run
+
+
+@benchmark(group='rotation', params=_params(size=[64, 256], unknown_type=['delta_beta', 'real_imag'],
+                                            backend=BACKENDS))
+def time_pad_object(size, unknown_type, backend, n_slices=16, probe_size=(32, 32)):
+    use_backend(backend)
+    obj = _variable(_random_object([size, size, n_slices]), backend)
+    # Positions on a raster that extends beyond the object on every side.
+    probe_pos = np.array([[y, x] for y in range(-probe_size[0] // 2, size, probe_size[0])
+                          for x in range(-probe_size[1] // 2, size, probe_size[1])])
+
+    def run():
+        pad_object(obj, [size, size, n_slices], probe_pos, probe_size, unknown_type=unknown_type)
+    return run
+
+
+# ==========================================
+# HDF5 I/O
+# ==========================================
+
+def _create_temp_dataset(size, n_slices):
+    folder = tempfile.mkdtemp(prefix='adorym_bench_')
+    f = h5py.File(os.path.join(folder, 'obj.h5'), 'w')
+    dset = f.create_dataset('obj', data=_random_object([size, size, n_slices]).astype('float32'))
+
+    def teardown():
+        f.close()
+        shutil.rmtree(folder, ignore_errors=True)
+    return dset, teardown
+
+
+def _get_pos_batch(size, probe_size, minibatch_size, seed=SEED):
+    rng = np.random.RandomState(seed)
+    return rng.randint(-probe_size // 4, size - probe_size + probe_size // 4, [minibatch_size, 2])
+
+
+@benchmark(group='hdf5', params=_params(size=[128, 256], probe_size=[32, 64], minibatch_size=[4, 16]))
+def time_get_rotated_subblocks(size, probe_size, minibatch_size, n_slices=16):
+    dset, teardown = _create_temp_dataset(size, n_slices)
+    pos_batch = _get_pos_batch(size, probe_size, minibatch_size)
+
+    def run():
+        get_rotated_subblocks(dset, pos_batch, [probe_size, probe_size], [size, size, n_slices])
+    return run, teardown
+
+
+@benchmark(group='hdf5', params=_params(size=[128, 256], probe_size=[32, 64], minibatch_size=[4, 16]))
+def time_write_subblocks_to_file(size, probe_size, minibatch_size, n_slices=16):
+    dset, teardown = _create_temp_dataset(size, n_slices)
+    pos_batch = _get_pos_batch(size, probe_size, minibatch_size)
+    rng = np.random.RandomState(SEED)
+    shape = [minibatch_size, probe_size, probe_size, n_slices]
+    obj_delta = rng.normal(size=shape) * 1e-8
+    obj_beta = rng.normal(size=shape) * 1e-9
+
+    def run():
+        write_subblocks_to_file(dset, pos_batch, obj_delta, obj_beta, [probe_size, probe_size],
+                                [size, size, n_slices])
+    return run, teardown
+
+
+# ==========================================
+# Optimizers
+# ==========================================
+
+optimizer_dict = {'adam': (AdamOptimizer, {'step_size': 1e-7}),
+                  'momentum': (MomentumOptimizer, {'step_size': 1e-7}),
+                  'gd': (GDOptimizer, {'step_size': 1e-7, 'dynamic_rate': False}),
+                  'curveball': (CurveballOptimizer, {}),
+                  'lbfgs': (LBFGSOptimizer, {'step_size': 1e-7, 'linesearch_type': None})}
+
+
+@benchmark(group='optimizers', params=_params(optimizer=list(optimizer_dict.keys()), size=[64, 128],
+                                              backend=BACKENDS))
+def time_optimizer_apply_gradient(optimizer, size, backend, n_slices=32):
+    use_backend(backend)
+    opt_class, options = optimizer_dict[optimizer]
+    folder = tempfile.mkdtemp(prefix='adorym_bench_')
+    opt = opt_class('obj', output_folder=folder, options_dict=options)
+    whole_object_size = [size, size, n_slices, 2]
+    opt.create_container(whole_object_size, use_checkpoint=False, device_obj=None, use_numpy=True)
+    if isinstance(opt, CurveballOptimizer):
+        # Coefficients are normally found from Gauss-Newton products before each step.
+        opt.beta, opt.rho = 1e-7, 0.9
+    x = _variable(_random_object(whole_object_size[:-1]), backend)
+    g_ls = [_variable(_random_object(whole_object_size[:-1], seed=SEED + i) - 5e-6, backend) for i in range(2)]
+    i_batch = [0]
+
+    def run():
+        # Alternate between two gradients so that quasi-Newton updates see distinct pairs.
+        x_new = opt.apply_gradient(x, g_ls[i_batch[0] % 2], i_batch[0], **options)
+        i_batch[0] += 1
+        return x_new
+
+    def teardown():
+        shutil.rmtree(folder, ignore_errors=True)
+    return run, teardown
+
+
+# ==========================================
+# Regularizers
+# ==========================================
+
+regularizer_dict = {'l1': lambda: L1Regularizer(1e-9, 1e-9),
+                    'reweighted_l1': lambda: ReweightedL1Regularizer(1e-9, 1e-9),
+                    'tv': lambda: TVRegularizer(1e-9),
+                    'corr': lambda: CorrRegularizer(1e-9),
+                    'grad_corr': lambda: GradCorrRegularizer(1e-9)}
+
+
+@benchmark(group='regularizers', params=_params(regularizer=list(regularizer_dict.keys()), size=[64, 128],
+                                                backend=BACKENDS))
+def time_regularizer_get_value(regularizer, size, backend, n_slices=32):
+    use_backend(backend)
+    reg = regularizer_dict[regularizer]()
+    obj = _variable(_random_object([size, size, n_slices]), backend)
+    if isinstance(reg, ReweightedL1Regularizer):
+        reg.update_l1_weight(_variable(np.ones([size, size, n_slices, 2]), backend))
+
+    def run():
+        reg.get_value(obj)
+    return run
+
+
+if __name__ == '__main__':
+    sys.exit(main(description='Micro-benchmarks of the numerical kernels of adorym.'))
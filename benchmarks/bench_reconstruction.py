@@ -0,0 +1,424 @@
+"""
+End-to-end throughput benchmarks of reconstruct_ptychography.
+
+Synthetic data are generated with simulate_ptychography for each scenario (2D ptychography, multislice
+ptychography, full-field tomography and multi-distance holography). Then, for each configuration (backend,
+distribution mode, minibatch size, n_dp_batch and number of ranks), a fixed number of batches is reconstructed
+in a separate job, launched with the single-node launcher of Adorym (adorym-run) or with mpirun. Reported are
+the diffraction patterns processed per second, the seconds per epoch extrapolated from the mean batch time, and
+the peak memory of the ranks. The first batches are excluded from the timing as warm-up.
+
+Examples:
+
+    python benchmarks/bench_reconstruction.py --scenario multislice_ptycho --ranks 1 --ranks 2 --ranks 4
+    python benchmarks/bench_reconstruction.py --backend autograd --backend pytorch --minibatch-size 2 \\
+        --minibatch-size 8 --distribution-mode none --distribution-mode distributed_object --output e2e.json
+
+Results are saved as JSON files with machine metadata, in the same format as the kernel benchmarks, so they can
+be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import itertools
+import subprocess
+import collections
+
+import numpy as np
+
+from common import get_machine_metadata, save_results, load_results, compare_results, format_comparison
+
+SCENARIOS = ['2d_ptycho', 'multislice_ptycho', 'fullfield_tomo', 'multidist_holography']
+DISTRIBUTION_MODES = {'none': None, 'distributed_object': 'distributed_object', 'shared_file': 'shared_file'}
+
+
+def get_scenario(name, size=32, n_theta=4):
+    """
+    Get the parameters of a scenario.
+
+    :param size: Int. Lateral size of the object in pixels.
+    :return: Dict with keys 'sim_params' (arguments of simulate_ptychography), 'rec_params' (arguments of
+             reconstruct_ptychography), 'phantom' (function generating the phantom as a list of [delta, beta], or
+             [real, imag] for unknown_type = 'real_imag'), and 'fixed_minibatch_size' (if the scenario only
+             supports one minibatch size).
+    """
+    common = {'energy_ev': 5000, 'psize_cm': 1e-7, 'theta_st': 0, 'theta_end': np.pi}
+    probe_size = max(8, size // 2)
+    raster = [(y, x) for y in range(0, size - probe_size + 1, probe_size // 2)
+              for x in range(0, size - probe_size + 1, probe_size // 2)]
+    gaussian_probe = {'probe_type': 'gaussian', 'probe_mag_sigma': probe_size / 4, 'probe_phase_sigma': probe_size / 4,
+                      'probe_phase_max': 0.5}
+    scenario = {'fixed_minibatch_size': None, 'unknown_type': 'delta_beta'}
+    if name == '2d_ptycho':
+        obj_size = (size, size, 1)
+        d = dict(common, obj_size=obj_size, probe_pos=raster, n_theta=1, free_prop_cm='inf', two_d_mode=True,
+                 **gaussian_probe)
+        scenario['sim_params'] = dict(d, probe_size=(probe_size, probe_size))
+        scenario['rec_params'] = dict(d)
+    elif name == 'multislice_ptycho':
+        obj_size = (size, size, size)
+        d = dict(common, obj_size=obj_size, probe_pos=raster, n_theta=n_theta, free_prop_cm='inf', **gaussian_probe)
+        scenario['sim_params'] = dict(d, probe_size=(probe_size, probe_size))
+        scenario['rec_params'] = dict(d)
+    elif name == 'fullfield_tomo':
+        obj_size = (size, size, size)
+        # Each angle has only one image, so a rank processes one image at a time.
+        scenario['fixed_minibatch_size'] = 1
+        d = dict(common, obj_size=obj_size, probe_pos=[(0, 0)], n_theta=n_theta * 4, free_prop_cm=1e-4,
+                 probe_type='plane')
+        scenario['sim_params'] = dict(d, probe_size=(size, size))
+        scenario['rec_params'] = dict(d)
+    elif name == 'multidist_holography':
+        obj_size = (size, size, 1)
+        free_prop_cm = [1e-4, 2e-4, 4e-4]
+        scenario['fixed_minibatch_size'] = 1
+        scenario['unknown_type'] = 'real_imag'
+        # The object is imaged as a single block at each distance.
+        d = dict(common, obj_size=obj_size, probe_pos=[(0, 0)], n_theta=1,
+                 free_prop_cm=free_prop_cm, two_d_mode=True, probe_type='plane', unknown_type='real_imag',
+                 theta_end=0)
+        scenario['sim_params'] = dict(d, probe_size=(size, size))
+        scenario['rec_params'] = dict(d, random_guess_means_sigmas=(1., 0., 0.01, 0.01))
+    else:
+        raise ValueError('Unknown scenario {}. Choose from {}.'.format(name, SCENARIOS))
+    scenario['obj_size'] = obj_size
+    return scenario
+
+
+def create_phantom(obj_size, unknown_type='delta_beta', seed=1234):
+    """
+    Create a phantom of random spheres.
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in obj_size], indexing='ij'), axis=-1)
+    blob = np.zeros(obj_size)
+    for _ in range(8):
+        center = rng.uniform(0, 1, 3) * np.array(obj_size)
+        radius = rng.uniform(0.1, 0.25) * min(obj_size[:2])
+        dist = np.sqrt(np.sum(((grid - center) * np.array([1, 1, 0 if obj_size[-1] == 1 else 1])) ** 2, axis=-1))
+        blob[dist < radius] += 1
+    if unknown_type == 'delta_beta':
+        return [blob * 1e-5, blob * 1e-6]
+    return [1. - 0.05 * blob, 0.05 * blob]
+
+
+def get_n_batch_per_epoch(n_pos, n_theta, minibatch_size, n_ranks, distribution_mode, update_scheme='immediate',
+                          two_d_mode=False):
+    """
+    Number of batches in an epoch, following the task allocation of reconstruct_ptychography.
+    """
+    if two_d_mode:
+        n_theta = 1
+    n_tot_per_batch = minibatch_size * n_ranks
+    if distribution_mode is None and update_scheme == 'immediate':
+        n_pos_padded = int(np.ceil(n_pos / minibatch_size)) * minibatch_size
+    else:
+        n_pos_padded = int(np.ceil(n_pos / n_tot_per_batch)) * n_tot_per_batch
+    return int(np.ceil(n_theta * n_pos_padded / n_tot_per_batch))
+
+
+# ==========================================
+# Worker (runs inside each job)
+# ==========================================
+
+def run_worker(config_fname):
+    with open(config_fname, 'r') as f:
+        config = json.load(f)
+    import adorym
+    from adorym.misc import check_config_indept_mpi
+    from adorym.timing import timers
+    project_config = check_config_indept_mpi()
+    try:
+        if project_config.get('independent_mpi', False):
+            raise Exception
+        from mpi4py import MPI
+    except:
+        from adorym.pseudo import MPI
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    if config['task'] == 'simulate':
+        adorym.simulate_ptychography(**config['params'])
+        return
+
+    t0 = time.time()
+    adorym.reconstruct_ptychography(**config['params'])
+    t_total = time.time() - t0
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    peak_gpu_mb = 0.
+    if config['params']['backend'] == 'pytorch' and not config['params']['cpu_only']:
+        import torch
+        if torch.cuda.is_available():
+            peak_gpu_mb = torch.cuda.max_memory_allocated() / 1024. ** 2
+    memory_ls = comm.allgather((peak_rss_mb, peak_gpu_mb))
+    # All ranks process the same number of batches, which are synchronized at the updates; rank 0's batch
+    # durations are used.
+    t_batch_ls = list(timers.duration_dict.get('batch', []))
+    phases = timers.summarize()
+    if rank == 0:
+        result = {'t_batch_ls': t_batch_ls,
+                  't_total': t_total,
+                  'peak_rss_mb': [m[0] for m in memory_ls],
+                  'peak_gpu_mb': [m[1] for m in memory_ls],
+                  'phases': phases}
+        with open(config['result_fname'], 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+# ==========================================
+# Driver
+# ==========================================
+
+def get_launch_command(script_args, n_ranks, launcher='local', threads_per_rank=None):
+    script = [os.path.abspath(__file__)] + script_args
+    if n_ranks == 1 and launcher == 'local':
+        return [sys.executable] + script
+    if launcher == 'local':
+        cmd = [sys.executable, '-m', 'adorym.local_comm', '-n', str(n_ranks)]
+        if threads_per_rank is not None:
+            cmd += ['-t', str(threads_per_rank)]
+        return cmd + script
+    return launcher.format(n=n_ranks).split() + [sys.executable] + script
+
+
+def run_job(config, folder, n_ranks, launcher='local', threads_per_rank=None, timeout=None, verbose=False):
+    config_fname = os.path.join(folder, 'config_{}.json'.format(config['name']))
+    with open(config_fname, 'w') as f:
+        json.dump(config, f, indent=2)
+    cmd = get_launch_command(['--worker', config_fname], n_ranks, launcher=launcher,
+                             threads_per_rank=threads_per_rank)
+    env = dict(os.environ)
+    # Make the benchmarks folder importable by the workers regardless of their working directory.
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] +
+                                        ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    log_fname = os.path.join(folder, 'log_{}.txt'.format(config['name']))
+    with open(log_fname, 'w') as log:
+        try:
+            ret = subprocess.run(cmd, cwd=folder, env=env, stdout=None if verbose else log,
+                                 stderr=subprocess.STDOUT, timeout=timeout).returncode
+        except subprocess.TimeoutExpired:
+            return 'timed out after {} s; see {}'.format(timeout, log_fname)
+    if ret != 0:
+        return 'exited with status {}; see {}'.format(ret, log_fname)
+    return None
+
+
+def prepare_data(scenario_name, scenario, folder, backend='autograd', launcher='local', timeout=None,
+                 verbose=False):
+    """
+    Generate the phantom and simulate the data of a scenario in folder, unless they exist already.
+    """
+    fname = os.path.join(folder, 'data.h5')
+    if os.path.exists(fname):
+        return None
+    phantom_path = os.path.join(folder, 'phantom')
+    if not os.path.exists(phantom_path):
+        os.makedirs(phantom_path)
+    grid_delta, grid_beta = create_phantom(scenario['obj_size'], unknown_type=scenario['unknown_type'])
+    np.save(os.path.join(phantom_path, 'grid_delta.npy'), grid_delta)
+    np.save(os.path.join(phantom_path, 'grid_beta.npy'), grid_beta)
+    params = dict(scenario['sim_params'], fname='data.h5', save_path=folder, phantom_path=phantom_path,
+                  output_folder='simulation', minibatch_size=1, n_dp_batch=1, backend=backend, cpu_only=True,
+                  use_checkpoint=False)
+    config = {'task': 'simulate', 'name': 'simulation', 'params': params}
+    err = run_job(config, folder, 1, launcher=launcher, timeout=timeout, verbose=verbose)
+    if err is not None:
+        if os.path.exists(fname):
+            os.remove(fname)
+        return 'Simulation of {} {}'.format(scenario_name, err)
+    return None
+
+
+def summarize_run(res, minibatch_size, n_ranks, n_batch_per_epoch, n_warmup):
+    t_batch_ls = np.array(res['t_batch_ls'])
+    if len(t_batch_ls) <= n_warmup:
+        raise ValueError('Only {} batches were timed; increase --n-batches.'.format(len(t_batch_ls)))
+    t_ls = t_batch_ls[n_warmup:]
+    t_mean = float(np.mean(t_ls))
+    return {'n_batches_timed': len(t_ls),
+            'min': float(np.min(t_ls)),
+            'median': float(np.median(t_ls)),
+            'mean': t_mean,
+            'stdev': float(np.std(t_ls)),
+            'times': [float(t) for t in t_ls],
+            'patterns_per_second': minibatch_size * n_ranks / t_mean,
+            'n_batch_per_epoch': n_batch_per_epoch,
+            'seconds_per_epoch': t_mean * n_batch_per_epoch,
+            'total_seconds': res['t_total'],
+            'peak_rss_mb': max(res['peak_rss_mb']),
+            'peak_rss_mb_per_rank': res['peak_rss_mb'],
+            'peak_gpu_mb': max(res['peak_gpu_mb']),
+            'phases': res['phases']}
+
+
+def format_report(results):
+    """
+    Format results as a table. For configurations that differ only in the number of ranks, the speedup and the
+    parallel efficiency relative to the smallest number of ranks are also listed.
+    """
+    base_dict = {}
+    for key, res in results.items():
+        if 'error' in res:
+            continue
+        p = dict(res['params'])
+        n_ranks = p.pop('ranks')
+        group = json.dumps(p, sort_keys=True)
+        if group not in base_dict or n_ranks < base_dict[group][0]:
+            base_dict[group] = (n_ranks, res['patterns_per_second'])
+    width = max([len(k) for k in results.keys()] + [9])
+    lines = ['{:<{w}}  {:>12}  {:>10}  {:>10}  {:>9}  {:>8}  {:>10}'.format(
+        'Benchmark', 'patterns/s', 's/epoch', 's/batch', 'RSS (MB)', 'speedup', 'efficiency', w=width)]
+    for key, res in results.items():
+        if 'error' in res:
+            lines.append('{:<{w}}  failed: {}'.format(key, res['error'], w=width))
+            continue
+        p = dict(res['params'])
+        n_ranks = p.pop('ranks')
+        n_ranks_0, pps_0 = base_dict[json.dumps(p, sort_keys=True)]
+        speedup = res['patterns_per_second'] / pps_0
+        efficiency = speedup * n_ranks_0 / n_ranks
+        lines.append('{:<{w}}  {:>12.2f}  {:>10.3f}  {:>10.4f}  {:>9.1f}  {:>8.2f}  {:>10.2f}'.format(
+            key, res['patterns_per_second'], res['seconds_per_epoch'], res['mean'], res['peak_rss_mb'], speedup,
+            efficiency, w=width))
+    return '\n'.join(lines)
+
+
+def get_key(param_dict):
+    return 'reconstruction[{}]'.format(','.join('{}={}'.format(k, v) for k, v in param_dict.items()))
+
+
+def run_benchmarks(args):
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='adorym_bench_')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    print('Working directory is {}.'.format(workdir))
+    # Each epoch has at least one batch, so n_batches epochs are enough; the run stops after max_n_batch batches.
+    n_batches = args.n_warmup + args.n_batches
+    results = collections.OrderedDict()
+    try:
+        for scenario_name in args.scenario or SCENARIOS:
+            scenario = get_scenario(scenario_name, size=args.size, n_theta=args.n_theta)
+            folder = os.path.join(workdir, '{}_{}'.format(scenario_name, args.size))
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            err = prepare_data(scenario_name, scenario, folder, launcher=args.launcher, timeout=args.timeout,
+                               verbose=args.verbose)
+            if err is not None:
+                print(err)
+            minibatch_size_ls = args.minibatch_size or [4]
+            if scenario['fixed_minibatch_size'] is not None:
+                minibatch_size_ls = [scenario['fixed_minibatch_size']]
+            combinations = itertools.product(args.backend or ['autograd'], args.distribution_mode or ['none'],
+                                             minibatch_size_ls, args.n_dp_batch or [None], args.ranks or [1])
+            for backend, mode, minibatch_size, n_dp_batch, n_ranks in combinations:
+                n_dp_batch = minibatch_size if n_dp_batch is None else min(n_dp_batch, minibatch_size)
+                param_dict = collections.OrderedDict([('scenario', scenario_name), ('size', args.size),
+                                                      ('backend', backend), ('distribution_mode', mode),
+                                                      ('minibatch_size', minibatch_size),
+                                                      ('n_dp_batch', n_dp_batch), ('ranks', n_ranks)])
+                key = get_key(param_dict)
+                if err is not None:
+                    results[key] = {'params': dict(param_dict), 'error': err}
+                    continue
+                name = '_'.join(str(v) for k, v in param_dict.items() if k not in ['scenario', 'size'])
+                result_fname = os.path.join(folder, 'result_{}.json'.format(name))
+                distribution_mode = DISTRIBUTION_MODES[mode]
+                params = dict(scenario['rec_params'], fname='data.h5', save_path=folder,
+                              output_folder='rec_{}'.format(name), n_epochs=n_batches, max_n_batch=n_batches,
+                              minibatch_size=minibatch_size, n_dp_batch=n_dp_batch, backend=backend,
+                              cpu_only=not args.gpu, distribution_mode=distribution_mode, learning_rate=1e-7,
+                              optimizer='adam', alpha_d=0, alpha_b=0, gamma=0, use_checkpoint=False,
+                              store_checkpoint=False, timing=True)
+                config = {'task': 'reconstruct', 'name': name, 'params': params, 'result_fname': result_fname}
+                if os.path.exists(result_fname):
+                    os.remove(result_fname)
+                err_run = run_job(config, folder, n_ranks, launcher=args.launcher,
+                                  threads_per_rank=args.threads_per_rank, timeout=args.timeout,
+                                  verbose=args.verbose)
+                if err_run is None and not os.path.exists(result_fname):
+                    err_run = 'no result written'
+                if err_run is not None:
+                    res = {'params': dict(param_dict), 'error': err_run}
+                else:
+                    with open(result_fname, 'r') as f:
+                        raw = json.load(f)
+                    n_batch_per_epoch = get_n_batch_per_epoch(len(params['probe_pos']), params['n_theta'],
+                                                              minibatch_size, n_ranks, distribution_mode,
+                                                              two_d_mode=params.get('two_d_mode', False))
+                    try:
+                        res = summarize_run(raw, minibatch_size, n_ranks, n_batch_per_epoch, args.n_warmup)
+                        res['params'] = dict(param_dict)
+                    except ValueError as e:
+                        res = {'params': dict(param_dict), 'error': str(e)}
+                res['name'] = 'reconstruction'
+                results[key] = res
+                print(format_report({key: res}).split('\n')[-1], flush=True)
+    finally:
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmarks of reconstruct_ptychography.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, default=None,
+                        help='Scenario to benchmark. Can be given more than once. Default is all.')
+    parser.add_argument('--backend', action='append', choices=['autograd', 'pytorch'], default=None)
+    parser.add_argument('--distribution-mode', action='append', choices=list(DISTRIBUTION_MODES.keys()),
+                        default=None)
+    parser.add_argument('--minibatch-size', action='append', type=int, default=None)
+    parser.add_argument('--n-dp-batch', action='append', type=int, default=None,
+                        help='Default is the minibatch size.')
+    parser.add_argument('--ranks', action='append', type=int, default=None, help='Number of ranks.')
+    parser.add_argument('--n-batches', type=int, default=5, help='Number of timed batches.')
+    parser.add_argument('--n-warmup', type=int, default=1, help='Number of batches excluded from timing.')
+    parser.add_argument('--size', type=int, default=32, help='Lateral size of the object in pixels.')
+    parser.add_argument('--n-theta', type=int, default=4)
+    parser.add_argument('--gpu', action='store_true', help='Allow the PyTorch backend to use the GPU.')
+    parser.add_argument('--launcher', default='local',
+                        help='"local" to use adorym-run, or an MPI launch command with {n} in place of the number '
+                             'of ranks, e.g. "mpirun -n {n}".')
+    parser.add_argument('--threads-per-rank', type=int, default=None, help='Passed to adorym-run.')
+    parser.add_argument('--timeout', type=float, default=1800, help='Timeout of each job in seconds.')
+    parser.add_argument('--workdir', default=None,
+                        help='Folder for data and outputs. Simulated data in it are reused. Default is a temporary '
+                             'folder that is removed at the end.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary working directory.')
+    parser.add_argument('--output', default=None, help='JSON file to save the results to.')
+    parser.add_argument('--compare', default=None, help='JSON file of earlier results to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the jobs.')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker is not None:
+        run_worker(args.worker)
+        return 0
+
+    results = run_benchmarks(args)
+    print()
+    print(format_report(results))
+    if args.output is not None:
+        save_results(args.output, results, get_machine_metadata())
+        print('Results saved to {}.'.format(args.output))
+    if args.compare is not None:
+        old_meta, old_results = load_results(args.compare)
+        old_results = collections.OrderedDict((k, v) for k, v in old_results.items() if k in results)
+        git_old = old_meta.get('git') or {}
+        print('\nComparison of batch times with {} (commit {}):'.format(args.compare,
+                                                                        git_old.get('commit', 'unknown')))
+        comparison = compare_results(old_results, results, threshold=args.threshold)
+        print(format_comparison(comparison))
+        if any(c[4] == 'slower' for c in comparison):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
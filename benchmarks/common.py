@@ -0,0 +1,360 @@
+"""
+Shared machinery for the benchmarks in this folder.
+
+Benchmarks are registered with the benchmark decorator. A benchmark is a setup function that takes the values of
+its parameters as keyword arguments, prepares the synthetic inputs, and returns the function to be timed (or a
+tuple of the function to be timed and a teardown function). Only the returned function is timed. Results are saved
+as JSON files together with machine metadata, so that runs made at different commits can be compared with
+compare_results.
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import platform
+import datetime
+import itertools
+import subprocess
+import collections
+
+import numpy as np
+
+import adorym.global_settings as global_settings
+
+__all__ = ['Benchmark', 'benchmark', 'registry', 'get_available_backends', 'use_backend', 'get_machine_metadata',
+           'run_benchmarks', 'save_results', 'load_results', 'compare_results', 'format_comparison',
+           'format_results', 'add_common_arguments', 'main']
+
+RESULT_FORMAT_VERSION = 1
+
+
+class Benchmark(object):
+    """
+    A registered benchmark.
+
+    :param func: Setup function. Called with the values of the parameters as keyword arguments; returns the
+                 function to be timed, or a tuple of the function to be timed and a teardown function.
+    :param name: String. Name of the benchmark. Default is the name of func without the prefix 'time_'.
+    :param params: OrderedDict or dict mapping parameter names to lists of values. Every combination of values
+                   is benchmarked. The parameter 'backend' is special: its values are restricted to the backends
+                   that can be imported and that are selected by the user.
+    :param group: String. Name of the group in which the benchmark is reported.
+    """
+    def __init__(self, func, name=None, params=None, group=None):
+        self.func = func
+        if name is None:
+            name = func.__name__[len('time_'):] if func.__name__.startswith('time_') else func.__name__
+        self.name = name
+        self.params = collections.OrderedDict(params if params is not None else {})
+        self.group = group
+
+    def get_param_combinations(self, quick=False, backends=None):
+        """
+        :param quick: Bool. If True, only the first value of each numerical parameter (such as sizes) is used.
+        :param backends: None or list of String. Backends to keep. Default is all available backends.
+        """
+        value_ls = []
+        for key, values in self.params.items():
+            if key == 'backend':
+                values = [v for v in values if v in get_available_backends()]
+                if backends is not None:
+                    values = [v for v in values if v in backends]
+            elif quick and all(isinstance(v, (int, float)) for v in values):
+                values = values[:1]
+            value_ls.append(values)
+        for combination in itertools.product(*value_ls):
+            yield collections.OrderedDict(zip(self.params.keys(), combination))
+
+    def get_key(self, param_dict):
+        if len(param_dict) == 0:
+            return self.name
+        return '{}[{}]'.format(self.name, ','.join('{}={}'.format(k, v) for k, v in param_dict.items()))
+
+
+registry = collections.OrderedDict()
+
+
+def benchmark(name=None, params=None, group=None):
+    """
+    Decorator registering a setup function as a benchmark. See Benchmark.
+    """
+    def decorator(func):
+        b = Benchmark(func, name=name, params=params, group=group)
+        registry[b.name] = b
+        return func
+    return decorator
+
+
+def get_available_backends():
+    import adorym.wrappers as w
+    backend_ls = []
+    if w.flag_autograd_avail:
+        backend_ls.append('autograd')
+    if w.flag_pytorch_avail:
+        backend_ls.append('pytorch')
+    return backend_ls
+
+
+def use_backend(backend):
+    """
+    Set the global backend of adorym. The benchmark runner restores the previous backend after each benchmark.
+    """
+    global_settings.backend = backend
+
+
+def _get_git_info():
+    folder = os.path.dirname(os.path.abspath(__file__))
+    info = {}
+    for key, cmd in [('commit', ['git', 'rev-parse', 'HEAD']),
+                     ('branch', ['git', 'rev-parse', '--abbrev-ref', 'HEAD']),
+                     ('dirty', ['git', 'status', '--porcelain', '--untracked-files=no'])]:
+        try:
+            out = subprocess.check_output(cmd, cwd=folder, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        info[key] = out if key != 'dirty' else len(out) > 0
+    return info
+
+
+def _get_version(module_name):
+    try:
+        module = __import__(module_name)
+        return getattr(module, '__version__', 'unknown')
+    except ImportError:
+        return None
+
+
+def get_machine_metadata():
+    """
+    Collect information about the machine, the software versions and the git revision that results are
+    recorded with.
+    """
+    meta = {'format_version': RESULT_FORMAT_VERSION,
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'git': _get_git_info(),
+            'versions': {name: _get_version(name) for name in ['numpy', 'scipy', 'h5py', 'autograd', 'torch',
+                                                                'mpi4py']}}
+    try:
+        import psutil
+        meta['total_memory_bytes'] = psutil.virtual_memory().total
+    except ImportError:
+        pass
+    if meta['versions']['torch'] is not None:
+        import torch
+        meta['torch_num_threads'] = torch.get_num_threads()
+        meta['cuda_available'] = torch.cuda.is_available()
+    env_keys = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'CUDA_VISIBLE_DEVICES']
+    meta['environment'] = {k: os.environ[k] for k in env_keys if k in os.environ}
+    return meta
+
+
+def _time_function(func, number):
+    t0 = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - t0) / number
+
+
+def run_benchmark(bench, param_dict, repeat=5, min_time=0.1, warmup=1):
+    """
+    Time a benchmark for one combination of parameters.
+
+    :param repeat: Int. Number of rounds that timings are collected from.
+    :param min_time: Float. The number of calls in each round is chosen so that a round takes at least this many
+                     seconds.
+    :param warmup: Int. Number of untimed calls made before timing.
+    :return: Dict of statistics of the time per call in seconds.
+    """
+    backend_temp = global_settings.backend
+    try:
+        ret = bench.func(**param_dict)
+        if isinstance(ret, tuple):
+            func, teardown = ret
+        else:
+            func, teardown = ret, None
+        try:
+            for _ in range(warmup):
+                func()
+            # Calibrate the number of calls per round with a single call.
+            t_single = _time_function(func, 1)
+            number = max(1, int(np.ceil(min_time / max(t_single, 1e-9))))
+            t_ls = [_time_function(func, number) for _ in range(repeat)]
+        finally:
+            if teardown is not None:
+                teardown()
+    finally:
+        global_settings.backend = backend_temp
+    return {'name': bench.name,
+            'group': bench.group,
+            'params': dict(param_dict),
+            'number': number,
+            'repeat': repeat,
+            'min': float(np.min(t_ls)),
+            'median': float(np.median(t_ls)),
+            'mean': float(np.mean(t_ls)),
+            'stdev': float(np.std(t_ls)),
+            'times': [float(t) for t in t_ls]}
+
+
+def run_benchmarks(pattern=None, quick=False, backends=None, repeat=5, min_time=0.1, warmup=1, verbose=True):
+    """
+    Run all registered benchmarks whose key matches the regular expression pattern.
+
+    :return: OrderedDict of results keyed by the benchmark keys.
+    """
+    results = collections.OrderedDict()
+    for bench in registry.values():
+        for param_dict in bench.get_param_combinations(quick=quick, backends=backends):
+            key = bench.get_key(param_dict)
+            if pattern is not None and re.search(pattern, key) is None:
+                continue
+            try:
+                res = run_benchmark(bench, param_dict, repeat=repeat, min_time=min_time, warmup=warmup)
+            except Exception as e:
+                res = {'name': bench.name, 'group': bench.group, 'params': dict(param_dict),
+                       'error': '{}: {}'.format(type(e).__name__, e)}
+            results[key] = res
+            if verbose:
+                print(format_results({key: res}, header=False), flush=True)
+    return results
+
+
+def save_results(fname, results, metadata=None):
+    if metadata is None:
+        metadata = get_machine_metadata()
+    folder = os.path.dirname(fname)
+    if folder != '' and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(fname, 'w') as f:
+        json.dump({'metadata': metadata, 'results': results}, f, indent=2)
+
+
+def load_results(fname):
+    with open(fname, 'r') as f:
+        d = json.load(f, object_pairs_hook=collections.OrderedDict)
+    return d['metadata'], d['results']
+
+
+def _format_time(t):
+    for unit, scale in [('s', 1.), ('ms', 1e-3), ('us', 1e-6)]:
+        if t >= scale:
+            return '{:.3f} {}'.format(t / scale, unit)
+    return '{:.3f} ns'.format(t / 1e-9)
+
+
+def format_results(results, header=True):
+    width = max([len(k) for k in results.keys()] + [9])
+    lines = []
+    if header:
+        lines.append('{:<{w}}  {:>12}  {:>12}  {:>12}'.format('Benchmark', 'min', 'median', 'stdev', w=width))
+    for key, res in results.items():
+        if 'error' in res:
+            lines.append('{:<{w}}  failed: {}'.format(key, res['error'], w=width))
+        else:
+            lines.append('{:<{w}}  {:>12}  {:>12}  {:>12}'.format(key, _format_time(res['min']),
+                                                                  _format_time(res['median']),
+                                                                  _format_time(res['stdev']), w=width))
+    return '\n'.join(lines)
+
+
+def compare_results(old_results, new_results, threshold=0.1, stat='median'):
+    """
+    Compare two sets of results.
+
+    :param threshold: Float. Relative change beyond which a benchmark is reported as slower or faster.
+    :return: List of tuples (key, old time, new time, ratio, status), where status is one of 'slower', 'faster',
+             'same', 'new', 'removed' or 'failed'.
+    """
+    comparison = []
+    for key in list(old_results.keys()) + [k for k in new_results.keys() if k not in old_results]:
+        old = old_results.get(key)
+        new = new_results.get(key)
+        if new is None:
+            comparison.append((key, old.get(stat), None, None, 'removed'))
+        elif old is None:
+            comparison.append((key, None, new.get(stat), None, 'new'))
+        elif 'error' in old or 'error' in new:
+            comparison.append((key, old.get(stat), new.get(stat), None, 'failed'))
+        else:
+            ratio = new[stat] / old[stat] if old[stat] > 0 else float('inf')
+            if ratio > 1 + threshold:
+                status = 'slower'
+            elif ratio < 1. / (1 + threshold):
+                status = 'faster'
+            else:
+                status = 'same'
+            comparison.append((key, old[stat], new[stat], ratio, status))
+    return comparison
+
+
+def format_comparison(comparison):
+    width = max([len(c[0]) for c in comparison] + [9])
+    lines = ['{:<{w}}  {:>12}  {:>12}  {:>7}  {}'.format('Benchmark', 'before', 'after', 'ratio', 'status',
+                                                         w=width)]
+    for key, t_old, t_new, ratio, status in comparison:
+        lines.append('{:<{w}}  {:>12}  {:>12}  {:>7}  {}'.format(key,
+                                                                 _format_time(t_old) if t_old is not None else '-',
+                                                                 _format_time(t_new) if t_new is not None else '-',
+                                                                 '{:.2f}'.format(ratio) if ratio is not None else '-',
+                                                                 status, w=width))
+    return '\n'.join(lines)
+
+
+def add_common_arguments(parser):
+    parser.add_argument('--filter', default=None, help='Regular expression selecting the benchmarks to run.')
+    parser.add_argument('--quick', action='store_true',
+                        help='Use only the first value of each numerical parameter, such as sizes.')
+    parser.add_argument('--backend', action='append', default=None,
+                        help='Backend to benchmark. Can be given more than once. Default is all available.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='Minimum duration of a timing round in seconds.')
+    parser.add_argument('--output', default=None, help='JSON file to save the results to.')
+    parser.add_argument('--compare', default=None, help='JSON file of earlier results to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change reported as a regression or an improvement.')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit.')
+
+
+def main(argv=None, description=None):
+    """
+    Command line entry point shared by the benchmark modules. Returns 1 if a comparison finds a regression.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=description)
+    add_common_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for bench in registry.values():
+            for param_dict in bench.get_param_combinations(quick=args.quick, backends=args.backend):
+                key = bench.get_key(param_dict)
+                if args.filter is None or re.search(args.filter, key) is not None:
+                    print(key)
+        return 0
+
+    results = run_benchmarks(pattern=args.filter, quick=args.quick, backends=args.backend, repeat=args.repeat,
+                             min_time=args.min_time)
+    if args.output is not None:
+        save_results(args.output, results)
+        print('Results saved to {}.'.format(args.output))
+    if args.compare is not None:
+        old_meta, old_results = load_results(args.compare)
+        git_old = old_meta.get('git') or {}
+        print('\nComparison with {} (commit {}):'.format(args.compare, git_old.get('commit', 'unknown')))
+        if args.filter is not None or args.quick or args.backend is not None:
+            # Benchmarks left out of this run are not reported as removed.
+            old_results = collections.OrderedDict((k, v) for k, v in old_results.items() if k in results)
+        comparison = compare_results(old_results, results, threshold=args.threshold)
+        print(format_comparison(comparison))
+        if any(c[4] == 'slower' for c in comparison):
+            return 1
+    return 0
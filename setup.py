@@ -7,6 +7,7 @@ setuptools.setup(
     description='Automatic differentiation-based object retrieval with dynamic modeling.',
     packages=setuptools.find_packages(exclude=['docs']),
     include_package_data=True,
+    entry_points={'console_scripts': ['adorym-run=adorym.local_comm:main']},
     url='http://github.com/mdw771/adorym.git',
     keywords=['adorym'],
     license='BSD-3',
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+# The test_*.py scripts in this folder run full reconstructions of the demo datasets when imported, so they are
+# run by hand and not collected by pytest. Tests collected by pytest are in subfolders.
+collect_ignore_glob = ['test_*.py']
+
+PERF_BASELINE = os.path.join(os.path.dirname(__file__), 'perf', 'baseline.json')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('perf', 'performance regression tests (run with -m perf)')
+    group.addoption('--perf-baseline', default=PERF_BASELINE,
+                    help='JSON file of baseline measurements. Default is tests/perf/baseline.json.')
+    group.addoption('--perf-update-baseline', action='store_true',
+                    help='Write the measurements to the baseline file instead of comparing with it.')
+    group.addoption('--perf-time-tolerance', type=float, default=0.5,
+                    help='Allowed relative increase of the time of a phase.')
+    group.addoption('--perf-time-floor', type=float, default=0.01,
+                    help='Allowed absolute increase of the time of a phase in seconds, so that short phases do not '
+                         'fail on noise.')
+    group.addoption('--perf-memory-tolerance', type=float, default=0.2,
+                    help='Allowed relative increase of memory.')
+    group.addoption('--perf-memory-floor', type=float, default=32.,
+                    help='Allowed absolute increase of memory in MB.')
+    group.addoption('--perf-repeat', type=int, default=3,
+                    help='Number of times each case is run. The fastest time of each phase is compared.')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'perf: performance regression test; run with "pytest -m perf".')
+
+
+def pytest_collection_modifyitems(config, items):
+    # Performance tests are slow and only meaningful on a quiet machine, so they are run only when selected.
+    if 'perf' in (config.option.markexpr or ''):
+        return
+    skip = pytest.mark.skip(reason='performance tests run only with "-m perf"')
+    for item in items:
+        if 'perf' in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,238 @@
+"""
+Performance regression tests. Small reconstructions with fixed seeds are run with timing and memory profiling,
+and the time and memory of each timed phase are compared with the committed baseline in baseline.json:
+
+    pytest -m perf tests
+
+A phase fails if its median time per call, or its memory growth, exceeds the baseline by more than the tolerances
+(see the --perf-* options in tests/conftest.py); the peak RSS of the run is also checked. The failure message
+lists all phases of the case with their baseline and current values.
+
+Timings depend on the machine, so the baseline must be recorded on the machine the tests run on, with the same
+number of threads:
+
+    pytest -m perf tests --perf-update-baseline
+"""
+import os
+import sys
+import csv
+import json
+
+import numpy as np
+import pytest
+
+import adorym
+from adorym.timing import timers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmarks'))
+from common import get_machine_metadata
+from bench_reconstruction import get_scenario, create_phantom
+
+SEED = 1234
+
+# Cases are named after the scenarios of benchmarks/bench_reconstruction.py. They are small enough to run in
+# seconds on a laptop CPU.
+CASES = {'2d_ptycho_autograd': {'scenario': '2d_ptycho', 'backend': 'autograd'},
+         'multislice_ptycho_autograd': {'scenario': 'multislice_ptycho', 'backend': 'autograd'},
+         'multislice_ptycho_pytorch': {'scenario': 'multislice_ptycho', 'backend': 'pytorch'},
+         'multislice_ptycho_distributed_object': {'scenario': 'multislice_ptycho', 'backend': 'autograd',
+                                                  'distribution_mode': 'distributed_object'},
+         'fullfield_tomo_autograd': {'scenario': 'fullfield_tomo', 'backend': 'autograd'}}
+SIZE = 32
+N_THETA = 2
+MINIBATCH_SIZE = 4
+
+
+class Baseline(object):
+    """
+    Baseline measurements, keyed by case. New measurements are written to the file at the end of the session
+    when the baseline is being updated.
+    """
+    def __init__(self, fname, update=False):
+        self.fname = fname
+        self.update = update
+        self.metadata = {}
+        self.cases = {}
+        if os.path.exists(fname):
+            with open(fname, 'r') as f:
+                d = json.load(f)
+            self.metadata = d.get('metadata', {})
+            self.cases = d.get('cases', {})
+        self.updated = False
+
+    def record(self, case, measurement):
+        self.cases[case] = measurement
+        self.updated = True
+
+    def save(self):
+        with open(self.fname, 'w') as f:
+            json.dump({'metadata': get_machine_metadata(), 'cases': self.cases}, f, indent=2, sort_keys=True)
+
+
+@pytest.fixture(scope='session')
+def perf_baseline(request):
+    baseline = Baseline(request.config.getoption('--perf-baseline'),
+                        update=request.config.getoption('--perf-update-baseline'))
+    yield baseline
+    if baseline.updated:
+        baseline.save()
+
+
+@pytest.fixture(scope='session')
+def perf_tolerances(request):
+    return {'time': (request.config.getoption('--perf-time-tolerance'),
+                     request.config.getoption('--perf-time-floor')),
+            'memory': (request.config.getoption('--perf-memory-tolerance'),
+                       request.config.getoption('--perf-memory-floor'))}
+
+
+@pytest.fixture(scope='session')
+def perf_data(tmp_path_factory):
+    """
+    Simulate the data of a scenario on first use.
+    """
+    folder_dict = {}
+
+    def get_data(scenario_name):
+        if scenario_name not in folder_dict:
+            folder = str(tmp_path_factory.mktemp(scenario_name))
+            scenario = get_scenario(scenario_name, size=SIZE, n_theta=N_THETA)
+            grid_delta, grid_beta = create_phantom(scenario['obj_size'], unknown_type=scenario['unknown_type'],
+                                                   seed=SEED)
+            os.makedirs(os.path.join(folder, 'phantom'))
+            np.save(os.path.join(folder, 'phantom', 'grid_delta.npy'), grid_delta)
+            np.save(os.path.join(folder, 'phantom', 'grid_beta.npy'), grid_beta)
+            np.random.seed(SEED)
+            run_in_folder(folder, adorym.simulate_ptychography,
+                          **dict(scenario['sim_params'], fname='data.h5', save_path=folder,
+                                 phantom_path=os.path.join(folder, 'phantom'), output_folder='simulation',
+                                 minibatch_size=1, n_dp_batch=1, cpu_only=True, use_checkpoint=False))
+            folder_dict[scenario_name] = (folder, scenario)
+        return folder_dict[scenario_name]
+    return get_data
+
+
+def run_in_folder(folder, func, **kwargs):
+    # Rotation lookup tables are written to the working directory.
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        return func(**kwargs)
+    finally:
+        os.chdir(cwd)
+
+
+def read_memory_csv(fname, rank=0):
+    memory = {}
+    with open(fname, 'r') as f:
+        for row in csv.DictReader(f):
+            if int(row['rank']) == rank:
+                memory[row['phase']] = {'rss_peak': float(row['rss_peak']), 'rss_growth': float(row['rss_growth'])}
+    return memory
+
+
+def run_case(folder, scenario, case_params, output_folder):
+    """
+    Run one reconstruction with timing and memory profiling.
+
+    :return: Dict with the median time and count of each phase ('phases'), the RSS growth of each phase in MB
+             ('memory'), and the peak RSS of the run in MB ('peak_rss_mb').
+    """
+    minibatch_size = scenario['fixed_minibatch_size'] or MINIBATCH_SIZE
+    params = dict(scenario['rec_params'], fname='data.h5', save_path=folder, output_folder=output_folder,
+                  n_epochs=1, minibatch_size=minibatch_size, n_dp_batch=minibatch_size,
+                  backend=case_params['backend'], distribution_mode=case_params.get('distribution_mode', None),
+                  cpu_only=True, learning_rate=1e-7, optimizer='adam', alpha_d=0, alpha_b=0, gamma=0,
+                  random_seed=SEED, use_checkpoint=False, store_checkpoint=False, memory_profiling=True)
+    run_in_folder(folder, adorym.reconstruct_ptychography, **params)
+    summary = timers.summarize()
+    memory = read_memory_csv(os.path.join(folder, output_folder, 'timing', 'memory.csv'))
+    return {'phases': {path: {'count': d['count'], 'p50': d['p50']} for path, d in summary.items()},
+            'memory': {path: d['rss_growth'] for path, d in memory.items()},
+            'peak_rss_mb': max([d['rss_peak'] for d in memory.values()])}
+
+
+def merge_runs(run_ls):
+    """
+    Keep the fastest time of each phase and the largest memory over repeated runs.
+    """
+    merged = {'phases': {}, 'memory': {}, 'peak_rss_mb': max([r['peak_rss_mb'] for r in run_ls])}
+    for r in run_ls:
+        for path, d in r['phases'].items():
+            if path not in merged['phases'] or d['p50'] < merged['phases'][path]['p50']:
+                merged['phases'][path] = dict(d)
+        for path, v in r['memory'].items():
+            merged['memory'][path] = max(merged['memory'].get(path, 0.), v)
+    return merged
+
+
+def compare_with_baseline(baseline, current, tolerances):
+    """
+    :return: (List of rows (quantity, phase, baseline, current, limit, status), bool that is True if any
+             quantity exceeds its limit).
+    """
+    row_ls = []
+    failed = False
+
+    def check(quantity, path, old, new, tol):
+        nonlocal failed
+        if old is None:
+            row_ls.append((quantity, path, None, new, None, 'new'))
+            return
+        if new is None:
+            row_ls.append((quantity, path, old, None, None, 'missing'))
+            return
+        limit = max(old * (1 + tol[0]), old + tol[1])
+        status = 'ok'
+        if new > limit:
+            status = 'FAIL'
+            failed = True
+        row_ls.append((quantity, path, old, new, limit, status))
+
+    for path in sorted(set(baseline['phases'].keys()) | set(current['phases'].keys())):
+        old = baseline['phases'].get(path, {}).get('p50')
+        new = current['phases'].get(path, {}).get('p50')
+        check('time (s)', path, old, new, tolerances['time'])
+    for path in sorted(set(baseline['memory'].keys()) | set(current['memory'].keys())):
+        check('rss growth (MB)', path, baseline['memory'].get(path), current['memory'].get(path),
+              tolerances['memory'])
+    check('peak rss (MB)', '(run)', baseline['peak_rss_mb'], current['peak_rss_mb'], tolerances['memory'])
+    return row_ls, failed
+
+
+def format_report(case, row_ls, baseline_metadata):
+    def fmt(v):
+        return '-' if v is None else '{:.4g}'.format(v)
+    l = max([len(r[1]) for r in row_ls] + [5])
+    lines = ['Performance regression in {}:'.format(case),
+             '{:<16} {:<{}} {:>10} {:>10} {:>10} {:>8}  {}'.format('quantity', 'phase', l, 'baseline', 'current',
+                                                                  'limit', 'ratio', 'status')]
+    for quantity, path, old, new, limit, status in row_ls:
+        ratio = '-' if old is None or new is None or old == 0 else '{:.2f}'.format(new / old)
+        lines.append('{:<16} {:<{}} {:>10} {:>10} {:>10} {:>8}  {}'.format(quantity, path, l, fmt(old), fmt(new),
+                                                                          fmt(limit), ratio, status))
+    git = baseline_metadata.get('git') or {}
+    lines.append('Baseline recorded at commit {} on {}. Re-record with --perf-update-baseline if the change is '
+                 'intended.'.format(git.get('commit', 'unknown'), baseline_metadata.get('hostname', 'unknown')))
+    return '\n'.join(lines)
+
+
+@pytest.mark.perf
+@pytest.mark.parametrize('case', list(CASES.keys()))
+def test_reconstruction_performance(case, request, perf_data, perf_baseline, perf_tolerances):
+    case_params = CASES[case]
+    if case_params['backend'] == 'pytorch':
+        pytest.importorskip('torch')
+    folder, scenario = perf_data(case_params['scenario'])
+    run_ls = [run_case(folder, scenario, case_params, 'rec_{}_{}'.format(case, i))
+              for i in range(request.config.getoption('--perf-repeat'))]
+    current = merge_runs(run_ls)
+
+    if perf_baseline.update:
+        perf_baseline.record(case, current)
+        return
+    if case not in perf_baseline.cases:
+        pytest.skip('No baseline for {} in {}.'.format(case, perf_baseline.fname))
+    row_ls, failed = compare_with_baseline(perf_baseline.cases[case], current, perf_tolerances)
+    if failed:
+        pytest.fail(format_report(case, row_ls, perf_baseline.metadata), pytrace=False)
@@ -0,0 +1,76 @@
+"""
+Worker script of test_local_comm.py, run by adorym.local_comm.launch with several ranks:
+
+    python local_comm_worker.py collectives [output folder]
+    python local_comm_worker.py crash [output folder]
+
+In 'collectives' mode, each rank runs the collectives of LocalComm on data from get_data and pickles the results
+to [output folder]/rank_[rank].pkl, so that the test can compare them with NumPy. In 'crash' mode, rank 0 leaves a
+shared memory block behind and exits with code 3 while the other ranks wait.
+"""
+import os
+import sys
+import glob
+import time
+import pickle
+
+import numpy as np
+
+# Large enough to be moved through shared memory (see adorym.local_comm.SHM_THRESHOLD).
+LARGE_SHAPE = [128, 128]
+SMALL_SHAPE = [4]
+
+
+def get_data(i, shape):
+    return np.random.RandomState(i).rand(*shape)
+
+
+def run_collectives(comm, output_folder):
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    small = get_data(rank, SMALL_SHAPE)
+    large = get_data(rank, LARGE_SHAPE)
+    res = {'rank': rank, 'size': size}
+    res['allreduce_scalar'] = comm.allreduce(rank + 1)
+    res['allreduce_small'] = comm.allreduce(small)
+    res['allreduce_large'] = comm.allreduce(large)
+    res['allreduce_max'] = comm.allreduce(small, op=np.maximum)
+    buf = large.copy()
+    comm.Allreduce(buf)
+    res['Allreduce'] = buf
+    res['bcast'] = comm.bcast({'root': rank, 'arr': large} if rank == size - 1 else None, root=size - 1)
+    buf = large.copy() if rank == 1 else np.zeros(LARGE_SHAPE)
+    comm.Bcast(buf, root=1)
+    res['Bcast'] = buf
+    res['allgather'] = comm.allgather((rank, small))
+    # Odd destinations get large arrays, so both the pickled and the shared memory paths are used.
+    res['alltoall'] = comm.alltoall([get_data(rank * size + i, LARGE_SHAPE if i % 2 else SMALL_SHAPE)
+                                     for i in range(size)])
+    comm.send(large, (rank + 1) % size, tag=5)
+    res['recv'] = comm.recv(source=(rank - 1) % size, tag=5)
+    sub_comm = comm.Split(color=rank % 2, key=-rank)
+    res['split'] = {'rank': sub_comm.Get_rank(), 'size': sub_comm.Get_size(),
+                    'allreduce': sub_comm.allreduce(large), 'allgather': sub_comm.allgather(rank)}
+    comm.Barrier()
+    # All collectives have returned on all ranks, so their shared memory blocks must be gone.
+    res['leftover_shm'] = glob.glob(os.path.join('/dev/shm', comm.channel.job_id + '*'))
+    with open(os.path.join(output_folder, 'rank_{}.pkl'.format(rank)), 'wb') as f:
+        pickle.dump(res, f)
+
+
+def run_crash(comm, output_folder):
+    from adorym.local_comm import _open_shm
+    with open(os.path.join(output_folder, 'job_id.txt'), 'w') as f:
+        f.write(comm.channel.job_id)
+    comm.Barrier()
+    if comm.Get_rank() == 0:
+        shm = _open_shm(comm.channel.new_block_name(), create=True, size=1 << 16)
+        shm.close()
+        sys.exit(3)
+    time.sleep(60)
+
+
+if __name__ == '__main__':
+    from adorym.local_comm import LocalComm
+    comm = LocalComm.from_environ()
+    {'collectives': run_collectives, 'crash': run_crash}[sys.argv[1]](comm, sys.argv[2])
@@ -0,0 +1,75 @@
+"""
+Tests of the shared-memory communicator of adorym-run. The collectives are run by local_comm_worker.py in
+separate processes started by adorym.local_comm.launch, and their results are compared with NumPy.
+"""
+import os
+import glob
+import pickle
+
+import numpy as np
+import pytest
+
+import adorym
+from adorym.local_comm import launch
+
+from local_comm_worker import get_data, LARGE_SHAPE, SMALL_SHAPE
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_comm_worker.py')
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm')
+
+
+@pytest.fixture(autouse=True)
+def worker_env(monkeypatch):
+    # Workers import adorym from this tree and run single-threaded.
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(adorym.__file__)))
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([repo, os.environ.get('PYTHONPATH', '')]))
+    monkeypatch.setenv('OMP_NUM_THREADS', '1')
+
+
+def run_workers(mode, n_ranks, folder):
+    return launch(WORKER, [mode, str(folder)], n_ranks=n_ranks)
+
+
+@pytest.mark.parametrize('n_ranks', [2, 3])
+def test_collectives(n_ranks, tmp_path):
+    assert run_workers('collectives', n_ranks, tmp_path) == 0
+    res_ls = []
+    for rank in range(n_ranks):
+        with open(os.path.join(str(tmp_path), 'rank_{}.pkl'.format(rank)), 'rb') as f:
+            res_ls.append(pickle.load(f))
+    small_ls = [get_data(i, SMALL_SHAPE) for i in range(n_ranks)]
+    large_ls = [get_data(i, LARGE_SHAPE) for i in range(n_ranks)]
+
+    for rank, res in enumerate(res_ls):
+        assert (res['rank'], res['size']) == (rank, n_ranks)
+        assert res['allreduce_scalar'] == n_ranks * (n_ranks + 1) // 2
+        np.testing.assert_allclose(res['allreduce_small'], np.sum(small_ls, axis=0))
+        np.testing.assert_allclose(res['allreduce_large'], np.sum(large_ls, axis=0))
+        np.testing.assert_array_equal(res['allreduce_max'], np.max(small_ls, axis=0))
+        np.testing.assert_allclose(res['Allreduce'], np.sum(large_ls, axis=0))
+        assert res['bcast']['root'] == n_ranks - 1
+        np.testing.assert_array_equal(res['bcast']['arr'], large_ls[-1])
+        np.testing.assert_array_equal(res['Bcast'], large_ls[1])
+        assert [r for r, _ in res['allgather']] == list(range(n_ranks))
+        for i, (_, a) in enumerate(res['allgather']):
+            np.testing.assert_array_equal(a, small_ls[i])
+        for i, a in enumerate(res['alltoall']):
+            np.testing.assert_array_equal(a, get_data(i * n_ranks + rank, LARGE_SHAPE if rank % 2 else SMALL_SHAPE))
+        np.testing.assert_array_equal(res['recv'], large_ls[(rank - 1) % n_ranks])
+
+        # Ranks with the same color, ordered by key = -rank.
+        members = sorted([i for i in range(n_ranks) if i % 2 == rank % 2], reverse=True)
+        split = res['split']
+        assert (split['rank'], split['size']) == (members.index(rank), len(members))
+        assert split['allgather'] == members
+        np.testing.assert_allclose(split['allreduce'], np.sum([large_ls[i] for i in members], axis=0))
+
+        assert res['leftover_shm'] == []
+
+
+def test_shm_removed_after_failure(tmp_path):
+    assert run_workers('crash', 2, tmp_path) == 3
+    with open(os.path.join(str(tmp_path), 'job_id.txt'), 'r') as f:
+        job_id = f.read()
+    assert glob.glob(os.path.join('/dev/shm', job_id + '*')) == []
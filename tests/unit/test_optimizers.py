@@ -0,0 +1,56 @@
+"""
+Convergence tests of optimizers on small problems with known minimizers.
+"""
+import numpy as np
+import pytest
+
+import adorym
+from adorym.optimizers import LBFGSOptimizer
+
+SHAPE = (6, 5)
+
+
+class QuadraticModel(adorym.ForwardModel):
+    """
+    Stand-in forward model whose loss is the convex quadratic 0.5 * x^T A x - b^T x of the flattened object,
+    with the condition number of A set by cond.
+    """
+    def __init__(self, cond=100., seed=0):
+        n = int(np.prod(SHAPE))
+        rng = np.random.RandomState(seed)
+        q, _ = np.linalg.qr(rng.randn(n, n))
+        self.a = q.dot(np.diag(np.logspace(0, np.log10(cond), n))).dot(q.T)
+        self.b = rng.randn(n)
+        self.loss_args = {}
+        self.current_loss = 0
+
+    def loss(self, obj):
+        x = obj.reshape(-1)
+        return 0.5 * x.dot(self.a.dot(x)) - self.b.dot(x)
+
+    def grad(self, obj):
+        return (self.a.dot(obj.reshape(-1)) - self.b).reshape(SHAPE)
+
+    def get_loss_function(self):
+        return self.loss
+
+    def get_minimizer(self):
+        return np.linalg.solve(self.a, self.b).reshape(SHAPE)
+
+
+@pytest.mark.parametrize('linesearch_type', [None, 'backtracking'])
+def test_lbfgs_converges_on_quadratic(linesearch_type):
+    model = QuadraticModel()
+    opt = LBFGSOptimizer('obj', options_dict={'history_size': 5}, forward_model=model)
+    opt.create_param_arrays(list(SHAPE), use_numpy=True, dtype='float64')
+    x = np.zeros(SHAPE)
+    loss_ls = [model.loss(x)]
+    for i in range(60):
+        model.current_loss = loss_ls[-1]
+        x = opt.apply_gradient(x, model.grad(x), i, step_size=1., linesearch_type=linesearch_type)
+        loss_ls.append(model.loss(x))
+    if linesearch_type is not None:
+        # Accepted steps satisfy the sufficient decrease condition.
+        assert np.all(np.diff(loss_ls) <= 0)
+    # Gradient descent with the best fixed step would still have about 30% of the initial error after 60 steps.
+    np.testing.assert_allclose(x, model.get_minimizer(), atol=1e-4)